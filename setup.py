@@ -34,6 +34,13 @@ REQUIRES = [
     "iso8601"
 ]
 
+EXTRAS_REQUIRE = {
+    # cliente asyncio (shuup_cielo.aio), Python 3.5+
+    "async": ["aiohttp>=3.3"],
+    # concurrent.futures (cielo_sync_transactions) no Python 2
+    ":python_version<'3.0'": ["futures"],
+}
+
 if __name__ == '__main__':
     setuptools.setup(
         name=NAME,
@@ -46,5 +53,6 @@ if __name__ == '__main__':
         packages=["shuup_cielo"],
         include_package_data=True,
         install_requires=REQUIRES,
+        extras_require=EXTRAS_REQUIRE,
         entry_points={"shuup.addon": "shuup_cielo=shuup_cielo"}
     )
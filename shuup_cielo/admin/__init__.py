@@ -37,6 +37,11 @@ class CieloModule(CurrencyBound, AdminModule):
                 "shuup_cielo.admin.views.CancelTransactionView",
                 name="cielo.transaction-cancel"
             ),
+            admin_url(
+                "^cielo/transaction/$",
+                "shuup_cielo.admin.views.transaction.TransactionListView",
+                name="cielo.transaction.list"
+            ),
             admin_url(
                 "^cielo/$",
                 "shuup_cielo.admin.views.DashboardView",
@@ -54,6 +59,13 @@ class CieloModule(CurrencyBound, AdminModule):
                 category=category,
                 aliases=[_("Show Dashboard")]
             ),
+            MenuEntry(
+                text=_("Transactions"),
+                icon="fa fa-list",
+                url="shuup_admin:cielo.transaction.list",
+                category=category,
+                aliases=[_("Search transactions")]
+            ),
         ]
 
 
@@ -10,14 +10,16 @@ from __future__ import unicode_literals
 
 from decimal import Decimal
 
+from django.core.urlresolvers import reverse
 from django.http.response import HttpResponseBadRequest, HttpResponseServerError
 from django.shortcuts import render_to_response
 from django.views.generic.base import TemplateView, View
 
 from cielo_webservice.exceptions import CieloRequestError
 import shuup_cielo
-from shuup_cielo.constants import CieloTransactionStatus
-from shuup_cielo.models import CieloTransaction
+from shuup_cielo.circuit_breaker import get_circuit_breaker_for_config
+from shuup_cielo.constants import CIRCUIT_BREAKER_STATE_CHOICES, CieloOperationStatus, CieloTransactionStatus
+from shuup_cielo.models import CieloConfig, CieloTransaction, CieloTransactionOperation
 
 TRANSACTION_DETAIL_TEMPLAE = 'cielo/admin/order_section_transaction_detail.jinja'
 
@@ -28,7 +30,27 @@ class DashboardView(TemplateView):
 
     def get_context_data(self, **kwargs):
         context_data = super(DashboardView, self).get_context_data(**kwargs)
-        context_data.update({'VERSION': shuup_cielo.__version__})
+        cielo_configs = list(CieloConfig.objects.select_related("shop").order_by("id"))
+
+        context_data.update({
+            'VERSION': shuup_cielo.__version__,
+            'circuit_breakers': [
+                (cielo_config, get_circuit_breaker_for_config(cielo_config).get_info())
+                for cielo_config in cielo_configs
+            ],
+            'CIRCUIT_BREAKER_STATES': dict(CIRCUIT_BREAKER_STATE_CHOICES),
+            'pending_operations': CieloTransactionOperation.objects.filter(
+                status=CieloOperationStatus.Pending).count(),
+            'failed_operations': CieloTransactionOperation.objects.filter(
+                status=CieloOperationStatus.Failed).count(),
+            'notification_urls': [
+                (cielo_config, self.request.build_absolute_uri(reverse("shuup:cielo_notification", kwargs={
+                    "shop_pk": cielo_config.shop_id,
+                    "token": cielo_config.get_notification_token()
+                })))
+                for cielo_config in cielo_configs
+            ],
+        })
         return context_data
 
 
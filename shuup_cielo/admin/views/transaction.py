@@ -0,0 +1,127 @@
+# -*- coding: utf-8 -*-
+# This file is part of Shuup Cielo.
+#
+# Copyright (c) 2016, Rockho Team. All rights reserved.
+# Author: Christian Hess
+#
+# This source code is licensed under the AGPLv3 license found in the
+# LICENSE file in the root directory of this source tree.
+from __future__ import unicode_literals
+
+import hashlib
+import json
+
+from django.core.cache import cache
+from django.core.urlresolvers import reverse
+from django.utils.encoding import force_bytes
+from django.utils.translation import ugettext_lazy as _
+
+from shuup.admin.utils.picotable import ChoicesFilter, Column, DateRangeFilter, Picotable, TextFilter
+from shuup.admin.utils.views import PicotableListView
+from shuup.core.models import Shop
+from shuup.utils.i18n import format_money
+from shuup_cielo.constants import CIELO_CREDITCARD_BRAND_CHOICES, CieloTransactionStatus
+from shuup_cielo.models import CieloTransaction
+
+# por quanto tempo, em segundos, o início de cada página visitada é lembrado
+CIELO_TRANSACTION_LIST_CURSOR_TIMEOUT = 60 * 30
+
+CARD_BRAND_CHOICES = [(brand, brand.capitalize()) for brand, label in CIELO_CREDITCARD_BRAND_CHOICES]
+
+
+class KeysetPicotable(Picotable):
+    """
+    Picotable paginated by primary key instead of COUNT and OFFSET
+
+    The last primary key of each page is cached for the user and filters, so
+    moving to the next or the previous page is an index range scan. Pages that
+    were not reached yet are read with OFFSET. The number of items is not
+    counted: the next page is offered while the current one is full.
+    """
+
+    def _get_cursor_key(self, query):
+        state = json.dumps([query.get("filters") or {}, query.get("perPage")], sort_keys=True)
+        return "cielo_transaction_list:{0}:{1}".format(
+            self.request.user.pk, hashlib.sha1(force_bytes(state)).hexdigest()
+        )
+
+    def get_data(self, query):
+        per_page = max(int(query.get("perPage") or 20), 1)
+        page_num = max(int(query.get("page") or 1), 1)
+        queryset = self.process_queryset(query).order_by("-pk")
+
+        cursor_key = self._get_cursor_key(query)
+        cursors = cache.get(cursor_key) or {}
+        cursor = cursors.get(page_num)
+
+        # uma linha a mais informa se existe a próxima página
+        if page_num == 1:
+            items = list(queryset[:per_page + 1])
+        elif cursor is not None:
+            items = list(queryset.filter(pk__lt=cursor)[:per_page + 1])
+        else:
+            offset = (page_num - 1) * per_page
+            items = list(queryset[offset:offset + per_page + 1])
+
+        has_next = len(items) > per_page
+        items = items[:per_page]
+
+        if has_next:
+            cursors[page_num + 1] = items[-1].pk
+            cache.set(cursor_key, cursors, timeout=CIELO_TRANSACTION_LIST_CURSOR_TIMEOUT)
+
+        return {
+            "columns": [column.to_json(context=self.context) for column in self.columns],
+            "pagination": {
+                "perPage": per_page,
+                "nItems": (page_num - 1) * per_page + len(items) + (1 if has_next else 0),
+                "nPages": page_num + 1 if has_next else page_num,
+                "pageNum": page_num,
+            },
+            "items": [self.process_item(item) for item in items],
+            "itemInfo": _("Showing page %(page)s of %(verbose_name_plural)s") % {
+                "page": page_num,
+                "verbose_name_plural": CieloTransaction._meta.verbose_name_plural,
+            },
+        }
+
+
+class TransactionListView(PicotableListView):
+    model = CieloTransaction
+    picotable_class = KeysetPicotable
+    default_columns = [
+        Column("tid", _("Transaction ID"), sortable=False, filter_config=TextFilter(operator="exact")),
+        Column("authorization_nsu", _("Authorization NSU"), sortable=False,
+               filter_config=TextFilter(operator="exact")),
+        Column("status", _("Transaction status"), sortable=False,
+               filter_config=ChoicesFilter(choices=CieloTransactionStatus.choices())),
+        Column("cc_brand", _("Card brand"), sortable=False, filter_config=ChoicesFilter(choices=CARD_BRAND_CHOICES)),
+        Column("shop", _("Shop"), sortable=False, display="format_shop",
+               filter_config=ChoicesFilter(choices=Shop.objects.all(), filter_field="shop_id")),
+        Column("total", _("Transaction total"), sortable=False, display="format_total"),
+        Column("creation_date", _("Creation date"), sortable=False, filter_config=DateRangeFilter()),
+    ]
+
+    def get_queryset(self):
+        # o pedido só é usado pelo link, o `order_id` vem da CieloOrderTransaction
+        return CieloTransaction.objects.select_related("order_transaction")
+
+    def format_shop(self, instance, *args, **kwargs):
+        if not hasattr(self, "_shop_names"):
+            self._shop_names = dict((shop.pk, "{0}".format(shop)) for shop in Shop.objects.all())
+        return self._shop_names.get(instance.shop_id, instance.shop_id)
+
+    def format_total(self, instance, *args, **kwargs):
+        return format_money(instance.total)
+
+    def get_object_url(self, instance):
+        if instance.order_transaction.order_id:
+            return reverse("shuup_admin:order.detail", kwargs={"pk": instance.order_transaction.order_id})
+
+    def get_object_abstract(self, instance, item):
+        return [
+            {"text": instance.tid, "class": "header"},
+            {"title": _("Transaction status"), "text": item.get("status")},
+            {"title": _("Transaction total"), "text": item.get("total")},
+            {"title": _("Creation date"), "text": item.get("creation_date")},
+        ]
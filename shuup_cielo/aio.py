@@ -0,0 +1,151 @@
+# -*- coding: utf-8 -*-
+# This file is part of Shuup Cielo.
+#
+# Copyright (c) 2016, Rockho Team. All rights reserved.
+# Author: Christian Hess
+#
+# This source code is licensed under the AGPLv3 license found in the
+# LICENSE file in the root directory of this source tree.
+"""
+asyncio client for the Cielo webservice
+
+Requires Python 3.5+ and aiohttp (``pip install shuup-cielo[async]``).
+"""
+import asyncio
+import uuid
+
+from django.core.exceptions import ImproperlyConfigured
+
+from cielo_webservice.exceptions import CieloRequestError
+from cielo_webservice.models import Comercial, Erro, Transacao, xml_to_object
+from shuup_cielo.circuit_breaker import get_circuit_breaker
+from shuup_cielo.client import get_cielo_request
+from shuup_cielo.exceptions import CieloConnectionError, CieloTimeoutError
+
+try:
+    import aiohttp
+except ImportError:  # pragma: no cover
+    aiohttp = None
+
+# quantidade padrão de conexões simultâneas com a Cielo
+CIELO_DEFAULT_ASYNC_LIMIT = 100
+
+
+class AsyncCieloClient(object):
+    """
+    Non-blocking version of `CieloRequest`
+
+    The XML messages are rendered and parsed exactly like the blocking
+    client does; only the HTTP round trip is made with aiohttp, through
+    a single session that keeps the connections alive.
+    """
+
+    def __init__(self, sandbox=False, affiliation=None, connect_timeout=3, read_timeout=5,
+                 limit=CIELO_DEFAULT_ASYNC_LIMIT, circuit_breaker=None):
+        if aiohttp is None:
+            raise ImproperlyConfigured("aiohttp is required to use the asyncio Cielo client.")
+
+        # reaproveita os templates e a URL do cliente bloqueante
+        self.templates = get_cielo_request(sandbox=sandbox, affiliation=affiliation)
+        self.base_url = self.templates.base_url
+        self.timeout = aiohttp.ClientTimeout(sock_connect=float(connect_timeout), sock_read=float(read_timeout))
+        self.limit = limit
+        self.circuit_breaker = circuit_breaker
+        self._session = None
+
+    @classmethod
+    def for_config(cls, cielo_config, **kwargs):
+        """
+        :type cielo_config: shuup_cielo.models.CieloConfig
+        :rtype: AsyncCieloClient
+        """
+        kwargs.setdefault("circuit_breaker", get_circuit_breaker(cielo_config.sandbox, cielo_config.ec_num))
+        return cls(sandbox=cielo_config.sandbox,
+                   affiliation=cielo_config.ec_num,
+                   connect_timeout=cielo_config.connect_timeout,
+                   read_timeout=cielo_config.read_timeout,
+                   **kwargs)
+
+    def _get_session(self):
+        if self._session is None or self._session.closed:
+            self._session = aiohttp.ClientSession(connector=aiohttp.TCPConnector(limit=self.limit),
+                                                  timeout=self.timeout)
+        return self._session
+
+    async def close(self):
+        if self._session is not None:
+            await self._session.close()
+            self._session = None
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *exc_info):
+        await self.close()
+
+    async def _send(self, xml):
+        """
+        Posts the message and returns the response body
+        """
+        try:
+            async with self._get_session().post(self.base_url, data={'mensagem': xml}) as response:
+                return await response.text()
+        except aiohttp.ServerTimeoutError as exc:
+            raise CieloTimeoutError("Cielo did not answer in time: {0}".format(exc))
+        except aiohttp.ClientError as exc:
+            raise CieloConnectionError("Failed to talk to Cielo: {0}".format(exc))
+
+    async def _call_breaker(self, method, *args):
+        """
+        Runs a circuit breaker call in the default executor
+
+        The breaker state is kept in the Django cache, whose calls block,
+        so they are kept out of the event loop.
+        """
+        return await asyncio.get_event_loop().run_in_executor(None, method, *args)
+
+    async def _request(self, template_name, **kwargs):
+        xml = self.templates.render_template(template_name, id=str(uuid.uuid4()), **kwargs)
+        probe = False
+
+        if self.circuit_breaker:
+            probe = await self._call_breaker(self.circuit_breaker.before_call)
+
+        try:
+            object_data = xml_to_object(await self._send(xml))
+        except Exception as exc:
+            if self.circuit_breaker:
+                await self._call_breaker(self.circuit_breaker.record_exception, exc, probe)
+            raise
+
+        if isinstance(object_data, Erro):
+            exc = CieloRequestError('{0} - {1}'.format(object_data.codigo, object_data.mensagem))
+            if self.circuit_breaker:
+                await self._call_breaker(self.circuit_breaker.record_exception, exc, probe)
+            raise exc
+
+        if self.circuit_breaker:
+            await self._call_breaker(self.circuit_breaker.record_success, probe)
+
+        return object_data
+
+    async def autorizar(self, transacao):
+        if not isinstance(transacao, Transacao):
+            raise TypeError('transacao precisa ser do tipo Transacao.')
+        return await self._request('transacao.xml', transacao=transacao)
+
+    async def consultar(self, tid=None, comercial=None):
+        if not isinstance(comercial, Comercial):
+            raise TypeError('comercial precisa ser do tipo Comercial.')
+        return await self._request('consulta.xml', tid=tid, comercial=comercial)
+
+    async def capturar(self, tid=None, comercial=None, valor=None, taxa_embarque=None):
+        if not isinstance(comercial, Comercial):
+            raise TypeError('comercial precisa ser do tipo Comercial.')
+        return await self._request('captura.xml', tid=tid, comercial=comercial,
+                                   valor=valor, taxa_embarque=taxa_embarque)
+
+    async def cancelar(self, tid=None, comercial=None, valor=None):
+        if not isinstance(comercial, Comercial):
+            raise TypeError('comercial precisa ser do tipo Comercial.')
+        return await self._request('cancelamento.xml', tid=tid, comercial=comercial, valor=valor)
@@ -8,6 +8,8 @@
 # LICENSE file in the root directory of this source tree.
 
 
+from django.db.models.signals import post_delete, post_save
+
 from shuup.apps import AppConfig
 
 
@@ -35,3 +37,12 @@ class ShuupCieloAppConfig(AppConfig):
             "shuup_cielo.admin:CieloConfigModule"
         ]
     }
+
+    def ready(self):
+        from shuup_cielo.config_cache import handle_cielo_config_change
+        from shuup_cielo.models import CieloConfig
+
+        post_save.connect(handle_cielo_config_change, sender=CieloConfig,
+                          dispatch_uid="shuup_cielo:cielo_config_saved")
+        post_delete.connect(handle_cielo_config_change, sender=CieloConfig,
+                            dispatch_uid="shuup_cielo:cielo_config_deleted")
@@ -8,22 +8,27 @@
 # LICENSE file in the root directory of this source tree.
 from __future__ import unicode_literals
 
-from decimal import Decimal
+import json
 import logging
 
 from django.contrib import messages
+from django.utils.safestring import mark_safe
 from django.utils.translation import ugettext as _p
 from django.utils.translation import ugettext_lazy as _
 from django.views.generic.base import TemplateView
 
 from shuup.front.checkout import BasicServiceCheckoutPhaseProvider, CheckoutPhaseViewMixin
+from shuup_cielo.config_cache import get_cielo_config
 from shuup_cielo.constants import (
-    CIELO_AUTHORIZED_STATUSES, CIELO_DECIMAL_PRECISION, CIELO_SERVICE_CREDIT, CIELO_SERVICE_DEBIT,
-    CIELO_UKNOWN_ERROR_MSG, CieloAuthorizationCode, CieloProduct
+    CIELO_AUTHORIZED_STATUSES, CIELO_SERVICE_CREDIT, CIELO_SERVICE_DEBIT, CIELO_UKNOWN_ERROR_MSG,
+    CieloAuthorizationCode, CieloProduct
 )
 from shuup_cielo.forms import CieloPaymentForm
+from shuup_cielo.installments import get_installments_matrix
 from shuup_cielo.models import CieloPaymentProcessor
 from shuup_cielo.objects import CIELO_ORDER_TRANSACTION_ID_KEY, CIELO_TRANSACTION_ID_KEY
+from shuup_cielo.status import refresh_transaction
+from shuup_cielo.utils import decimal_to_int_cents, get_basket_total
 
 logger = logging.getLogger(__name__)
 
@@ -51,13 +56,33 @@ class CieloCheckoutPhase(CheckoutPhaseViewMixin, TemplateView):
         context['has_valid_transaction'] = self._has_valid_transaction()
         context['next_phase'] = self.next_phase
         context['form'] = CieloPaymentForm(**form_kwargs)
+        context['installments_matrix'] = self._get_installments_matrix_json()
         return context
 
+    def _get_installments_matrix_json(self):
+        """
+        The installments of every brand, rendered in the page so that
+        changing the brand needs no request
+        """
+        cielo_config = get_cielo_config(self.request.shop)
+
+        if not cielo_config:
+            return None
+
+        try:
+            basket_total = get_basket_total(self.request.basket)
+            matrix = get_installments_matrix(self.request.basket, basket_total, cielo_config)
+        except Exception:
+            logger.exception("Failed to calculate the installments matrix")
+            return None
+
+        return mark_safe(json.dumps(matrix).replace("</", "<\\/"))
+
     def is_valid(self):
         if self._has_valid_transaction():
             cielo_transaction = self.request.cielo.transaction
 
-            if cielo_transaction.refresh() and \
+            if refresh_transaction(cielo_transaction) and \
                     cielo_transaction.authorization_lr in CIELO_AUTHORIZED_STATUSES:
                 return True
 
@@ -76,23 +101,39 @@ class CieloCheckoutPhase(CheckoutPhaseViewMixin, TemplateView):
     def _has_valid_transaction(self):
         """
         This must return True if a valid transaction is in the user session
+
+        The result is kept in the request while the transaction,
+        the payment service and the basket total stay the same.
         """
         cielo_order = self.request.cielo.order_transaction
         cielo_transaction = self.request.cielo.transaction
 
-        # the instances should be valid
-        if cielo_order and cielo_transaction:
-            service = self.request.basket.payment_method.choice_identifier
-            is_credit = (cielo_transaction.cc_product in (CieloProduct.Credit, CieloProduct.InstallmentCredit))
-            is_debit = (cielo_transaction.cc_product == CieloProduct.Debit)
+        if not (cielo_order and cielo_transaction):
+            return False
+
+        state = (cielo_order.pk, cielo_transaction.pk, cielo_transaction.total_cents,
+                 self.request.basket.payment_method_id, get_basket_total(self.request.basket))
+        memo = getattr(self.request, "_cielo_valid_transaction_memo", None)
+
+        if memo and memo[0] == state:
+            return memo[1]
 
-            # the service must match the cc product
-            if (service == CIELO_SERVICE_CREDIT and is_credit) or (service == CIELO_SERVICE_DEBIT and is_debit):
-                order_total = self.request.basket.taxful_total_price.value
+        is_valid = self._check_transaction(cielo_transaction)
+        self.request._cielo_valid_transaction_memo = (state, is_valid)
+        return is_valid
 
-                # All clear: valor da transação igual ao total do carrinho!
-                if abs((cielo_transaction.total_value - order_total).quantize(CIELO_DECIMAL_PRECISION)) <= Decimal(0):
-                    return True
+    def _check_transaction(self, cielo_transaction):
+        service = self.request.basket.payment_method.choice_identifier
+        is_credit = (cielo_transaction.cc_product in (CieloProduct.Credit, CieloProduct.InstallmentCredit))
+        is_debit = (cielo_transaction.cc_product == CieloProduct.Debit)
+
+        # the service must match the cc product
+        if (service == CIELO_SERVICE_CREDIT and is_credit) or (service == CIELO_SERVICE_DEBIT and is_debit):
+            order_total = get_basket_total(self.request.basket)
+
+            # All clear: valor da transação igual ao total do carrinho!
+            if cielo_transaction.total_cents == decimal_to_int_cents(order_total):
+                return True
 
         return False
 
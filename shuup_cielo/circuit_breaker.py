@@ -0,0 +1,201 @@
+# -*- coding: utf-8 -*-
+# This file is part of Shuup Cielo.
+#
+# Copyright (c) 2016, Rockho Team. All rights reserved.
+# Author: Christian Hess
+#
+# This source code is licensed under the AGPLv3 license found in the
+# LICENSE file in the root directory of this source tree.
+from __future__ import unicode_literals
+
+import time
+from xml.parsers.expat import ExpatError
+
+from django.conf import settings
+from django.core.cache import cache
+import requests
+
+from cielo_webservice.exceptions import CieloRequestError
+from shuup_cielo.constants import CIELO_UNAVAILABLE_ERROR_CODES, CircuitBreakerState
+from shuup_cielo.exceptions import (
+    CieloCircuitOpenError, CieloConnectionError, CieloDeadlineExceeded, CieloTimeoutError
+)
+from shuup_cielo.utils import safe_int
+
+# valores padrão, podem ser alterados nas configurações do Django
+CIELO_DEFAULT_BREAKER_ERROR_RATE = 0.5
+CIELO_DEFAULT_BREAKER_MIN_CALLS = 10
+CIELO_DEFAULT_BREAKER_WINDOW = 60
+CIELO_DEFAULT_BREAKER_RESET_TIMEOUT = 30
+
+
+def is_gateway_failure(exc):
+    """
+    Returns whether the exception means that Cielo itself is failing
+
+    Business errors (invalid card, invalid status, ...) do not count.
+    """
+    if isinstance(exc, CieloDeadlineExceeded):
+        # o prazo da requisição local acabou, não é culpa da Cielo
+        return False
+
+    if isinstance(exc, (CieloTimeoutError, CieloConnectionError, requests.RequestException, ExpatError)):
+        return True
+
+    if isinstance(exc, CieloRequestError):
+        # mensagem no formato "<codigo> - <mensagem>"
+        return safe_int("{0}".format(exc).split(" - ")[0]) in CIELO_UNAVAILABLE_ERROR_CODES
+
+    return False
+
+
+class CircuitBreaker(object):
+    """
+    Circuit breaker whose state is kept in the Django cache,
+    so it is shared by all the workers and nodes
+
+    * closed: calls go through and errors are counted in a time window
+    * open: the error rate was reached, calls fail immediately
+    * half-open: the reset timeout has passed, a single probe call is allowed;
+      it closes the circuit if it succeeds or opens it again if it fails
+    """
+
+    def __init__(self, name, error_rate=None, min_calls=None, window=None, reset_timeout=None):
+        self.name = name
+        self.error_rate = float(error_rate if error_rate is not None else getattr(
+            settings, "CIELO_BREAKER_ERROR_RATE", CIELO_DEFAULT_BREAKER_ERROR_RATE))
+        self.min_calls = int(min_calls if min_calls is not None else getattr(
+            settings, "CIELO_BREAKER_MIN_CALLS", CIELO_DEFAULT_BREAKER_MIN_CALLS))
+        self.window = int(window if window is not None else getattr(
+            settings, "CIELO_BREAKER_WINDOW", CIELO_DEFAULT_BREAKER_WINDOW))
+        self.reset_timeout = int(reset_timeout if reset_timeout is not None else getattr(
+            settings, "CIELO_BREAKER_RESET_TIMEOUT", CIELO_DEFAULT_BREAKER_RESET_TIMEOUT))
+
+    def _key(self, suffix):
+        return "cielo_breaker:{0}:{1}".format(self.name, suffix)
+
+    def _window_keys(self):
+        bucket = int(time.time() // self.window)
+        return (self._key("calls:{0}".format(bucket)), self._key("failures:{0}".format(bucket)))
+
+    def _incr(self, key):
+        cache.add(key, 0, timeout=self.window * 2)
+        try:
+            return cache.incr(key)
+        except ValueError:
+            # a chave expirou entre o add e o incr
+            cache.set(key, 1, timeout=self.window * 2)
+            return 1
+
+    def get_opened_at(self):
+        return cache.get(self._key("opened_at"))
+
+    def get_state(self):
+        opened_at = self.get_opened_at()
+
+        if opened_at is None:
+            return CircuitBreakerState.Closed
+
+        if time.time() - opened_at >= self.reset_timeout:
+            return CircuitBreakerState.HalfOpen
+
+        return CircuitBreakerState.Open
+
+    def get_info(self):
+        calls_key, failures_key = self._window_keys()
+        counters = cache.get_many([calls_key, failures_key])
+
+        return {
+            "name": self.name,
+            "state": self.get_state(),
+            "opened_at": self.get_opened_at(),
+            "calls": counters.get(calls_key, 0),
+            "failures": counters.get(failures_key, 0),
+        }
+
+    def open(self):
+        cache.set(self._key("opened_at"), time.time(), timeout=None)
+        cache.delete(self._key("probe"))
+
+    def close(self):
+        cache.delete_many([self._key("opened_at"), self._key("probe")] + list(self._window_keys()))
+
+    def before_call(self):
+        """
+        Checks whether a call may be made
+
+        :return: whether this call is the half-open probe
+        :rtype: bool
+        """
+        state = self.get_state()
+
+        if state == CircuitBreakerState.Closed:
+            return False
+
+        # apenas uma chamada de teste por vez, as outras falham
+        if state == CircuitBreakerState.HalfOpen and cache.add(self._key("probe"), 1, timeout=self.reset_timeout):
+            return True
+
+        raise CieloCircuitOpenError("Cielo is unavailable, calls are suspended for a while.")
+
+    def record_success(self, probe=False):
+        if probe:
+            self.close()
+            return
+
+        self._incr(self._window_keys()[0])
+
+    def record_failure(self, probe=False):
+        if probe:
+            self.open()
+            return
+
+        calls_key, failures_key = self._window_keys()
+        calls = self._incr(calls_key)
+        failures = self._incr(failures_key)
+
+        if calls >= self.min_calls and (float(failures) / calls) >= self.error_rate:
+            self.open()
+
+    def release_probe(self):
+        """
+        Allows another half-open probe without changing the state
+        """
+        cache.delete(self._key("probe"))
+
+    def record_exception(self, exc, probe=False):
+        if is_gateway_failure(exc):
+            self.record_failure(probe)
+        elif probe and isinstance(exc, CieloDeadlineExceeded):
+            # a Cielo não chegou a ser chamada
+            self.release_probe()
+        elif probe:
+            # respondeu, mesmo que com erro de negócio
+            self.close()
+
+    def call(self, func, *args, **kwargs):
+        probe = self.before_call()
+
+        try:
+            result = func(*args, **kwargs)
+        except Exception as exc:
+            self.record_exception(exc, probe)
+            raise
+
+        self.record_success(probe)
+        return result
+
+
+def get_circuit_breaker(sandbox=False, affiliation=None):
+    """
+    :rtype: CircuitBreaker
+    """
+    return CircuitBreaker("{0}:{1}".format("sandbox" if sandbox else "production", affiliation))
+
+
+def get_circuit_breaker_for_config(cielo_config):
+    """
+    :type cielo_config: shuup_cielo.models.CieloConfig
+    :rtype: CircuitBreaker
+    """
+    return get_circuit_breaker(sandbox=cielo_config.sandbox, affiliation=cielo_config.ec_num)
@@ -0,0 +1,207 @@
+# -*- coding: utf-8 -*-
+# This file is part of Shuup Cielo.
+#
+# Copyright (c) 2016, Rockho Team. All rights reserved.
+# Author: Christian Hess
+#
+# This source code is licensed under the AGPLv3 license found in the
+# LICENSE file in the root directory of this source tree.
+from __future__ import unicode_literals
+
+import threading
+import time
+
+from django.conf import settings
+import requests
+
+from cielo_webservice.adapter import TLSv1HttpAdapter
+from cielo_webservice.request import CieloRequest
+from shuup_cielo.circuit_breaker import get_circuit_breaker
+from shuup_cielo.exceptions import CieloDeadlineExceeded, CieloTimeoutError
+
+# quantidade padrão de conexões persistentes mantidas por cliente
+CIELO_DEFAULT_POOL_SIZE = 10
+
+_clients = {}
+_clients_lock = threading.Lock()
+
+# estado da thread atual: prazo da requisição HTTP e timeout da chamada em andamento
+_local = threading.local()
+
+
+class TimeoutHTTPAdapter(TLSv1HttpAdapter):
+    """
+    TLSv1 adapter that applies the timeout of the current gateway call
+
+    `CieloRequest` does not accept a timeout, so the value
+    is passed through the current thread state.
+    """
+
+    def send(self, request, **kwargs):
+        if kwargs.get("timeout") is None:
+            kwargs["timeout"] = getattr(_local, "timeout", None)
+        return super(TimeoutHTTPAdapter, self).send(request, **kwargs)
+
+
+def start_request_deadline():
+    """
+    Marks the beginning of an HTTP request
+
+    Every gateway call made by this thread from now on
+    draws from the same `CieloConfig.request_timeout` budget.
+    """
+    _local.request_start = time.time()
+
+
+def clear_request_deadline():
+    _local.request_start = None
+
+
+def get_remaining_time(budget):
+    """
+    Returns how many seconds are left from `budget` in the current HTTP request
+    or None if there is no request being tracked
+
+    :type budget: float
+    :rtype: float|None
+    """
+    request_start = getattr(_local, "request_start", None)
+
+    if request_start is None:
+        return None
+
+    return budget - (time.time() - request_start)
+
+
+class CieloClient(object):
+    """
+    Makes the gateway calls of a `CieloConfig` through the pooled `CieloRequest`
+    enforcing the connect/read timeouts and the request deadline
+    """
+
+    def __init__(self, cielo_request, connect_timeout, read_timeout, request_timeout, circuit_breaker=None):
+        self.cielo_request = cielo_request
+        self.circuit_breaker = circuit_breaker
+        self.connect_timeout = float(connect_timeout)
+        self.read_timeout = float(read_timeout)
+        self.request_timeout = float(request_timeout)
+
+    def _get_timeout(self):
+        remaining = get_remaining_time(self.request_timeout)
+
+        if remaining is None:
+            return (self.connect_timeout, self.read_timeout)
+
+        if remaining <= 0:
+            raise CieloDeadlineExceeded("The time budget for the payment gateway has run out.")
+
+        return (min(self.connect_timeout, remaining), min(self.read_timeout, remaining))
+
+    def _request(self, operation, timeout, **kwargs):
+        _local.timeout = timeout
+
+        try:
+            return getattr(self.cielo_request, operation)(**kwargs)
+        except requests.Timeout as exc:
+            raise CieloTimeoutError("Cielo did not answer in time: {0}".format(exc))
+        finally:
+            _local.timeout = None
+
+    def _call(self, operation, **kwargs):
+        # o prazo é verificado antes do circuit breaker: sem chamada à Cielo,
+        # não há resultado para registrar nem teste de meia-abertura para gastar
+        timeout = self._get_timeout()
+
+        if self.circuit_breaker:
+            return self.circuit_breaker.call(self._request, operation, timeout, **kwargs)
+        return self._request(operation, timeout, **kwargs)
+
+    def autorizar(self, **kwargs):
+        return self._call("autorizar", **kwargs)
+
+    def consultar(self, **kwargs):
+        return self._call("consultar", **kwargs)
+
+    def capturar(self, **kwargs):
+        return self._call("capturar", **kwargs)
+
+    def cancelar(self, **kwargs):
+        return self._call("cancelar", **kwargs)
+
+
+def _create_cielo_request(sandbox):
+    cielo_request = CieloRequest(sandbox=sandbox)
+    pool_size = getattr(settings, "CIELO_CONNECTION_POOL_SIZE", CIELO_DEFAULT_POOL_SIZE)
+
+    # permite apontar para outro servidor, como o simulador local da Cielo
+    base_url = getattr(settings, "CIELO_BASE_URL", None)
+    if base_url:
+        cielo_request.base_url = base_url
+
+    # substitui o adaptador padrão por um com um pool maior de conexões
+    # persistentes (keep-alive), já que a mesma sessão será compartilhada
+    # por todas as threads do processo
+    for prefix in ('https://', 'http://'):
+        cielo_request.session.mount(prefix, TimeoutHTTPAdapter(pool_connections=1, pool_maxsize=pool_size))
+
+    return cielo_request
+
+
+def get_cielo_request(sandbox=False, affiliation=None):
+    """
+    Returns the process-wide `CieloRequest` for the given environment and affiliation
+
+    Every client keeps its own pool of persistent HTTPS connections,
+    so the TCP+TLS handshake is paid only once per connection instead
+    of once per gateway call.
+
+    :type sandbox: bool
+    :type affiliation: str|None
+    :rtype: cielo_webservice.request.CieloRequest
+    """
+    key = (bool(sandbox), affiliation)
+    cielo_request = _clients.get(key)
+
+    if cielo_request is None:
+        with _clients_lock:
+            cielo_request = _clients.get(key)
+
+            if cielo_request is None:
+                cielo_request = _create_cielo_request(bool(sandbox))
+                _clients[key] = cielo_request
+
+    return cielo_request
+
+
+def get_cielo_request_for_config(cielo_config):
+    """
+    Returns the process-wide `CieloRequest` for a `CieloConfig`
+
+    :type cielo_config: shuup_cielo.models.CieloConfig
+    :rtype: cielo_webservice.request.CieloRequest
+    """
+    return get_cielo_request(sandbox=cielo_config.sandbox, affiliation=cielo_config.ec_num)
+
+
+def get_cielo_client(cielo_config):
+    """
+    Returns a `CieloClient` for a `CieloConfig`
+
+    :type cielo_config: shuup_cielo.models.CieloConfig
+    :rtype: CieloClient
+    """
+    return CieloClient(get_cielo_request_for_config(cielo_config),
+                       connect_timeout=cielo_config.connect_timeout,
+                       read_timeout=cielo_config.read_timeout,
+                       request_timeout=cielo_config.request_timeout,
+                       circuit_breaker=get_circuit_breaker(cielo_config.sandbox, cielo_config.ec_num))
+
+
+def clear_cielo_requests():
+    """
+    Closes and discards all the pooled clients
+    """
+    with _clients_lock:
+        for cielo_request in _clients.values():
+            cielo_request.session.close()
+        _clients.clear()
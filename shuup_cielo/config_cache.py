@@ -0,0 +1,133 @@
+# -*- coding: utf-8 -*-
+# This file is part of Shuup Cielo.
+#
+# Copyright (c) 2016, Rockho Team. All rights reserved.
+# Author: Christian Hess
+#
+# This source code is licensed under the AGPLv3 license found in the
+# LICENSE file in the root directory of this source tree.
+"""
+Per-shop `CieloConfig` cache
+
+The configs are kept in the Django cache under a per-shop version token,
+so every worker and node sees a change as soon as the version changes,
+and in a local in-process layer that is trusted for a few seconds
+(`CIELO_CONFIG_LOCAL_TTL`) before the version is checked again.
+
+The version is replaced when a `CieloConfig` is saved or deleted.
+"""
+from __future__ import unicode_literals
+
+import time
+import uuid
+
+from django.apps import apps
+from django.conf import settings
+from django.core.cache import cache
+from django.db import transaction as db_transaction
+
+CIELO_DEFAULT_CONFIG_LOCAL_TTL = 5
+CIELO_DEFAULT_CONFIG_CACHE_TIMEOUT = 3600
+
+# guardado no cache quando a loja não possui configuração
+_NO_CONFIG = 0
+
+_local_configs = {}
+
+
+def _get_version_key(shop_id):
+    return "cielo_config_version:{0}".format(shop_id)
+
+
+def _get_config_key(shop_id, version):
+    return "cielo_config:{0}:{1}".format(shop_id, version)
+
+
+def _get_version(shop_id):
+    version_key = _get_version_key(shop_id)
+    version = cache.get(version_key)
+
+    if version is None:
+        cache.add(version_key, uuid.uuid4().hex, timeout=None)
+        version = cache.get(version_key)
+
+    return version
+
+
+def _get_cielo_config(shop_id):
+    """
+    :return: the config and the version it was loaded for
+    :rtype: tuple[shuup_cielo.models.CieloConfig|None, str]
+    """
+    local_config = _local_configs.get(shop_id)
+    current_time = time.time()
+    local_ttl = getattr(settings, "CIELO_CONFIG_LOCAL_TTL", CIELO_DEFAULT_CONFIG_LOCAL_TTL)
+
+    if local_config and current_time - local_config[2] < local_ttl:
+        return (local_config[1], local_config[0])
+
+    version = _get_version(shop_id)
+
+    if local_config and local_config[0] == version:
+        _local_configs[shop_id] = (version, local_config[1], current_time)
+        return (local_config[1], version)
+
+    config_key = _get_config_key(shop_id, version)
+    cielo_config = cache.get(config_key)
+
+    if cielo_config is None:
+        cielo_config = apps.get_model("shuup_cielo", "CieloConfig").objects.filter(shop_id=shop_id).first()
+        cache.set(config_key, cielo_config or _NO_CONFIG,
+                  timeout=getattr(settings, "CIELO_CONFIG_CACHE_TIMEOUT", CIELO_DEFAULT_CONFIG_CACHE_TIMEOUT))
+
+    cielo_config = cielo_config or None
+    _local_configs[shop_id] = (version, cielo_config, current_time)
+    return (cielo_config, version)
+
+
+def get_cielo_config(shop):
+    """
+    Returns the Cielo config of the shop, or None when it is not configured
+
+    The returned object is shared, it must not be changed.
+
+    :type shop: shuup.core.models.Shop|int
+    :rtype: shuup_cielo.models.CieloConfig|None
+    """
+    return _get_cielo_config(getattr(shop, "pk", shop))[0]
+
+
+def get_cielo_config_version(shop):
+    """
+    Returns the token that changes every time the shop config changes
+
+    :type shop: shuup.core.models.Shop|int
+    :rtype: str
+    """
+    # a versão vem da mesma leitura, outra thread pode invalidar a camada local no meio
+    return _get_cielo_config(getattr(shop, "pk", shop))[1]
+
+
+def invalidate_cielo_config(shop_id):
+    """
+    Makes every worker load the config of the shop again
+    """
+    cache.set(_get_version_key(shop_id), uuid.uuid4().hex, timeout=None)
+    _local_configs.pop(shop_id, None)
+
+
+def clear_cielo_config_cache():
+    """
+    Drops the local layer of this process
+    """
+    _local_configs.clear()
+
+
+def handle_cielo_config_change(sender, instance, **kwargs):
+    shop_id = instance.shop_id
+    invalidate_cielo_config(shop_id)
+
+    # outro worker pode ter guardado a configuração antiga antes do commit
+    on_commit = getattr(db_transaction, "on_commit", None)
+    if on_commit:  # Django >= 1.9
+        on_commit(lambda: invalidate_cielo_config(shop_id))
@@ -59,6 +59,15 @@ class CieloCardBrand(object):
     Unknown = 'unknown'
 
 
+class CircuitBreakerState(object):
+    '''
+    Estado do circuit breaker das chamadas à Cielo
+    '''
+    Closed = 'closed'
+    Open = 'open'
+    HalfOpen = 'half-open'
+
+
 class CieloTransactionStatus(Enum):
     NotCreated = -1
     Created = 0
@@ -86,6 +95,41 @@ class CieloTransactionStatus(Enum):
         Cancelling = _('Cancelling')
 
 
+class CieloOperationType(Enum):
+    Capture = 1
+    Cancel = 2
+
+    class Labels:
+        Capture = _('Capture')
+        Cancel = _('Cancel')
+
+
+class CieloOperationStatus(Enum):
+    Pending = 0
+    Done = 1
+    Failed = 2
+
+    class Labels:
+        Pending = _('Pending')
+        Done = _('Done')
+        Failed = _('Failed')
+
+
+class CieloSyncSource(Enum):
+    Query = 1
+    Authorization = 2
+    Capture = 3
+    Cancel = 4
+    Notification = 5
+
+    class Labels:
+        Query = _('Query')
+        Authorization = _('Authorization')
+        Capture = _('Capture')
+        Cancel = _('Cancel')
+        Notification = _('Notification')
+
+
 CieloErrorMap = {
     1: _('Mensagem inválida'),
     2: _('Credenciais inválidas'),
@@ -212,11 +256,32 @@ CieloAuthorizationCode = {
 }
 
 
+# códigos de erro que indicam indisponibilidade da Cielo
+CIELO_UNAVAILABLE_ERROR_CODES = (97, 98)
+
+
 CIELO_UKNOWN_ERROR_MSG = _('Unknown error')
 
 
 CIELO_AUTHORIZED_STATUSES = ("00", "000", "11")
 
+# ordem em que os estados acontecem: uma resposta antiga da Cielo
+# não pode levar a transação de volta a um estado anterior
+CIELO_TRANSACTION_STATUS_RANK = {
+    CieloTransactionStatus.NotCreated: 0,
+    CieloTransactionStatus.Created: 0,
+    CieloTransactionStatus.InProgress: 1,
+    CieloTransactionStatus.Authenticating: 2,
+    CieloTransactionStatus.Authenticated: 3,
+    CieloTransactionStatus.NotAuthenticated: 3,
+    CieloTransactionStatus.Authorized: 4,
+    CieloTransactionStatus.NotAuthorized: 4,
+    # a consulta volta a mostrar o estado da Cielo se o cancelamento falhar
+    CieloTransactionStatus.Cancelling: 4,
+    CieloTransactionStatus.Captured: 5,
+    CieloTransactionStatus.Cancelled: 6,
+}
+
 
 class CieloAuthorizationType(object):
     OnlyAuthenticate = 0
@@ -317,3 +382,10 @@ CIELO_AUTHORIZATION_TYPE_CHOICES = (
     (CieloAuthorizationType.Direct, _('Direct, do not authenticate')),
     (CieloAuthorizationType.Recurrent, _('Recurrent')),
 )
+
+
+CIRCUIT_BREAKER_STATE_CHOICES = (
+    (CircuitBreakerState.Closed, _('Closed')),
+    (CircuitBreakerState.Open, _('Open')),
+    (CircuitBreakerState.HalfOpen, _('Half-open')),
+)
@@ -0,0 +1,41 @@
+# -*- coding: utf-8 -*-
+# This file is part of Shuup Cielo.
+#
+# Copyright (c) 2016, Rockho Team. All rights reserved.
+# Author: Christian Hess
+#
+# This source code is licensed under the AGPLv3 license found in the
+# LICENSE file in the root directory of this source tree.
+from __future__ import unicode_literals
+
+from cielo_webservice.exceptions import CieloRequestError
+
+
+class CieloConnectionError(CieloRequestError):
+    """
+    It was not possible to talk to the gateway
+    """
+
+
+class CieloTimeoutError(CieloRequestError):
+    """
+    The gateway did not answer within the configured timeouts
+    """
+
+
+class CieloDeadlineExceeded(CieloTimeoutError):
+    """
+    The time budget of the current HTTP request is over
+    """
+
+
+class CieloCircuitOpenError(CieloRequestError):
+    """
+    Cielo is considered unavailable and the call was not made
+    """
+
+
+class CieloTransactionNotSettled(Exception):
+    """
+    Cielo has not authorized nor refused the transaction yet
+    """
@@ -0,0 +1,144 @@
+# -*- coding: utf-8 -*-
+# This file is part of Shuup Cielo.
+#
+# Copyright (c) 2016, Rockho Team. All rights reserved.
+# Author: Christian Hess
+#
+# This source code is licensed under the AGPLv3 license found in the
+# LICENSE file in the root directory of this source tree.
+"""
+Installment options offered in the checkout
+"""
+from __future__ import unicode_literals
+
+from decimal import Decimal
+import hashlib
+import logging
+
+from django.core.cache import cache
+from django.utils.encoding import force_bytes
+from django.utils.formats import localize
+from django.utils.translation import get_language
+
+from shuup.utils.i18n import format_money
+from shuup_cielo.config_cache import get_cielo_config_version
+from shuup_cielo.constants import (
+    CIELO_CREDITCARD_BRAND_CHOICES, CIELO_DEBITCARD_BRAND_CHOICES, CIELO_SERVICE_DEBIT,
+    CieloProduct, CieloProductMatrix, INSTALLMENT_CHOICE_WITH_INTEREST_STRING,
+    INSTALLMENT_CHOICE_WITHOUT_INTEREST_STRING
+)
+from shuup_cielo.models import InstallmentContext
+
+logger = logging.getLogger(__name__)
+
+# grupos de bandeiras com as mesmas opções
+INSTALLMENTS_GROUP = "installments"
+SINGLE_PAYMENT_GROUP = "single"
+
+CIELO_DEFAULT_INSTALLMENTS_MATRIX_TIMEOUT = 60 * 30
+
+
+def get_basket_service(basket):
+    if basket.payment_method_id:
+        return basket.payment_method.choice_identifier
+
+
+def get_installments_state(basket, basket_total, cielo_config, *extra):
+    """
+    Returns a digest of everything the installment options depend on
+
+    :rtype: str
+    """
+    return hashlib.sha1(force_bytes(":".join("{0}".format(part) for part in (
+        basket_total, basket.currency, get_cielo_config_version(cielo_config.shop_id), get_language()
+    ) + extra))).hexdigest()
+
+
+def get_installment_options(basket, basket_total, cielo_config, allow_installments=True):
+    """
+    Returns the installment options for the basket total
+
+    :param allow_installments: whether the card brand accepts installments
+    :rtype: list[dict]
+    """
+    installments = []
+
+    if allow_installments:
+        try:
+            context = InstallmentContext(basket_total, cielo_config)
+            interest_rate = cielo_config.interest_rate
+
+            for choice in context.get_intallments_choices():
+
+                # if installment has interest
+                if choice[3] > 0:
+                    name = INSTALLMENT_CHOICE_WITH_INTEREST_STRING.format(
+                        choice[0],
+                        format_money(basket.create_price(choice[1])),
+                        format_money(basket.create_price(choice[2])),
+                        localize(interest_rate)
+                    )
+                else:
+                    name = INSTALLMENT_CHOICE_WITHOUT_INTEREST_STRING.format(
+                        choice[0],
+                        format_money(basket.create_price(choice[1])),
+                        format_money(basket.create_price(choice[2]))
+                    )
+
+                installments.append({"number": choice[0], "name": name})
+
+        except Exception:
+            logger.exception("Failed to calculate installments for basket {0}".format(basket))
+
+    if len(installments) == 0:
+        installments.append({
+            "number": 1,
+            "name": INSTALLMENT_CHOICE_WITHOUT_INTEREST_STRING.format(
+                1,
+                format_money(basket.create_price(basket_total)),
+                format_money(basket.create_price(basket_total)),
+                localize(Decimal())
+            )
+        })
+
+    return installments
+
+
+def get_installments_matrix(basket, basket_total, cielo_config):
+    """
+    Returns the installment options of every brand accepted by the basket payment service
+
+    Brands with the same capability share the same options, so each group
+    is calculated once. The matrix is cached for each basket state.
+
+    :rtype: dict
+    :return: {"brands": {brand: group}, "options": {group: options}}
+    """
+    service = get_basket_service(basket)
+    cache_key = "cielo_installments_matrix:{0}".format(
+        get_installments_state(basket, basket_total, cielo_config, service)
+    )
+    matrix = cache.get(cache_key)
+
+    if matrix is not None:
+        return matrix
+
+    if service == CIELO_SERVICE_DEBIT:
+        brands = dict((brand, SINGLE_PAYMENT_GROUP) for brand, label in CIELO_DEBITCARD_BRAND_CHOICES)
+    else:
+        brands = dict(
+            (brand, INSTALLMENTS_GROUP
+             if CieloProductMatrix.get(brand, {}).get(CieloProduct.InstallmentCredit) else SINGLE_PAYMENT_GROUP)
+            for brand, label in CIELO_CREDITCARD_BRAND_CHOICES
+        )
+
+    matrix = {
+        "brands": brands,
+        "options": dict(
+            (group, get_installment_options(basket, basket_total, cielo_config,
+                                            allow_installments=(group == INSTALLMENTS_GROUP)))
+            for group in set(brands.values())
+        )
+    }
+    cache.set(cache_key, matrix, timeout=CIELO_DEFAULT_INSTALLMENTS_MATRIX_TIMEOUT)
+    return matrix
@@ -0,0 +1,46 @@
+# -*- coding: utf-8 -*-
+# This file is part of Shuup Cielo.
+#
+# Copyright (c) 2016, Rockho Team. All rights reserved.
+# Author: Christian Hess
+#
+# This source code is licensed under the AGPLv3 license found in the
+# LICENSE file in the root directory of this source tree.
+from __future__ import unicode_literals
+
+import time
+
+from django.core.management.base import BaseCommand, CommandError
+
+from shuup_cielo.exceptions import CieloCircuitOpenError
+from shuup_cielo.outbox import process_outbox
+
+
+class Command(BaseCommand):
+    help = "Sends the scheduled Cielo captures and cancellations"
+
+    def add_arguments(self, parser):
+        parser.add_argument("--limit", type=int, default=None,
+                            help="Maximum operations processed per run")
+        parser.add_argument("--loop", action="store_true", default=False,
+                            help="Keep running, checking the outbox every --interval seconds")
+        parser.add_argument("--interval", type=float, default=10,
+                            help="Seconds between the outbox checks with --loop (default: %(default)s)")
+
+    def handle(self, *args, **options):
+        while True:
+            try:
+                result = process_outbox(limit=options["limit"])
+            except CieloCircuitOpenError:
+                if not options["loop"]:
+                    raise CommandError("Cielo is unavailable, the pending operations will be sent on the next run.")
+                self.stderr.write("Cielo is unavailable, waiting.")
+            else:
+                if result.processed or not options["loop"]:
+                    self.stdout.write("{0} operations processed: {1} done, {2} to retry, {3} failed".format(
+                        result.processed, result.done, result.retried, result.failed))
+
+            if not options["loop"]:
+                break
+
+            time.sleep(options["interval"])
@@ -0,0 +1,105 @@
+# -*- coding: utf-8 -*-
+# This file is part of Shuup Cielo.
+#
+# Copyright (c) 2016, Rockho Team. All rights reserved.
+# Author: Christian Hess
+#
+# This source code is licensed under the AGPLv3 license found in the
+# LICENSE file in the root directory of this source tree.
+from __future__ import unicode_literals
+
+import io
+import os
+
+from django.core.management.base import BaseCommand, CommandError
+
+from shuup_cielo.constants import CieloTransactionStatus
+from shuup_cielo.exceptions import CieloCircuitOpenError
+from shuup_cielo.sync import (
+    CIELO_DEFAULT_SYNC_BATCH_SIZE, CIELO_DEFAULT_SYNC_WORKERS, CIELO_SYNC_DEFAULT_STATUSES,
+    get_transactions_to_sync, parse_age, sync_transactions
+)
+
+
+def _parse_status(value):
+    try:
+        return CieloTransactionStatus(int(value))
+    except ValueError:
+        pass
+
+    try:
+        return CieloTransactionStatus[value]
+    except KeyError:
+        raise CommandError("Invalid transaction status: {0}".format(value))
+
+
+class Command(BaseCommand):
+    help = "Synchronizes the Cielo transactions status and amounts with Cielo"
+
+    def add_arguments(self, parser):
+        parser.add_argument("--status", action="append", dest="statuses", default=None,
+                            help="Transaction status name or code, may be repeated "
+                                 "(default: the statuses that may still change)")
+        parser.add_argument("--min-age", default="30m",
+                            help="Skip transactions newer than this, e.g. 30m, 12h, 7d (default: 30m)")
+        parser.add_argument("--max-age", default=None,
+                            help="Skip transactions older than this, e.g. 90d")
+        parser.add_argument("--shop", type=int, default=None, help="Shop ID")
+        parser.add_argument("--workers", type=int, default=CIELO_DEFAULT_SYNC_WORKERS,
+                            help="Simultaneous calls to Cielo (default: %(default)s)")
+        parser.add_argument("--batch-size", type=int, default=CIELO_DEFAULT_SYNC_BATCH_SIZE,
+                            help="Transactions saved per database write (default: %(default)s)")
+        parser.add_argument("--start-after", type=int, default=None,
+                            help="Only transactions with a greater ID")
+        parser.add_argument("--checkpoint", default=None,
+                            help="File that keeps the last synchronized ID, to resume interrupted runs")
+
+    def handle(self, *args, **options):
+        if options["workers"] < 1 or options["batch_size"] < 1:
+            raise CommandError("--workers and --batch-size must be positive.")
+
+        statuses = CIELO_SYNC_DEFAULT_STATUSES
+        if options["statuses"]:
+            statuses = [_parse_status(status) for status in options["statuses"]]
+
+        start_after = options["start_after"]
+        checkpoint = options["checkpoint"]
+
+        if start_after is None and checkpoint and os.path.exists(checkpoint):
+            with io.open(checkpoint) as checkpoint_file:
+                start_after = int(checkpoint_file.read().strip() or 0) or None
+            self.stdout.write("Resuming after transaction ID {0}".format(start_after))
+
+        queryset = get_transactions_to_sync(
+            statuses=statuses,
+            min_age=parse_age(options["min_age"]) if options["min_age"] else None,
+            max_age=parse_age(options["max_age"]) if options["max_age"] else None,
+            shop=options["shop"],
+            start_after=start_after
+        )
+        total = queryset.count()
+        self.stdout.write("{0} transactions to synchronize".format(total))
+
+        def on_batch(result):
+            if checkpoint:
+                with io.open(checkpoint, "w") as checkpoint_file:
+                    checkpoint_file.write("{0}".format(result.last_pk))
+
+            self.stdout.write("{0}/{1} processed, {2} updated, {3} failed ({4:.1f}/s)".format(
+                result.processed, total, result.updated, result.failed, result.throughput))
+
+        try:
+            result = sync_transactions(queryset,
+                                       workers=options["workers"],
+                                       batch_size=options["batch_size"],
+                                       on_batch=on_batch)
+        except CieloCircuitOpenError:
+            raise CommandError("Cielo is unavailable, synchronization interrupted. "
+                               "Run again with the same --checkpoint to resume.")
+
+        if checkpoint and os.path.exists(checkpoint):
+            os.remove(checkpoint)
+
+        self.stdout.write(
+            "Done: {0} processed, {1} updated, {2} failed in {3:.1f}s ({4:.1f} transactions/s)".format(
+                result.processed, result.updated, result.failed, result.elapsed, result.throughput))
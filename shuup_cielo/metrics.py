@@ -0,0 +1,46 @@
+# -*- coding: utf-8 -*-
+# This file is part of Shuup Cielo.
+#
+# Copyright (c) 2016, Rockho Team. All rights reserved.
+# Author: Christian Hess
+#
+# This source code is licensed under the AGPLv3 license found in the
+# LICENSE file in the root directory of this source tree.
+"""
+Process-wide counters
+"""
+from __future__ import unicode_literals
+
+from collections import Counter
+import threading
+
+# escritas de sessão evitadas porque o contexto Cielo não mudou
+SESSION_WRITES_SKIPPED = "session_writes_skipped"
+
+# consultas à Cielo evitadas porque a transação estava atualizada ou final
+REFRESHES_SKIPPED = "refreshes_skipped"
+
+_counters = Counter()
+_lock = threading.Lock()
+
+
+def increment(name, amount=1):
+    with _lock:
+        _counters[name] += amount
+
+
+def get_counter(name):
+    return _counters[name]
+
+
+def get_counters():
+    """
+    :rtype: dict
+    """
+    with _lock:
+        return dict(_counters)
+
+
+def reset_counters():
+    with _lock:
+        _counters.clear()
@@ -8,7 +8,7 @@
 # LICENSE file in the root directory of this source tree.
 from __future__ import unicode_literals
 
-from shuup_cielo.models import CieloOrderTransaction, CieloTransaction
+from shuup_cielo.client import clear_request_deadline, start_request_deadline
 from shuup_cielo.objects import (
     CIELO_ORDER_TRANSACTION_ID_KEY, CIELO_TRANSACTION_ID_KEY, CieloTransactionContext
 )
@@ -16,30 +16,26 @@ from shuup_cielo.objects import (
 
 class CieloTransactionMiddleware(object):
     """
-    Fetches the current session's CieloTransactionContext object
-    or create a brand new and set it as a request attribute called `cielo`.
+    Sets the current session's CieloTransactionContext object as a
+    request attribute called `cielo`. Its objects are loaded lazily.
+
+    It also starts the time budget shared by all the gateway calls made
+    while handling the request.
     """
 
     def process_request(self, request):
-        cielo_context = CieloTransactionContext()
-
-        if request.session.get(CIELO_TRANSACTION_ID_KEY):
-            cielo_context.set_transaction(
-                CieloTransaction.objects.filter(pk=request.session[CIELO_TRANSACTION_ID_KEY]).first()
-            )
-
-        if request.session.get(CIELO_ORDER_TRANSACTION_ID_KEY):
-            cielo_context.set_order_transaction(
-                CieloOrderTransaction.objects.filter(
-                    pk=request.session[CIELO_ORDER_TRANSACTION_ID_KEY]
-                ).first()
-            )
-
-        # coloca o atributo
-        request.cielo = cielo_context
+        start_request_deadline()
+
+        # os objetos só são carregados quando acessados
+        request.cielo = CieloTransactionContext(
+            transaction_id=request.session.get(CIELO_TRANSACTION_ID_KEY),
+            order_transaction_id=request.session.get(CIELO_ORDER_TRANSACTION_ID_KEY)
+        )
         request.cielo.set_request(request)
 
     def process_response(self, request, response):
+        clear_request_deadline()
+
         if hasattr(request, 'cielo'):
             request.cielo.commit()
         return response
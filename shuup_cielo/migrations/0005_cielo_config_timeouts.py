@@ -0,0 +1,31 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+import django.core.validators
+from decimal import Decimal
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('shuup_cielo', '0004_cielo_config'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='cieloconfig',
+            name='connect_timeout',
+            field=models.DecimalField(decimal_places=1, default=Decimal('3'), max_digits=4, verbose_name='Connect timeout', help_text='Maximum time, in seconds, to wait for a connection with Cielo.', validators=[django.core.validators.MinValueValidator(Decimal('0.1'))]),
+        ),
+        migrations.AddField(
+            model_name='cieloconfig',
+            name='read_timeout',
+            field=models.DecimalField(decimal_places=1, default=Decimal('5'), max_digits=4, verbose_name='Read timeout', help_text='Maximum time, in seconds, to wait for each Cielo response.', validators=[django.core.validators.MinValueValidator(Decimal('0.1'))]),
+        ),
+        migrations.AddField(
+            model_name='cieloconfig',
+            name='request_timeout',
+            field=models.DecimalField(decimal_places=1, default=Decimal('15'), max_digits=4, verbose_name='Request time budget', help_text='Maximum time, in seconds, that all the Cielo calls made while handling a single page request may take together.', validators=[django.core.validators.MinValueValidator(Decimal('0.1'))]),
+        ),
+    ]
@@ -0,0 +1,38 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+import django.db.models.deletion
+import django.utils.timezone
+import enumfields.fields
+import shuup.core.fields
+import shuup_cielo.constants
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('shuup_cielo', '0005_cielo_config_timeouts'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='CieloTransactionOperation',
+            fields=[
+                ('id', models.AutoField(primary_key=True, verbose_name='ID', auto_created=True, serialize=False)),
+                ('operation', enumfields.fields.EnumIntegerField(verbose_name='Operation', enum=shuup_cielo.constants.CieloOperationType)),
+                ('amount', shuup.core.fields.MoneyValueField(max_digits=36, decimal_places=9, verbose_name='amount')),
+                ('status', enumfields.fields.EnumIntegerField(db_index=True, verbose_name='Operation status', default=0, enum=shuup_cielo.constants.CieloOperationStatus)),
+                ('attempts', models.PositiveIntegerField(verbose_name='Attempts', default=0)),
+                ('next_attempt', models.DateTimeField(db_index=True, verbose_name='Next attempt', default=django.utils.timezone.now)),
+                ('last_error', models.TextField(verbose_name='Last error', blank=True)),
+                ('creation_date', models.DateTimeField(auto_now_add=True, verbose_name='Creation date')),
+                ('last_update', models.DateTimeField(verbose_name='Last update', auto_now=True)),
+                ('transaction', models.ForeignKey(related_name='operations', on_delete=django.db.models.deletion.CASCADE, verbose_name='Cielo transaction', to='shuup_cielo.CieloTransaction')),
+            ],
+            options={
+                'verbose_name': 'Cielo transaction operation',
+                'verbose_name_plural': 'Cielo transaction operations',
+            },
+        ),
+    ]
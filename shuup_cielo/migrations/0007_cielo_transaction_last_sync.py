@@ -0,0 +1,26 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+import enumfields.fields
+import shuup_cielo.constants
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('shuup_cielo', '0006_cielo_transaction_operation'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='cielotransaction',
+            name='last_sync',
+            field=models.DateTimeField(verbose_name='Last sync', null=True, blank=True, editable=False),
+        ),
+        migrations.AddField(
+            model_name='cielotransaction',
+            name='last_sync_source',
+            field=enumfields.fields.EnumIntegerField(verbose_name='Last sync source', null=True, blank=True, editable=False, enum=shuup_cielo.constants.CieloSyncSource),
+        ),
+    ]
@@ -0,0 +1,102 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from decimal import Decimal, ROUND_HALF_UP
+
+from django.db import migrations, models
+from django.db.models import Case, F, Value, When
+
+AMOUNT_FIELDS = (
+    ('total_value', 'total_cents'),
+    ('total_captured_value', 'total_captured_cents'),
+    ('total_reversed_value', 'total_reversed_cents'),
+    ('interest_value', 'interest_cents'),
+)
+
+BATCH_SIZE = 500
+
+
+def _convert_in_batches(CieloTransaction, fields, convert):
+    """
+    Writes `convert` of each (source, target) field pair, one UPDATE per batch
+    """
+    queryset = CieloTransaction.objects.order_by('pk')
+    source_fields = [source_field for source_field, target_field in fields]
+    last_pk = 0
+
+    while True:
+        batch = list(queryset.filter(pk__gt=last_pk).values('pk', *source_fields)[:BATCH_SIZE])
+
+        if not batch:
+            break
+
+        values = {}
+        for source_field, target_field in fields:
+            field = CieloTransaction._meta.get_field(target_field)
+            values[target_field] = Case(
+                *[When(pk=row['pk'], then=Value(convert(row[source_field]), output_field=field)) for row in batch],
+                default=F(target_field),
+                output_field=field
+            )
+
+        CieloTransaction.objects.filter(pk__in=[row['pk'] for row in batch]).update(**values)
+        last_pk = batch[-1]['pk']
+
+
+def values_to_cents(apps, schema_editor):
+    CieloTransaction = apps.get_model('shuup_cielo', 'CieloTransaction')
+    _convert_in_batches(CieloTransaction, AMOUNT_FIELDS,
+                        lambda value: int((value * 100).quantize(Decimal(1), rounding=ROUND_HALF_UP)))
+
+
+def cents_to_values(apps, schema_editor):
+    CieloTransaction = apps.get_model('shuup_cielo', 'CieloTransaction')
+    _convert_in_batches(CieloTransaction, [(cents_field, value_field) for value_field, cents_field in AMOUNT_FIELDS],
+                        lambda cents: Decimal(cents).scaleb(-2))
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('shuup_cielo', '0007_cielo_transaction_last_sync'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='cielotransaction',
+            name='total_cents',
+            field=models.BigIntegerField(editable=False, verbose_name='transaction total (cents)', default=0),
+        ),
+        migrations.AddField(
+            model_name='cielotransaction',
+            name='total_captured_cents',
+            field=models.BigIntegerField(verbose_name='total captured (cents)', default=0),
+        ),
+        migrations.AddField(
+            model_name='cielotransaction',
+            name='total_reversed_cents',
+            field=models.BigIntegerField(verbose_name='total reversed (cents)', default=0),
+        ),
+        migrations.AddField(
+            model_name='cielotransaction',
+            name='interest_cents',
+            field=models.BigIntegerField(editable=False, verbose_name='interest amount (cents)', default=0),
+        ),
+        migrations.RunPython(values_to_cents, cents_to_values),
+        migrations.RemoveField(
+            model_name='cielotransaction',
+            name='total_value',
+        ),
+        migrations.RemoveField(
+            model_name='cielotransaction',
+            name='total_captured_value',
+        ),
+        migrations.RemoveField(
+            model_name='cielotransaction',
+            name='total_reversed_value',
+        ),
+        migrations.RemoveField(
+            model_name='cielotransaction',
+            name='interest_value',
+        ),
+    ]
@@ -0,0 +1,51 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from collections import defaultdict
+
+from django.db import migrations
+import shuup.core.fields
+
+BATCH_SIZE = 500
+
+
+def backfill_currency(apps, schema_editor):
+    CieloTransaction = apps.get_model('shuup_cielo', 'CieloTransaction')
+    queryset = CieloTransaction.objects.filter(currency='').order_by('pk')
+    last_pk = 0
+
+    while True:
+        batch = list(queryset.filter(pk__gt=last_pk).values_list(
+            'pk', 'order_transaction__order__currency', 'shop__currency'
+        )[:BATCH_SIZE])
+
+        if not batch:
+            break
+
+        # transações sem pedido usam a moeda da loja
+        pks_by_currency = defaultdict(list)
+        for pk, order_currency, shop_currency in batch:
+            pks_by_currency[order_currency or shop_currency].append(pk)
+
+        for currency, pks in pks_by_currency.items():
+            CieloTransaction.objects.filter(pk__in=pks).update(currency=currency)
+
+        last_pk = batch[-1][0]
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('shuup', '0004_update_orderline_refunds'),
+        ('shuup_cielo', '0008_cielo_transaction_cents'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='cielotransaction',
+            name='currency',
+            field=shuup.core.fields.CurrencyField(max_length=4, verbose_name='currency', blank=True, default=''),
+            preserve_default=False,
+        ),
+        migrations.RunPython(backfill_currency, migrations.RunPython.noop),
+    ]
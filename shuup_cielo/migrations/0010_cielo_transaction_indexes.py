@@ -0,0 +1,85 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+
+TABLE = 'shuup_cielo_cielotransaction'
+
+INDEXES = (
+    ('shuup_cielo_cielotransaction_tid', ('tid',)),
+    ('shuup_cielo_cielotransaction_authorization_nsu', ('authorization_nsu',)),
+    ('shuup_cielo_cielotransaction_creation_date', ('creation_date',)),
+    ('shuup_cielo_cielotransaction_shop_status_date', ('shop_id', 'status', 'creation_date')),
+    ('shuup_cielo_cielotransaction_status_date', ('status', 'creation_date')),
+)
+
+
+def _is_concurrent(schema_editor):
+    # CREATE INDEX CONCURRENTLY não roda dentro de uma transação,
+    # o que só é possível com `Migration.atomic = False` (Django >= 1.10)
+    return schema_editor.connection.vendor == 'postgresql' and not schema_editor.connection.in_atomic_block
+
+
+def create_indexes(apps, schema_editor):
+    concurrent = _is_concurrent(schema_editor)
+
+    for name, columns in INDEXES:
+        sql = schema_editor.sql_create_index % {
+            'name': schema_editor.quote_name(name),
+            'table': schema_editor.quote_name(TABLE),
+            'columns': ', '.join(schema_editor.quote_name(column) for column in columns),
+            'extra': '',
+        }
+        if concurrent:
+            sql = sql.replace('CREATE INDEX', 'CREATE INDEX CONCURRENTLY', 1)
+        schema_editor.execute(sql)
+
+
+def drop_indexes(apps, schema_editor):
+    concurrent = _is_concurrent(schema_editor)
+
+    for name, columns in INDEXES:
+        sql = schema_editor.sql_delete_index % {
+            'name': schema_editor.quote_name(name),
+            'table': schema_editor.quote_name(TABLE),
+        }
+        if concurrent:
+            sql = sql.replace('DROP INDEX', 'DROP INDEX CONCURRENTLY', 1)
+        schema_editor.execute(sql)
+
+
+class Migration(migrations.Migration):
+    atomic = False
+
+    dependencies = [
+        ('shuup_cielo', '0009_cielo_transaction_currency'),
+    ]
+
+    operations = [
+        migrations.SeparateDatabaseAndState(
+            database_operations=[
+                migrations.RunPython(create_indexes, drop_indexes),
+            ],
+            state_operations=[
+                migrations.AlterField(
+                    model_name='cielotransaction',
+                    name='tid',
+                    field=models.CharField(max_length=50, verbose_name='Transaction ID', db_index=True),
+                ),
+                migrations.AlterField(
+                    model_name='cielotransaction',
+                    name='authorization_nsu',
+                    field=models.CharField(max_length=50, verbose_name='Authorization NSU', blank=True, null=True, db_index=True),
+                ),
+                migrations.AlterField(
+                    model_name='cielotransaction',
+                    name='creation_date',
+                    field=models.DateTimeField(auto_now_add=True, verbose_name='Creation date', db_index=True),
+                ),
+                migrations.AlterIndexTogether(
+                    name='cielotransaction',
+                    index_together=set([('shop', 'status', 'creation_date'), ('status', 'creation_date')]),
+                ),
+            ],
+        ),
+    ]
@@ -0,0 +1,19 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('shuup_cielo', '0010_cielo_transaction_indexes'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='cielotransactionoperation',
+            name='expected_total_cents',
+            field=models.BigIntegerField(editable=False, verbose_name='expected total (cents)', default=0),
+        ),
+    ]
@@ -8,33 +8,41 @@
 # LICENSE file in the root directory of this source tree.
 from __future__ import unicode_literals
 
+from collections import namedtuple
+from datetime import timedelta
 from decimal import Decimal
 import logging
 
 from django.core.validators import MaxValueValidator, MinValueValidator
-from django.db import models
+from django.db import models, transaction as db_transaction
 from django.http.response import HttpResponseRedirect
+from django.utils.crypto import salted_hmac
 from django.utils.encoding import python_2_unicode_compatible
+from django.utils.timezone import now
 from django.utils.translation import ugettext_lazy as _
 from enumfields import EnumIntegerField
 import iso8601
 
 from cielo_webservice.models import Comercial
-from cielo_webservice.request import CieloRequest
-from shuup.core.fields import MoneyValueField
+from shuup.core.fields import CurrencyField, MoneyValueField
 from shuup.core.models import PaymentProcessor, ServiceChoice
 from shuup.core.models._service_base import ServiceBehaviorComponent, ServiceCost
 from shuup.core.models._shops import Shop
 from shuup.utils.analog import LogEntryKind
 from shuup.utils.excs import Problem
 from shuup.utils.properties import MoneyProperty
+from shuup_cielo import metrics
+from shuup_cielo.client import get_cielo_client
+from shuup_cielo.config_cache import get_cielo_config
 from shuup_cielo.constants import (
     CIELO_AUTHORIZATION_TYPE_CHOICES, CIELO_DECIMAL_PRECISION, CIELO_PRODUCT_CHOICES,
-    CIELO_SERVICE_CREDIT, CIELO_SERVICE_DEBIT, CieloAuthorizationType, CieloTransactionStatus,
+    CIELO_SERVICE_CREDIT, CIELO_SERVICE_DEBIT, CIELO_TRANSACTION_STATUS_RANK, CieloAuthorizationType,
+    CieloOperationStatus, CieloOperationType, CieloSyncSource, CieloTransactionStatus,
     INTEREST_TYPE_CHOICES, InterestType
 )
 from shuup_cielo.objects import CIELO_ORDER_TRANSACTION_ID_KEY, CIELO_TRANSACTION_ID_KEY
-from shuup_cielo.utils import decimal_to_int_cents, InstallmentCalculator, safe_int
+from shuup_cielo.status import get_refresh_max_age
+from shuup_cielo.utils import cents_to_decimal, decimal_to_int_cents, get_installment_table, safe_int
 
 logger = logging.getLogger(__name__)
 
@@ -113,39 +121,86 @@ class CieloOrderTransaction(models.Model):
         return "CieloOrder {0} for order ID {1}".format(self.id, self.order_id)
 
 
+def cents_property(field_name):
+    '''
+    Decimal view of an integer cents field
+
+    A plain `property`, so it can also be given to the model constructor.
+    '''
+    return property(lambda self: cents_to_decimal(getattr(self, field_name)),
+                    lambda self, value: setattr(self, field_name, decimal_to_int_cents(value)))
+
+
 @python_2_unicode_compatible
 class CieloTransaction(models.Model):
     TIMEOUT_SECONDS = 5
 
+    # campos alterados por `apply_transaction`
+    SYNC_FIELDS = (
+        'status', 'authorization_lr', 'authorization_nsu', 'authorization_date', 'international',
+        'authentication_eci', 'authentication_date', 'total_captured_cents', 'total_reversed_cents',
+    )
+
+    # quando e de onde veio o estado da transação
+    SYNC_INFO_FIELDS = ('last_sync', 'last_sync_source')
+
+    # o cliente ainda está autenticando no banco, a Cielo muda o estado sozinha
+    WAITING_STATUSES = (
+        CieloTransactionStatus.Created,
+        CieloTransactionStatus.InProgress,
+        CieloTransactionStatus.Authenticating,
+    )
+
+    # só há valor a estornar na Cielo depois da autorização
+    CANCELLABLE_STATUSES = (
+        CieloTransactionStatus.Authorized,
+        CieloTransactionStatus.Captured,
+    )
+
+    # enviadas à Cielo, mas ainda podem ser autorizadas
+    UNSETTLED_STATUSES = WAITING_STATUSES + (CieloTransactionStatus.Authenticated,)
+
     shop = models.ForeignKey(Shop, verbose_name=_("shop"))
     order_transaction = models.OneToOneField(CieloOrderTransaction,
                                              related_name="transaction",
                                              verbose_name=_("Cielo Order"))
-    tid = models.CharField(_('Transaction ID'), max_length=50)
+    tid = models.CharField(_('Transaction ID'), max_length=50, db_index=True)
     status = EnumIntegerField(CieloTransactionStatus,
                               verbose_name=_('Transaction status'),
                               default=CieloTransactionStatus.NotCreated,
                               blank=True)
-    creation_date = models.DateTimeField(_('Creation date'), auto_now_add=True)
+    creation_date = models.DateTimeField(_('Creation date'), auto_now_add=True, db_index=True)
     last_update = models.DateTimeField(_('Last update'), auto_now=True)
+    last_sync = models.DateTimeField(_('Last sync'), null=True, blank=True, editable=False)
+    last_sync_source = EnumIntegerField(CieloSyncSource, verbose_name=_('Last sync source'),
+                                        null=True, blank=True, editable=False)
 
     cc_holder = models.CharField(_('Card holder'), max_length=50)
     cc_brand = models.CharField(_('Card brand'), max_length=30)
     installments = models.PositiveSmallIntegerField(_('Installments'), default=1)
     cc_product = models.CharField(_('Product'), max_length=30, choices=CIELO_PRODUCT_CHOICES)
 
-    total = MoneyProperty('total_value', 'order_transaction.order.currency')
-    total_captured = MoneyProperty('total_captured_value', 'order_transaction.order.currency')
-    total_reversed = MoneyProperty('total_reversed_value', 'order_transaction.order.currency')
-    intereset = MoneyProperty('interest_value', 'order_transaction.order.currency')
+    # moeda do pedido, copiada para não consultar o pedido a cada valor exibido
+    currency = CurrencyField(verbose_name=_('currency'), blank=True)
 
-    total_value = MoneyValueField(editable=False, verbose_name=_('transaction total'), default=0)
-    total_captured_value = MoneyValueField(editable=True, verbose_name=_('total captured'), default=0)
-    total_reversed_value = MoneyValueField(editable=True, verbose_name=_('total reversed'), default=0)
-    interest_value = MoneyValueField(editable=False, verbose_name=_('interest amount'), default=0)
+    total = MoneyProperty('total_value', 'currency')
+    total_captured = MoneyProperty('total_captured_value', 'currency')
+    total_reversed = MoneyProperty('total_reversed_value', 'currency')
+    intereset = MoneyProperty('interest_value', 'currency')
+
+    # valores em centavos, como enviados e recebidos da Cielo
+    total_cents = models.BigIntegerField(editable=False, verbose_name=_('transaction total (cents)'), default=0)
+    total_captured_cents = models.BigIntegerField(editable=True, verbose_name=_('total captured (cents)'), default=0)
+    total_reversed_cents = models.BigIntegerField(editable=True, verbose_name=_('total reversed (cents)'), default=0)
+    interest_cents = models.BigIntegerField(editable=False, verbose_name=_('interest amount (cents)'), default=0)
+
+    total_value = cents_property('total_cents')
+    total_captured_value = cents_property('total_captured_cents')
+    total_reversed_value = cents_property('total_reversed_cents')
+    interest_value = cents_property('interest_cents')
 
     authorization_lr = models.CharField(_('Authorization LR code'), max_length=2, blank=True)
-    authorization_nsu = models.CharField(_('Authorization NSU'), max_length=50, blank=True, null=True)
+    authorization_nsu = models.CharField(_('Authorization NSU'), max_length=50, blank=True, null=True, db_index=True)
     authorization_date = models.DateTimeField(_('Authorization date'), null=True, blank=True)
 
     authentication_eci = models.SmallIntegerField(_('ECI security level'), null=True, default=0)
@@ -156,23 +211,43 @@ class CieloTransaction(models.Model):
     class Meta:
         verbose_name = _('Cielo 1.5 transaction')
         verbose_name_plural = _('Cielo 1.5 transactions')
+        # listagens por loja e estado e a sincronização em lote
+        index_together = (('shop', 'status', 'creation_date'), ('status', 'creation_date'))
 
     def __str__(self):
         return "CieloTransaction TID={0}".format(self.tid)
 
+    def save(self, *args, **kwargs):
+        if not self.currency and self.shop_id:
+            self.currency = self.shop.currency
+        return super(CieloTransaction, self).save(*args, **kwargs)
+
+    def _get_cielo_config(self):
+        cielo_config = get_cielo_config(self.shop_id)
+
+        if cielo_config is None:
+            raise CieloConfig.DoesNotExist("CieloConfig not configured for shop {0}".format(self.shop_id))
+
+        return cielo_config
+
     def _get_comercial(self):
-        cielo_config = self.shop.cielo_config
+        cielo_config = self._get_cielo_config()
         return Comercial(numero=safe_int(cielo_config.ec_num), chave=cielo_config.ec_key)
 
     def _get_cielo_request(self):
-        return CieloRequest(sandbox=self.shop.cielo_config.sandbox)
+        return get_cielo_client(self._get_cielo_config())
 
-    def refresh(self):
+    def refresh(self, max_age=None):
         '''
         Updates this transaction info with Cielo server
 
+        :param max_age: when given, Cielo is not queried if the transaction
+            is final or was synchronized less than `max_age` seconds ago
         :return: wheter the synchronization was successful
         '''
+        if max_age is not None and (self.is_final() or self.is_synced(max_age)):
+            metrics.increment(metrics.REFRESHES_SKIPPED)
+            return True
 
         # consuta a transação
         cielo_request = self._get_cielo_request()
@@ -188,7 +263,86 @@ class CieloTransaction(models.Model):
 
         return False
 
-    def _update_from_transaction(self, response_transaction):
+    def is_final(self):
+        '''
+        Whether the transaction can no longer change on Cielo by itself
+        '''
+        if self.status == CieloTransactionStatus.Cancelled:
+            return self.total_reversed_cents >= self.total_cents
+
+        return self.status in (CieloTransactionStatus.Captured, CieloTransactionStatus.NotAuthorized)
+
+    def is_synced(self, max_age):
+        '''
+        Whether the transaction was synchronized less than `max_age` seconds ago
+
+        Transactions waiting for the customer authentication are never considered synced.
+        '''
+        if not self.last_sync or self.status in self.WAITING_STATUSES:
+            return False
+
+        return now() - self.last_sync < timedelta(seconds=max_age)
+
+    def set_synced(self, source=CieloSyncSource.Query):
+        '''
+        Records that the transaction info came from Cielo now, without saving it
+        '''
+        self.last_sync = now()
+        self.last_sync_source = source
+
+    def _update_from_transaction(self, response_transaction, source=CieloSyncSource.Query):
+        '''
+        Applies the Cielo transaction info and writes only the fields that changed
+
+        The row is only updated while its stored status is not further along
+        than the response status, so a stale response never regresses a newer
+        one; in that case the stored values are loaded back.
+
+        :return: whether the transaction was written
+        :rtype: bool
+        '''
+        if self.pk is None:
+            self.apply_transaction(response_transaction)
+            self.set_synced(source)
+            self.save()
+            return True
+
+        stored_values = self._get_sync_values()
+        self.apply_transaction(response_transaction)
+        update_fields = [field_name for field_name, value in zip(self.SYNC_FIELDS, stored_values)
+                         if getattr(self, field_name) != value]
+
+        # sem mudanças, a data da sincronização é gravada no máximo uma vez por período
+        if not update_fields and self.last_sync and \
+                now() - self.last_sync < timedelta(seconds=get_refresh_max_age()):
+            self.set_synced(source)
+            return False
+
+        self.set_synced(source)
+        self.last_update = now()
+        update_fields.extend(self.SYNC_INFO_FIELDS + ('last_update',))
+
+        allowed_statuses = [status for status, rank in CIELO_TRANSACTION_STATUS_RANK.items()
+                            if rank <= CIELO_TRANSACTION_STATUS_RANK[self.status]]
+        updated = CieloTransaction.objects.filter(pk=self.pk, status__in=allowed_statuses).update(
+            **dict((field_name, getattr(self, field_name)) for field_name in update_fields)
+        )
+
+        if not updated:
+            logger.info("Stale Cielo response ignored for TID={0}".format(self.tid))
+            self.refresh_from_db(fields=self.SYNC_FIELDS + self.SYNC_INFO_FIELDS + ('last_update',))
+
+        return bool(updated)
+
+    def _get_sync_values(self):
+        return tuple(getattr(self, field_name) for field_name in self.SYNC_FIELDS)
+
+    def apply_transaction(self, response_transaction):
+        """
+        Copies the Cielo transaction info into this object, without saving it
+
+        :type response_transaction: cielo_webservice.models.Transacao
+        """
         if response_transaction.status:
             self.status = response_transaction.status
 
@@ -203,12 +357,10 @@ class CieloTransaction(models.Model):
             self.authentication_date = iso8601.parse_date(response_transaction.autenticacao.data_hora)
 
         if response_transaction.captura:
-            self.total_captured_value = Decimal(response_transaction.captura.valor / 100.0)
+            self.total_captured_cents = safe_int(response_transaction.captura.valor)
 
         if response_transaction.cancelamento:
-            self.total_reversed_value = Decimal(response_transaction.cancelamento.valor / 100.0)
-
-        self.save()
+            self.total_reversed_cents = safe_int(response_transaction.cancelamento.valor)
 
     def capture(self, amount):
         '''
@@ -220,7 +372,7 @@ class CieloTransaction(models.Model):
         response_transaction = cielo_request.capturar(tid=self.tid,
                                                       comercial=self._get_comercial(),
                                                       valor=decimal_to_int_cents(amount))
-        self._update_from_transaction(response_transaction)
+        self._update_from_transaction(response_transaction, CieloSyncSource.Capture)
 
     def safe_cancel(self, amount):
         """
@@ -244,7 +396,109 @@ class CieloTransaction(models.Model):
         response_transaction = cielo_request.cancelar(tid=self.tid,
                                                       comercial=self._get_comercial(),
                                                       valor=decimal_to_int_cents(amount))
-        self._update_from_transaction(response_transaction)
+        self._update_from_transaction(response_transaction, CieloSyncSource.Cancel)
+
+    def schedule_capture(self, amount):
+        """
+        Schedules the capture of a total or partial amount of this transaction
+
+        The capture is made by the `cielo_process_outbox` command.
+
+        :type: amount: decimal.Decimal
+        :rtype: CieloTransactionOperation
+        """
+        return self._schedule_operation(CieloOperationType.Capture, amount)
+
+    def schedule_cancel(self, amount):
+        """
+        Schedules the cancellation of a total or partial amount of this transaction
+
+        An authorized or captured transaction is marked as `Cancelling`.
+        A transaction Cielo may still authorize keeps its status: the
+        `cielo_process_outbox` command queries it and only cancels it once
+        it is authorized. Nothing is scheduled for refused transactions.
+
+        :type: amount: decimal.Decimal
+        :return: the pending cancellation, if any
+        :rtype: CieloTransactionOperation|None
+        """
+        if self.status in self.CANCELLABLE_STATUSES:
+            return self._schedule_operation(CieloOperationType.Cancel, amount, CieloTransactionStatus.Cancelling)
+
+        if self.tid and self.status in self.UNSETTLED_STATUSES:
+            return self._schedule_operation(CieloOperationType.Cancel, amount)
+
+        return self.operations.filter(operation=CieloOperationType.Cancel,
+                                      status=CieloOperationStatus.Pending).first()
+
+    def _schedule_operation(self, operation_type, amount, status=None):
+        with db_transaction.atomic():
+            operation = self.operations.filter(operation=operation_type,
+                                               status=CieloOperationStatus.Pending).first()
+
+            if not operation:
+                # total capturado ou estornado esperado na Cielo depois da operação,
+                # para reconhecer, numa nova tentativa, se ela já foi aplicada
+                if operation_type == CieloOperationType.Cancel:
+                    expected_total_cents = self.total_reversed_cents + decimal_to_int_cents(amount)
+                else:
+                    expected_total_cents = self.total_captured_cents + decimal_to_int_cents(amount)
+
+                operation = self.operations.create(operation=operation_type, amount=amount,
+                                                   expected_total_cents=expected_total_cents)
+
+            if status is not None and self.status != status:
+                self.status = status
+                self.save(update_fields=['status', 'last_update'])
+
+        return operation
+
+
+@python_2_unicode_compatible
+class CieloTransactionOperation(models.Model):
+    """
+    A capture or cancellation waiting to be sent to Cielo (outbox)
+
+    The operation is saved in the same database transaction that changes
+    the state of the `CieloTransaction`, so it is never lost, and is sent
+    by the `cielo_process_outbox` command, outside the customer request.
+    """
+    transaction = models.ForeignKey(CieloTransaction,
+                                    related_name="operations",
+                                    on_delete=models.CASCADE,
+                                    verbose_name=_("Cielo transaction"))
+    operation = EnumIntegerField(CieloOperationType, verbose_name=_('Operation'))
+    amount = MoneyValueField(verbose_name=_('amount'))
+    expected_total_cents = models.BigIntegerField(editable=False, verbose_name=_('expected total (cents)'), default=0)
+    status = EnumIntegerField(CieloOperationStatus,
+                              verbose_name=_('Operation status'),
+                              default=CieloOperationStatus.Pending,
+                              db_index=True)
+    attempts = models.PositiveIntegerField(_('Attempts'), default=0)
+    next_attempt = models.DateTimeField(_('Next attempt'), default=now, db_index=True)
+    last_error = models.TextField(_('Last error'), blank=True)
+    creation_date = models.DateTimeField(_('Creation date'), auto_now_add=True)
+    last_update = models.DateTimeField(_('Last update'), auto_now=True)
+
+    class Meta:
+        verbose_name = _('Cielo transaction operation')
+        verbose_name_plural = _('Cielo transaction operations')
+
+    def __str__(self):
+        return "{0} of {1} for TID={2}".format(self.operation.name, self.amount, self.transaction.tid)
+
+
+def get_installment_amount(amount, installment, total_coefficient):
+    """
+    Returns the installment amount, not rounded
+
+    It is derived from the total, so exact divisions stay exact (R$ 30.00
+    in 3x is R$ 10.00, not 9.999...) when compared to the minimum amount.
+    Only the value shown to the customer is rounded.
+
+    :rtype: decimal.Decimal
+    """
+    return amount * total_coefficient / installment
 
 
 class InstallmentContext(object):
@@ -276,42 +530,68 @@ class InstallmentContext(object):
 
         '''
         installments = []
+        amount = Decimal(self.installment_total_amount)
+        table = get_installment_table(self.max_installments, self.installments_without_interest,
+                                      self.interest_type, self.interest_rate)
 
-        for installment in range(1, self.max_installments + 1):
-            installment_amount = Decimal()
-            installments_total = Decimal(self.installment_total_amount)
-
-            # parcela sem juros
-            if installment <= self.installments_without_interest or self.interest_rate <= Decimal(0):
-
-                installment_amount = self.installment_total_amount / installment
-
-            elif self.interest_type == InterestType.Simple:
-                # juros simples
-                installments_total, installment_amount = InstallmentCalculator.simple_interest(
-                    self.installment_total_amount, installment, self.interest_rate
-                )
-
-            else:
-                # PRICE tabale
-                installments_total, installment_amount = InstallmentCalculator.price_interest(
-                    self.installment_total_amount, installment, self.interest_rate
-                )
+        for installment, total_coefficient in table:
+            installment_amount = get_installment_amount(amount, installment, total_coefficient)
 
             # o valor da parcela deve ser maior que o mínimo
             if installment_amount >= self.min_installment_amount:
-                interest_total = installments_total - self.installment_total_amount
+                installments_total = amount * total_coefficient
 
                 installments.append(
-                    (int(installment),
-                     Decimal(installment_amount).quantize(CIELO_DECIMAL_PRECISION),
-                     Decimal(installments_total).quantize(CIELO_DECIMAL_PRECISION),
-                     Decimal(interest_total).quantize(CIELO_DECIMAL_PRECISION))
+                    (installment,
+                     installment_amount.quantize(CIELO_DECIMAL_PRECISION),
+                     installments_total.quantize(CIELO_DECIMAL_PRECISION),
+                     (installments_total - amount).quantize(CIELO_DECIMAL_PRECISION))
                 )
 
         return sorted(installments, key=lambda x: x[0])
 
 
+InstallmentOffer = namedtuple("InstallmentOffer", ("number", "installment_amount", "total", "interest"))
+
+
+def get_best_installment_offers(prices, cielo_config):
+    """
+    Returns the offer with the most installments for each price, in one pass
+
+    The same coefficient table of `InstallmentContext` is used, so the
+    offers match the installments shown in the checkout.
+
+    :param prices: amounts or prices (anything with a `value`)
+    :type cielo_config: CieloConfig
+    :return: an offer for each price, or None when the price can't be paid in installments
+    :rtype: list[InstallmentOffer|None]
+    """
+    table = get_installment_table(cielo_config.max_installments, cielo_config.installments_without_interest,
+                                  cielo_config.interest_type, cielo_config.interest_rate)
+    rows = tuple(reversed(table))
+    min_installment_amount = cielo_config.min_installment_amount
+    offers = []
+
+    for price in prices:
+        amount = Decimal(getattr(price, "value", price))
+        offer = None
+
+        for installment, total_coefficient in rows:
+            installment_amount = get_installment_amount(amount, installment, total_coefficient)
+
+            if installment_amount >= min_installment_amount:
+                total = amount * total_coefficient
+                offer = InstallmentOffer(installment,
+                                         installment_amount.quantize(CIELO_DECIMAL_PRECISION),
+                                         total.quantize(CIELO_DECIMAL_PRECISION),
+                                         (total - amount).quantize(CIELO_DECIMAL_PRECISION))
+                break
+
+        offers.append(offer)
+
+    return offers
+
+
 class CieloConfig(models.Model):
     MAX_INSTALLMENTS = 12
     shop = models.OneToOneField(Shop, verbose_name=_("Shop"), related_name="cielo_config")
@@ -366,10 +646,40 @@ class CieloConfig(models.Model):
                                   default=False,
                                   help_text=_('Enable this to activate Developer mode (test mode).'))
 
+    connect_timeout = models.DecimalField(_('Connect timeout'),
+                                          max_digits=4,
+                                          decimal_places=1,
+                                          default=Decimal(3),
+                                          validators=[MinValueValidator(Decimal('0.1'))],
+                                          help_text=_('Maximum time, in seconds, to wait for a connection '
+                                                      'with Cielo.'))
+
+    read_timeout = models.DecimalField(_('Read timeout'),
+                                       max_digits=4,
+                                       decimal_places=1,
+                                       default=Decimal(CieloTransaction.TIMEOUT_SECONDS),
+                                       validators=[MinValueValidator(Decimal('0.1'))],
+                                       help_text=_('Maximum time, in seconds, to wait for each Cielo response.'))
+
+    request_timeout = models.DecimalField(_('Request time budget'),
+                                          max_digits=4,
+                                          decimal_places=1,
+                                          default=Decimal(15),
+                                          validators=[MinValueValidator(Decimal('0.1'))],
+                                          help_text=_('Maximum time, in seconds, that all the Cielo calls made '
+                                                      'while handling a single page request may take together.'))
+
     class Meta:
         verbose_name = _('cielo configuration')
         verbose_name_plural = _('cielo configurations')
 
+    def get_notification_token(self):
+        """
+        Token that authenticates the status notifications posted by Cielo
+        """
+        value = "{0}:{1}:{2}".format(self.shop_id, self.ec_num, self.ec_key)
+        return salted_hmac("shuup_cielo.notification", value).hexdigest()
+
     def __str__(self):  # pragma: no cover
         return _('Cielo configuration for {0}').format(self.shop)
 
@@ -8,38 +8,86 @@
 # LICENSE file in the root directory of this source tree.
 from __future__ import unicode_literals
 
+from shuup_cielo import metrics
+
 CIELO_TRANSACTION_ID_KEY = 'cielo_transaction_id'
 CIELO_ORDER_TRANSACTION_ID_KEY = 'cielo_order_transaction_id'
 
 
 class CieloTransactionContext(object):
+    """
+    Cielo payment state of the current session
+
+    The transaction and the pre-order transaction are only loaded when first
+    accessed, so requests that do not touch the payment do not query them.
+    When both are needed, they are loaded by a single query.
+    """
     _request = None
-    _transaction = None
-    _order_transaction = None
+
+    def __init__(self, transaction_id=None, order_transaction_id=None):
+        self._transaction_id = transaction_id
+        self._order_transaction_id = order_transaction_id
+        self._transaction = None
+        self._order_transaction = None
+        self._transaction_loaded = not transaction_id
+        self._order_transaction_loaded = not order_transaction_id
+
+    def _load(self):
+        # os modelos importam as chaves deste módulo
+        from shuup_cielo.models import CieloOrderTransaction, CieloTransaction
+
+        if not self._transaction_loaded:
+            self._transaction = CieloTransaction.objects.select_related(
+                'order_transaction', 'shop'
+            ).filter(pk=self._transaction_id).first()
+            self._transaction_loaded = True
+
+        if not self._order_transaction_loaded:
+            if self._transaction and self._transaction.order_transaction_id == self._order_transaction_id:
+                self._order_transaction = self._transaction.order_transaction
+            else:
+                self._order_transaction = CieloOrderTransaction.objects.filter(
+                    pk=self._order_transaction_id
+                ).first()
+            self._order_transaction_loaded = True
 
     def commit(self):
-        """ Persists the current session objects """
-        self._request.session.modified = True
+        """
+        Persists the current session objects
+
+        Only the keys that changed are written, so the session is not
+        saved again when the Cielo state is untouched.
+        """
+        changed = False
+
+        if self._transaction_loaded:
+            transaction_id = self._transaction.pk if self._transaction else None
+
+            if transaction_id != self._transaction_id:
+                self._request.session[CIELO_TRANSACTION_ID_KEY] = transaction_id
+                self._transaction_id = transaction_id
+                changed = True
 
-        if self._transaction:
-            self._request.session[CIELO_TRANSACTION_ID_KEY] = self._transaction.pk
-        else:
-            self._request.session[CIELO_TRANSACTION_ID_KEY] = None
+        if self._order_transaction_loaded:
+            order_transaction_id = self._order_transaction.pk if self._order_transaction else None
 
-        if self._order_transaction:
-            self._request.session[CIELO_ORDER_TRANSACTION_ID_KEY] = self._order_transaction.pk
-        else:
-            self._request.session[CIELO_ORDER_TRANSACTION_ID_KEY] = None
+            if order_transaction_id != self._order_transaction_id:
+                self._request.session[CIELO_ORDER_TRANSACTION_ID_KEY] = order_transaction_id
+                self._order_transaction_id = order_transaction_id
+                changed = True
+
+        if not changed:
+            metrics.increment(metrics.SESSION_WRITES_SKIPPED)
 
     def rollback(self):
-        """ Cancel the current transaction if it exists """
-        if self._transaction:
-            self._transaction.safe_cancel(self._transaction.total_value)
+        """ Schedule the cancellation of the current transaction if it exists """
+        if self.transaction:
+            self.transaction.schedule_cancel(self.transaction.total_value)
 
     def clear(self):
         """ Set the current attributs to None and commit """
-        self._transaction = None
-        self._order_transaction = None
+        self.set_transaction(None)
+        self.set_order_transaction(None)
         self.commit()
 
     def set_request(self, request):
@@ -47,14 +95,20 @@ class CieloTransactionContext(object):
 
     def set_transaction(self, transaction):
         self._transaction = transaction
+        self._transaction_loaded = True
 
     def set_order_transaction(self, order_transaction):
         self._order_transaction = order_transaction
+        self._order_transaction_loaded = True
 
     @property
     def transaction(self):
+        if not self._transaction_loaded:
+            self._load()
         return self._transaction
 
     @property
     def order_transaction(self):
+        if not self._order_transaction_loaded:
+            self._load()
         return self._order_transaction
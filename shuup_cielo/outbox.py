@@ -0,0 +1,229 @@
+# -*- coding: utf-8 -*-
+# This file is part of Shuup Cielo.
+#
+# Copyright (c) 2016, Rockho Team. All rights reserved.
+# Author: Christian Hess
+#
+# This source code is licensed under the AGPLv3 license found in the
+# LICENSE file in the root directory of this source tree.
+"""
+Delivery of the scheduled captures and cancellations (`CieloTransactionOperation`)
+
+Operations are claimed with a lease, so several workers may drain the
+outbox at the same time, and retried with exponential backoff. Before a
+retry Cielo is queried, so an operation that reached Cielo before the
+previous attempt failed is not sent twice.
+
+A transaction abandoned before Cielo answered is queried as well: it is
+cancelled once authorized, and left alone if refused.
+"""
+from __future__ import unicode_literals
+
+from datetime import timedelta
+import logging
+
+from django.conf import settings
+from django.db import transaction as db_transaction
+from django.utils.timezone import now
+
+from shuup_cielo.constants import (
+    CieloOperationStatus, CieloOperationType, CieloSyncSource, CieloTransactionStatus
+)
+from shuup_cielo.exceptions import CieloCircuitOpenError, CieloTransactionNotSettled
+from shuup_cielo.models import CieloTransaction, CieloTransactionOperation
+from shuup_cielo.utils import decimal_to_int_cents, safe_int
+
+logger = logging.getLogger(__name__)
+
+CIELO_DEFAULT_OUTBOX_MAX_ATTEMPTS = 10
+
+# segundos até a primeira nova tentativa, dobrado a cada falha
+CIELO_DEFAULT_OUTBOX_RETRY_DELAY = 30
+CIELO_DEFAULT_OUTBOX_MAX_RETRY_DELAY = 3600
+
+# tempo que uma operação fica reservada para o worker que a pegou
+CIELO_DEFAULT_OUTBOX_LEASE = 300
+
+
+class OutboxResult(object):
+    def __init__(self):
+        self.done = 0
+        self.retried = 0
+        self.failed = 0
+
+    @property
+    def processed(self):
+        return self.done + self.retried + self.failed
+
+
+def get_max_attempts():
+    return getattr(settings, "CIELO_OUTBOX_MAX_ATTEMPTS", CIELO_DEFAULT_OUTBOX_MAX_ATTEMPTS)
+
+
+def get_retry_delay(attempts):
+    """
+    :param attempts: failed attempts so far
+    :rtype: datetime.timedelta
+    """
+    delay = getattr(settings, "CIELO_OUTBOX_RETRY_DELAY", CIELO_DEFAULT_OUTBOX_RETRY_DELAY)
+    max_delay = getattr(settings, "CIELO_OUTBOX_MAX_RETRY_DELAY", CIELO_DEFAULT_OUTBOX_MAX_RETRY_DELAY)
+    return timedelta(seconds=min(delay * (2 ** max(attempts - 1, 0)), max_delay))
+
+
+def get_pending_operations():
+    return CieloTransactionOperation.objects.filter(
+        status=CieloOperationStatus.Pending,
+        next_attempt__lte=now()
+    ).select_related("transaction").order_by("next_attempt", "pk")
+
+
+def _claim(operation):
+    """
+    Reserves the operation for this worker
+
+    :return: whether no other worker took it first
+    """
+    lease = getattr(settings, "CIELO_OUTBOX_LEASE", CIELO_DEFAULT_OUTBOX_LEASE)
+    next_attempt = now() + timedelta(seconds=lease)
+
+    claimed = CieloTransactionOperation.objects.filter(
+        pk=operation.pk,
+        status=CieloOperationStatus.Pending,
+        next_attempt=operation.next_attempt
+    ).update(next_attempt=next_attempt)
+
+    operation.next_attempt = next_attempt
+    return bool(claimed)
+
+
+def _is_applied(operation, response_transaction):
+    """
+    Checks whether Cielo has already applied the operation
+
+    The captured or reversed total returned by Cielo is compared against the
+    total expected after this operation, not its amount, so an earlier
+    partial cancellation is not taken for this one.
+    """
+    # operações agendadas antes do total esperado existir
+    valor = operation.expected_total_cents or decimal_to_int_cents(operation.amount)
+
+    if operation.operation == CieloOperationType.Cancel:
+        return bool(response_transaction.status == CieloTransactionStatus.Cancelled.value or
+                    (response_transaction.cancelamento and response_transaction.cancelamento.valor >= valor))
+
+    return bool(response_transaction.captura and response_transaction.captura.valor >= valor)
+
+
+def _needs_cancel(response_transaction):
+    """
+    Checks whether Cielo has authorized the transaction, so there is something to cancel
+
+    :raises CieloTransactionNotSettled: while Cielo may still authorize it
+    """
+    status = CieloTransactionStatus(safe_int(response_transaction.status))
+
+    if status in CieloTransaction.UNSETTLED_STATUSES:
+        raise CieloTransactionNotSettled("Cielo has not answered transaction {0} yet.".format(
+            response_transaction.tid))
+
+    return status in CieloTransaction.CANCELLABLE_STATUSES
+
+
+def process_operation(operation):
+    """
+    Sends the operation to Cielo, updating the transaction on success
+    and scheduling a new attempt on failure
+
+    :type operation: shuup_cielo.models.CieloTransactionOperation
+    :return: whether the operation is done
+    :rtype: bool
+    """
+    cielo_transaction = operation.transaction
+    cielo_request = cielo_transaction._get_cielo_request()
+    comercial = cielo_transaction._get_comercial()
+    response_transaction = None
+    source = CieloSyncSource.Query
+
+    # agendado antes da resposta da Cielo: a transação não foi marcada como Cancelling
+    unsettled = (operation.operation == CieloOperationType.Cancel and
+                 cielo_transaction.status in CieloTransaction.UNSETTLED_STATUSES)
+
+    try:
+        # a tentativa anterior pode ter chegado à Cielo antes de falhar
+        if operation.attempts or unsettled:
+            current_transaction = cielo_request.consultar(tid=cielo_transaction.tid, comercial=comercial)
+            if _is_applied(operation, current_transaction):
+                response_transaction = current_transaction
+            elif unsettled and not _needs_cancel(current_transaction):
+                # a Cielo recusou a transação: não há o que cancelar
+                response_transaction = current_transaction
+
+        if response_transaction is None:
+            if operation.operation == CieloOperationType.Cancel:
+                source = CieloSyncSource.Cancel
+                response_transaction = cielo_request.cancelar(tid=cielo_transaction.tid,
+                                                              comercial=comercial,
+                                                              valor=decimal_to_int_cents(operation.amount))
+            else:
+                source = CieloSyncSource.Capture
+                response_transaction = cielo_request.capturar(tid=cielo_transaction.tid,
+                                                              comercial=comercial,
+                                                              valor=decimal_to_int_cents(operation.amount))
+
+    except CieloCircuitOpenError:
+        # a Cielo está fora: devolve a operação sem gastar uma tentativa
+        operation.next_attempt = now()
+        operation.save(update_fields=["next_attempt", "last_update"])
+        raise
+
+    except Exception as exc:
+        operation.attempts += 1
+        operation.last_error = "{0}".format(exc)
+
+        if operation.attempts >= get_max_attempts():
+            operation.status = CieloOperationStatus.Failed
+            logger.error("Cielo {0} of TID={1} failed after {2} attempts: {3}".format(
+                operation.operation.name, cielo_transaction.tid, operation.attempts, exc))
+        else:
+            operation.next_attempt = now() + get_retry_delay(operation.attempts)
+            logger.warning("Cielo {0} of TID={1} failed, retrying at {2}: {3}".format(
+                operation.operation.name, cielo_transaction.tid, operation.next_attempt, exc))
+
+        operation.save()
+        return False
+
+    with db_transaction.atomic():
+        cielo_transaction._update_from_transaction(response_transaction, source)
+        operation.attempts += 1
+        operation.status = CieloOperationStatus.Done
+        operation.last_error = ""
+        operation.save()
+
+    return True
+
+
+def process_outbox(limit=None):
+    """
+    Sends the pending operations whose next attempt is due
+
+    :param limit: maximum number of operations to process
+    :rtype: OutboxResult
+    """
+    result = OutboxResult()
+    operations = get_pending_operations()
+
+    if limit:
+        operations = operations[:limit]
+
+    for operation in operations:
+        if not _claim(operation):
+            continue
+
+        if process_operation(operation):
+            result.done += 1
+        elif operation.status == CieloOperationStatus.Failed:
+            result.failed += 1
+        else:
+            result.retried += 1
+
+    return result
@@ -0,0 +1,136 @@
+# -*- coding: utf-8 -*-
+# This file is part of Shuup Cielo.
+#
+# Copyright (c) 2016, Rockho Team. All rights reserved.
+# Author: Christian Hess
+#
+# This source code is licensed under the AGPLv3 license found in the
+# LICENSE file in the root directory of this source tree.
+from __future__ import unicode_literals
+
+from django.conf import settings
+from django.core.cache import cache
+
+from shuup_cielo.constants import CieloTransactionStatus
+
+# intervalo mínimo, em segundos, entre duas consultas à Cielo para a mesma transação
+CIELO_DEFAULT_STATUS_POLL_INTERVAL = 2
+
+# tempo máximo, em segundos, que a página de confirmação aguarda a autorização
+CIELO_DEFAULT_STATUS_POLL_TIMEOUT = 60
+
+# por quanto tempo, em segundos, um estado notificado pela Cielo dispensa novas consultas
+CIELO_DEFAULT_NOTIFIED_STATUS_TIMEOUT = 300
+
+# por quanto tempo, em segundos, uma transação sincronizada dispensa novas consultas
+CIELO_DEFAULT_REFRESH_MAX_AGE = 10
+
+
+def get_status_poll_interval():
+    return getattr(settings, "CIELO_STATUS_POLL_INTERVAL", CIELO_DEFAULT_STATUS_POLL_INTERVAL)
+
+
+def get_status_poll_timeout():
+    return getattr(settings, "CIELO_STATUS_POLL_TIMEOUT", CIELO_DEFAULT_STATUS_POLL_TIMEOUT)
+
+
+def get_refresh_max_age():
+    return getattr(settings, "CIELO_REFRESH_MAX_AGE", CIELO_DEFAULT_REFRESH_MAX_AGE)
+
+
+def _get_status_key(cielo_transaction):
+    return "cielo_status:{0}".format(cielo_transaction.tid)
+
+
+def _get_refresh_lock_key(cielo_transaction):
+    return "cielo_status_refresh:{0}".format(cielo_transaction.tid)
+
+
+def _get_notified_status_key(cielo_transaction):
+    return "cielo_status_notified:{0}".format(cielo_transaction.tid)
+
+
+def set_cached_status(cielo_transaction):
+    """
+    Shares the current status of the transaction with the other workers
+    """
+    cache.set(_get_status_key(cielo_transaction), cielo_transaction.status.value,
+              timeout=get_status_poll_interval())
+
+
+def set_notified_status(cielo_transaction):
+    """
+    Shares a status pushed by Cielo with the other workers
+
+    While it is cached, the checkout trusts the transaction saved in the
+    database instead of querying Cielo again, except for an authorization,
+    which is confirmed by one query first.
+    """
+    timeout = getattr(settings, "CIELO_NOTIFIED_STATUS_TIMEOUT", CIELO_DEFAULT_NOTIFIED_STATUS_TIMEOUT)
+    cache.set(_get_notified_status_key(cielo_transaction), cielo_transaction.status.value, timeout=timeout)
+    set_cached_status(cielo_transaction)
+
+
+def refresh_transaction(cielo_transaction):
+    """
+    Updates the transaction from Cielo, unless Cielo has recently notified its status
+    or the transaction is final or was recently synchronized
+
+    A notified authorization is only accepted after Cielo confirms it once.
+
+    :type cielo_transaction: shuup_cielo.models.CieloTransaction
+    :return: whether the transaction info is up to date
+    :rtype: bool
+    """
+    notified_key = _get_notified_status_key(cielo_transaction)
+    status = cache.get(notified_key)
+
+    if status is None:
+        return cielo_transaction.refresh(max_age=get_refresh_max_age())
+
+    if status != cielo_transaction.status.value:
+        cielo_transaction.refresh_from_db()
+
+    # a notificação não é assinada pela Cielo: a autorização é confirmada por uma consulta
+    if cielo_transaction.status == CieloTransactionStatus.Authorized:
+        if not cielo_transaction.refresh():
+            return False
+        cache.delete(notified_key)
+
+    return True
+
+
+def get_transaction_status(cielo_transaction):
+    """
+    Returns the status of the transaction, asking Cielo at most once per poll interval
+
+    While the cached (or notified) status is valid every caller reads it; when it
+    expires, only the caller that takes the refresh lock queries Cielo and the
+    others keep the status saved in the database.
+
+    :type cielo_transaction: shuup_cielo.models.CieloTransaction
+    :rtype: shuup_cielo.constants.CieloTransactionStatus
+    """
+    status_key = _get_status_key(cielo_transaction)
+    notified_key = _get_notified_status_key(cielo_transaction)
+    cached = cache.get_many([status_key, notified_key])
+    status = cached.get(status_key, cached.get(notified_key))
+
+    if status is None and cache.add(_get_refresh_lock_key(cielo_transaction), 1,
+                                    timeout=get_status_poll_interval()):
+        if cielo_transaction.refresh(max_age=get_refresh_max_age()):
+            set_cached_status(cielo_transaction)
+        return cielo_transaction.status
+
+    # outro worker atualizou a transação depois que ela foi carregada
+    if status is not None and status != cielo_transaction.status.value:
+        cielo_transaction.refresh_from_db()
+
+    return cielo_transaction.status
+
+
+def is_pending_status(status):
+    """
+    Whether Cielo is still authorizing the transaction
+    """
+    return status == CieloTransactionStatus.Authenticating
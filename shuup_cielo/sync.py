@@ -0,0 +1,253 @@
+# -*- coding: utf-8 -*-
+# This file is part of Shuup Cielo.
+#
+# Copyright (c) 2016, Rockho Team. All rights reserved.
+# Author: Christian Hess
+#
+# This source code is licensed under the AGPLv3 license found in the
+# LICENSE file in the root directory of this source tree.
+"""
+Bulk synchronization of `CieloTransaction` objects with Cielo
+
+The gateway calls are made by a bounded thread pool while the database
+is only touched by the calling thread, in batches.
+"""
+from __future__ import unicode_literals
+
+from concurrent.futures import ThreadPoolExecutor
+from datetime import timedelta
+import logging
+import time
+
+from django.db import transaction as db_transaction
+from django.db.models import Case, F, Value, When
+from django.utils.timezone import now
+
+from shuup_cielo.constants import CIELO_TRANSACTION_STATUS_RANK, CieloTransactionStatus
+from shuup_cielo.exceptions import CieloCircuitOpenError
+from shuup_cielo.models import CieloTransaction
+
+logger = logging.getLogger(__name__)
+
+# transações que ainda podem mudar na Cielo
+CIELO_SYNC_DEFAULT_STATUSES = (
+    CieloTransactionStatus.Created,
+    CieloTransactionStatus.InProgress,
+    CieloTransactionStatus.Authenticated,
+    CieloTransactionStatus.Authorized,
+    CieloTransactionStatus.Authenticating,
+    CieloTransactionStatus.Cancelling,
+)
+
+CIELO_DEFAULT_SYNC_WORKERS = 8
+CIELO_DEFAULT_SYNC_BATCH_SIZE = 200
+
+
+class SyncResult(object):
+    def __init__(self):
+        self.fetched = 0
+        self.updated = 0
+        self.failed = 0
+        self.last_pk = None
+        self.started_at = time.time()
+
+    @property
+    def processed(self):
+        return self.fetched + self.failed
+
+    @property
+    def elapsed(self):
+        return time.time() - self.started_at
+
+    @property
+    def throughput(self):
+        """
+        Transactions processed per second
+        """
+        elapsed = self.elapsed
+        return (self.processed / elapsed) if elapsed > 0 else 0.0
+
+
+def get_transactions_to_sync(statuses=CIELO_SYNC_DEFAULT_STATUSES, min_age=None, max_age=None,
+                             shop=None, start_after=None):
+    """
+    :param statuses: only transactions with these statuses
+    :param min_age: only transactions created at least this long ago
+    :type min_age: datetime.timedelta|None
+    :param max_age: only transactions created at most this long ago
+    :type max_age: datetime.timedelta|None
+    :type shop: shuup.core.models.Shop|int|None
+    :param start_after: only transactions with a greater primary key
+    :rtype: django.db.models.QuerySet
+    """
+    queryset = CieloTransaction.objects.filter(shop__cielo_config__isnull=False)
+
+    if statuses:
+        queryset = queryset.filter(status__in=statuses)
+    if min_age is not None:
+        queryset = queryset.filter(creation_date__lte=now() - min_age)
+    if max_age is not None:
+        queryset = queryset.filter(creation_date__gte=now() - max_age)
+    if shop is not None:
+        queryset = queryset.filter(shop=shop)
+    if start_after is not None:
+        queryset = queryset.filter(pk__gt=start_after)
+
+    return queryset.order_by('pk')
+
+
+def bulk_update_transactions(transactions, fields=CieloTransaction.SYNC_FIELDS):
+    """
+    Saves the `fields` of all the `transactions` with one UPDATE per status
+
+    As in `CieloTransaction._update_from_transaction`, a row is skipped when
+    its stored status is further along than the new one, e.g. when it was
+    captured while Cielo was being queried.
+
+    :type transactions: list[shuup_cielo.models.CieloTransaction]
+    :return: number of updated rows
+    :rtype: int
+    """
+    if not transactions:
+        return 0
+
+    last_update = now()
+    buckets = {}
+
+    for transaction in transactions:
+        buckets.setdefault(transaction.status, []).append(transaction)
+
+    updated = 0
+
+    with db_transaction.atomic():
+        for status, bucket in buckets.items():
+            values = {"last_update": last_update}
+
+            for field_name in fields:
+                field = CieloTransaction._meta.get_field(field_name)
+                # o ELSE com a própria coluna faz o banco inferir o tipo do CASE
+                values[field.attname] = Case(
+                    *[When(pk=transaction.pk, then=Value(getattr(transaction, field.attname), output_field=field))
+                      for transaction in bucket],
+                    default=F(field.attname),
+                    output_field=field
+                )
+
+            allowed_statuses = [allowed for allowed, rank in CIELO_TRANSACTION_STATUS_RANK.items()
+                                if rank <= CIELO_TRANSACTION_STATUS_RANK[status]]
+            updated += CieloTransaction.objects.filter(
+                pk__in=[t.pk for t in bucket], status__in=allowed_statuses
+            ).update(**values)
+
+    for transaction in transactions:
+        transaction.last_update = last_update
+
+    return updated
+
+
+def _prepare_fetch(transaction):
+    """
+    Resolves the client and the credentials of the transaction
+
+    Called in the main thread, so the workers never query the database
+    (the config cache may need to) nor open connections of their own.
+    """
+    try:
+        return (transaction, transaction._get_cielo_request(), transaction._get_comercial(), None)
+    except Exception as exc:
+        return (transaction, None, None, exc)
+
+
+def _fetch_transaction(job):
+    transaction, cielo_request, comercial, exc = job
+
+    if exc is not None:
+        return (transaction, None, exc)
+
+    try:
+        response = cielo_request.consultar(tid=transaction.tid, comercial=comercial)
+        return (transaction, response, None)
+    except Exception as exc:
+        return (transaction, None, exc)
+
+
+def sync_transactions(queryset, workers=CIELO_DEFAULT_SYNC_WORKERS, batch_size=CIELO_DEFAULT_SYNC_BATCH_SIZE,
+                      on_batch=None):
+    """
+    Queries every transaction of `queryset` on Cielo and saves the changes
+
+    The queryset is walked by primary key, `batch_size` transactions at a time.
+    `SyncResult.last_pk` holds the last primary key of a completely processed
+    batch, so an interrupted run can be resumed from it.
+
+    :param queryset: as returned by `get_transactions_to_sync`
+    :param workers: number of simultaneous calls to Cielo
+    :param on_batch: called with the `SyncResult` after each batch is saved
+    :rtype: SyncResult
+    :raises CieloCircuitOpenError: when Cielo becomes unavailable in the middle of the run
+    """
+    result = SyncResult()
+
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        while True:
+            batch = queryset
+            if result.last_pk is not None:
+                batch = batch.filter(pk__gt=result.last_pk)
+            batch = list(batch[:batch_size])
+
+            if not batch:
+                break
+
+            changed = []
+            circuit_open = None
+
+            jobs = [_prepare_fetch(transaction) for transaction in batch]
+
+            for transaction, response, exc in executor.map(_fetch_transaction, jobs):
+                if exc is not None:
+                    result.failed += 1
+
+                    if isinstance(exc, CieloCircuitOpenError):
+                        circuit_open = exc
+                    else:
+                        logger.warning("Fail to sync Cielo transaction %s: %s", transaction.tid, exc)
+                    continue
+
+                result.fetched += 1
+                values = transaction._get_sync_values()
+                transaction.apply_transaction(response)
+
+                # só escreve o que mudou
+                if transaction._get_sync_values() != values:
+                    transaction.set_synced()
+                    changed.append(transaction)
+
+            result.updated += bulk_update_transactions(
+                changed, CieloTransaction.SYNC_FIELDS + CieloTransaction.SYNC_INFO_FIELDS
+            )
+
+            if circuit_open:
+                # o lote será refeito na próxima execução
+                raise circuit_open
+
+            result.last_pk = batch[-1].pk
+
+            if on_batch:
+                on_batch(result)
+
+    return result
+
+
+def parse_age(value):
+    """
+    Parses ages like `30m`, `12h` or `7d` (minutes when there is no unit)
+
+    :rtype: datetime.timedelta
+    """
+    units = {"m": "minutes", "h": "hours", "d": "days"}
+    value = value.strip().lower()
+
+    if value and value[-1] in units:
+        return timedelta(**{units[value[-1]]: int(value[:-1])})
+
+    return timedelta(minutes=int(value))
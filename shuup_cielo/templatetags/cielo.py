@@ -0,0 +1,53 @@
+# -*- coding: utf-8 -*-
+# This file is part of Shuup Cielo.
+#
+# Copyright (c) 2016, Rockho Team. All rights reserved.
+# Author: Christian Hess
+#
+# This source code is licensed under the AGPLv3 license found in the
+# LICENSE file in the root directory of this source tree.
+"""
+Template helpers for the storefront
+
+Example, for a product listing::
+
+    {% set offers = cielo_installment_offers(products|map(attribute="price")|list) %}
+    {% for product in products %}
+        {% set offer = offers[loop.index0] %}
+        {% if offer and offer.number > 1 %}
+            {{ offer.number }}x {{ request.shop.create_price(offer.installment_amount)|money }}
+        {% endif %}
+    {% endfor %}
+"""
+from __future__ import unicode_literals
+
+from django_jinja import library
+from jinja2.utils import contextfunction
+
+from shuup_cielo.config_cache import get_cielo_config
+from shuup_cielo.models import get_best_installment_offers
+
+
+@library.global_function
+@contextfunction
+def cielo_installment_offers(context, prices):
+    """
+    Returns the best installment offer (`InstallmentOffer` or None) for each price
+    """
+    prices = list(prices)
+    request = context.get("request")
+    cielo_config = get_cielo_config(request.shop) if request is not None else None
+
+    if not cielo_config:
+        return [None] * len(prices)
+
+    return get_best_installment_offers(prices, cielo_config)
+
+
+@library.global_function
+@contextfunction
+def cielo_installment_offer(context, price):
+    """
+    Returns the best installment offer (`InstallmentOffer` or None) for a single price
+    """
+    return cielo_installment_offers(context, [price])[0]
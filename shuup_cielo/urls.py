@@ -10,7 +10,10 @@
 from django.conf.urls import patterns, url
 from django.views.decorators.csrf import csrf_exempt
 
-from shuup_cielo.views import GetInstallmentsOptionsView, TransactionReturnView, TransactionView
+from shuup_cielo.views import (
+    GetInstallmentsOptionsView, NotificationView, TransactionReturnView, TransactionStatusView,
+    TransactionView
+)
 
 urlpatterns = patterns(
     '',
@@ -22,5 +25,12 @@ urlpatterns = patterns(
 
     url(r'^checkout/return/(?P<cielo_order_pk>\d+)/$',
         csrf_exempt(TransactionReturnView.as_view()),
-        name='cielo_transaction_return')
+        name='cielo_transaction_return'),
+
+    url(r'^checkout/status/(?P<cielo_order_pk>\d+)/$', TransactionStatusView.as_view(),
+        name='cielo_transaction_status'),
+
+    url(r'^cielo/notification/(?P<shop_pk>\d+)/(?P<token>\w+)/$',
+        csrf_exempt(NotificationView.as_view()),
+        name='cielo_notification')
 )
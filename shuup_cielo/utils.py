@@ -8,8 +8,15 @@
 # LICENSE file in the root directory of this source tree.
 from __future__ import division, unicode_literals
 
-from decimal import Decimal
-import math
+from decimal import Decimal, ROUND_HALF_UP
+import threading
+
+from shuup_cielo.constants import InterestType
+
+# tabelas de coeficientes já calculadas, por parâmetros de parcelamento
+_installment_tables = {}
+_installment_tables_lock = threading.Lock()
+INSTALLMENT_TABLES_MAX_SIZE = 128
 
 
 def is_cc_valid(cc_number):
@@ -41,9 +48,41 @@ def safe_int(num):
 
 def decimal_to_int_cents(amount):
     '''
-    Convert decimal (13.24) into cents (1324)
+    Convert decimal (13.24) into cents (1324), rounding half up
+    '''
+    return safe_int((Decimal(amount) * 100).quantize(Decimal(1), rounding=ROUND_HALF_UP))
+
+
+def cents_to_decimal(cents):
+    '''
+    Convert cents (1324) into decimal (13.24)
     '''
-    return safe_int(Decimal(amount) * 100)
+    return Decimal(safe_int(cents)).scaleb(-2)
+
+
+def get_basket_total(basket):
+    '''
+    Returns the basket taxful total, calculated once while the basket is unchanged
+
+    The total is kept in the basket object, so it lives for a single request,
+    and is tied to the processed lines cache of the basket: when the basket
+    changes, Shuup drops that cache and the total is calculated again.
+
+    :rtype: Decimal
+    '''
+    methods = (basket.payment_method_id, basket.shipping_method_id)
+    memo = basket.__dict__.get("_cielo_total_memo")
+
+    if memo and memo[0] is getattr(basket, "_processed_lines_cache", None) and memo[1] == methods:
+        return memo[2]
+
+    total = basket.taxful_total_price.value
+    lines_cache = getattr(basket, "_processed_lines_cache", None)
+
+    if lines_cache is not None:
+        basket._cielo_total_memo = (lines_cache, methods, total)
+
+    return total
 
 
 class InstallmentCalculator(object):
@@ -61,13 +100,24 @@ class InstallmentCalculator(object):
         :return: (total with interest, installment amount)
         '''
 
-        one = Decimal(1.0)
-        interest_rate = interest_rate / Decimal(100)
-        coefficient = interest_rate / (one - (one / Decimal(math.pow(one + interest_rate, installments))))
+        coefficient = InstallmentCalculator.price_coefficient(installments, interest_rate)
         installment_amount = (coefficient * amount)
 
         return (installment_amount * installments, installment_amount)
 
+    @staticmethod
+    def price_coefficient(installments, interest_rate):
+        '''
+        PRICE table coefficient: the installment amount for each unit financed
+
+        :type: installments: int
+        :type: interest_rate: Decimal
+        :rtype: Decimal
+        '''
+        one = Decimal(1)
+        interest_rate = Decimal(interest_rate) / Decimal(100)
+        return interest_rate / (one - (one / ((one + interest_rate) ** installments)))
+
     @staticmethod
     def simple_interest(amount, installments, interest_rate):
         '''
@@ -85,3 +135,43 @@ class InstallmentCalculator(object):
         total = amount + Decimal(amount * installments * interest_rate)
 
         return (total, total / installments)
+
+
+def get_installment_table(max_installments, installments_without_interest, interest_type, interest_rate):
+    '''
+    Returns the coefficients of every installment number up to `max_installments`
+
+    The table is calculated once for each set of parameters, so the
+    installments of any amount cost a multiplication per row.
+
+    :rtype: tuple[(int, Decimal)]
+    :return: (installment number, total coefficient) tuples
+    '''
+    interest_rate = Decimal(interest_rate)
+    key = (max_installments, installments_without_interest, interest_type, interest_rate)
+    table = _installment_tables.get(key)
+
+    if table is None:
+        rows = []
+
+        for installment in range(1, max_installments + 1):
+            # parcela sem juros
+            if installment <= installments_without_interest or interest_rate <= Decimal(0):
+                total_coefficient = Decimal(1)
+
+            elif interest_type == InterestType.Simple:
+                total_coefficient = Decimal(1) + installment * interest_rate / Decimal(100)
+
+            else:
+                total_coefficient = InstallmentCalculator.price_coefficient(installment, interest_rate) * installment
+
+            rows.append((installment, total_coefficient))
+
+        table = tuple(rows)
+
+        with _installment_tables_lock:
+            if len(_installment_tables) >= INSTALLMENT_TABLES_MAX_SIZE:
+                _installment_tables.clear()
+            _installment_tables[key] = table
+
+    return table
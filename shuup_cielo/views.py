@@ -8,13 +8,21 @@
 # LICENSE file in the root directory of this source tree.
 
 from decimal import Decimal
+import hashlib
 import logging
-import time
+import threading
 
 from django.contrib import messages
+from django.core.cache import cache
 from django.core.urlresolvers import reverse
-from django.http.response import HttpResponseBadRequest, HttpResponseRedirect, JsonResponse
-from django.utils.formats import localize
+from django.http.response import (
+    HttpResponse, HttpResponseBadRequest, HttpResponseForbidden, HttpResponseNotFound,
+    HttpResponseNotModified, HttpResponseRedirect, JsonResponse
+)
+from django.shortcuts import render
+from django.utils.cache import patch_cache_control, patch_vary_headers
+from django.utils.crypto import constant_time_compare
+from django.utils.encoding import force_bytes
 from django.utils.timezone import now
 from django.utils.translation import ugettext as _p
 from django.utils.translation import ugettext_lazy as _
@@ -22,49 +30,85 @@ from django.views.generic.base import View
 from django.views.generic.edit import BaseFormView
 
 from cielo_webservice.exceptions import CieloRequestError
-from cielo_webservice.models import Cartao, Comercial, Pagamento, Pedido, Transacao
-from cielo_webservice.request import CieloRequest
-from shuup.utils.i18n import format_money
+from cielo_webservice.models import Cartao, Comercial, Pagamento, Pedido, Transacao, xml_to_object
 from shuup.utils.importing import cached_load, load
+from shuup_cielo.client import get_cielo_client
+from shuup_cielo.config_cache import get_cielo_config
 from shuup_cielo.constants import (
     CIELO_AUTHORIZED_STATUSES, CIELO_SERVICE_CREDIT, CIELO_UKNOWN_ERROR_MSG, CieloAuthorizationCode,
-    CieloProduct, CieloProductMatrix, CieloTransactionStatus,
-    INSTALLMENT_CHOICE_WITH_INTEREST_STRING, INSTALLMENT_CHOICE_WITHOUT_INTEREST_STRING
+    CieloProduct, CieloProductMatrix, CieloSyncSource
 )
+from shuup_cielo.exceptions import CieloCircuitOpenError, CieloTimeoutError
 from shuup_cielo.forms import CieloPaymentForm
+from shuup_cielo.installments import (
+    get_basket_service, get_installment_options, get_installments_matrix, get_installments_state
+)
 from shuup_cielo.models import CieloOrderTransaction, CieloTransaction, InstallmentContext
-from shuup_cielo.utils import decimal_to_int_cents, safe_int
+from shuup_cielo.status import (
+    get_status_poll_interval, get_status_poll_timeout, get_transaction_status, is_pending_status,
+    set_notified_status
+)
+from shuup_cielo.utils import decimal_to_int_cents, get_basket_total, safe_int
 from shuup.front.checkout._storage import CheckoutPhaseStorage
 
 logger = logging.getLogger(__name__)
 
+# por quanto tempo, em segundos, uma notificação repetida é ignorada
+CIELO_NOTIFICATION_DEDUPLICATION_TIMEOUT = 60 * 60 * 24
+
+
+# (src key, destination key) pair
+BASKET_SEARCH_KEYS = (
+    ('payment_method_id', 'payment_method_id'),
+    ('shipping_method_id', 'shipping_method_id'),
+    ('shipping', 'shipping_address'),
+    ('shipping_extra', 'shipping_address_extra'),
+    ('payment', 'payment_address'),
+    ('payment_extra', 'payment_address_extra'),
+)
+
+# identificadores das fases do checkout, resolvidos uma vez por processo
+_checkout_phases = {}
+_checkout_phases_lock = threading.Lock()
+
+
+def _get_checkout_phase_identifiers():
+    view_spec = cached_load("SHUUP_CHECKOUT_VIEW_SPEC")
+    phase_identifiers = _checkout_phases.get(id(view_spec))
+
+    if phase_identifiers is None:
+        phase_identifiers = tuple(load(phase).identifier for phase in view_spec.phase_specs)
+
+        with _checkout_phases_lock:
+            _checkout_phases.clear()
+            _checkout_phases[id(view_spec)] = phase_identifiers
+
+    return phase_identifiers
+
 
 def _configure_basket(request):
     """
     Search for some needed keys in the checkout phases storages
-    """
 
-    # (src key, destination key) pair
-    search_keys = [
-        ('payment_method_id', 'payment_method_id'),
-        ('shipping_method_id', 'shipping_method_id'),
-        ('shipping', 'shipping_address'),
-        ('shipping_extra', 'shipping_address_extra'),
-        ('payment', 'payment_address'),
-        ('payment_extra', 'payment_address_extra'),
-    ]
-
-    for phase in cached_load("SHUUP_CHECKOUT_VIEW_SPEC").phase_specs:
-        phase_class = load(phase)
+    When a key is in more than one phase, the last phase wins. The phases
+    are looked up from the last one, so the search stops at the first hit.
+    """
+    phase_identifiers = _get_checkout_phase_identifiers()
+    storages = {}
 
-        storage = CheckoutPhaseStorage(request, phase_class.identifier)
+    def get_storage(phase_identifier):
+        if phase_identifier not in storages:
+            storages[phase_identifier] = CheckoutPhaseStorage(request, phase_identifier)
+        return storages[phase_identifier]
 
-        for key, dst_key in search_keys:
-            value = storage.get(key)
+    for key, dst_key in BASKET_SEARCH_KEYS:
+        for phase_identifier in reversed(phase_identifiers):
+            value = get_storage(phase_identifier).get(key)
 
             # key found, set it to request.basket on dst_key
             if value:
                 setattr(request.basket, dst_key, value)
+                break
 
 
 class GetInstallmentsOptionsView(View):
@@ -74,11 +118,14 @@ class GetInstallmentsOptionsView(View):
 
     def get(self, request, *args, **kwargs):
         cc_brand = request.GET.get("cc_brand", "").lower()
+        all_brands = bool(request.GET.get("all"))
 
-        if not cc_brand:
+        if not cc_brand and not all_brands:
             return HttpResponseBadRequest()
 
-        if not hasattr(request.shop, "cielo_config"):
+        cielo_config = get_cielo_config(request.shop)
+
+        if not cielo_config:
             logger.error("CieloConfig not configured for {0} shop".format(request.shop))
             return HttpResponseBadRequest()
 
@@ -86,56 +133,42 @@ class GetInstallmentsOptionsView(View):
             # populate the basket with all the checkout stuff
             _configure_basket(request)
 
-            basket_total = request.basket.taxful_total_price.value
+            basket_total = get_basket_total(request.basket)
         except:
             logger.exception("Basket total is not valid")
             return HttpResponseBadRequest()
 
-        installments = []
-
-        FALLBACK_INSTALLMENT = {
-            "number": 1,
-            "name": INSTALLMENT_CHOICE_WITHOUT_INTEREST_STRING.format(
-                1,
-                format_money(request.basket.create_price(basket_total)),
-                format_money(request.basket.create_price(basket_total)),
-                localize(Decimal())
-            )
-        }
-
-        # if it is a credit card service and the brand allows installments..
-        if CieloProductMatrix.get(cc_brand, {}).get(CieloProduct.InstallmentCredit):
-
-            try:
-                context = InstallmentContext(basket_total, request.shop.cielo_config)
-                interest_rate = request.shop.cielo_config.interest_rate
-
-                for choice in context.get_intallments_choices():
+        # as opções só mudam com o total, a bandeira (ou o serviço, para todas elas),
+        # a configuração ou o idioma
+        if all_brands:
+            state = get_installments_state(request.basket, basket_total, cielo_config,
+                                           "all", get_basket_service(request.basket))
+        else:
+            state = get_installments_state(request.basket, basket_total, cielo_config, cc_brand)
 
-                    # if installment has interest
-                    if choice[3] > 0:
-                        name = INSTALLMENT_CHOICE_WITH_INTEREST_STRING.format(
-                            choice[0],
-                            format_money(request.basket.create_price(choice[1])),
-                            format_money(request.basket.create_price(choice[2])),
-                            localize(interest_rate)
-                        )
-                    else:
-                        name = INSTALLMENT_CHOICE_WITHOUT_INTEREST_STRING.format(
-                            choice[0],
-                            format_money(request.basket.create_price(choice[1])),
-                            format_money(request.basket.create_price(choice[2]))
-                        )
+        etag = '"{0}"'.format(state)
 
-                    installments.append({"number": choice[0], "name": name})
+        if etag in request.META.get("HTTP_IF_NONE_MATCH", ""):
+            return self._set_cache_headers(HttpResponseNotModified(), etag)
 
-            except:
-                logger.exception("Failed to calculate installments for basket {0}".format(request.basket))
+        # todas as bandeiras de uma vez
+        if all_brands:
+            matrix = get_installments_matrix(request.basket, basket_total, cielo_config)
+            return self._set_cache_headers(JsonResponse(matrix), etag)
 
-        if len(installments) == 0:
-            installments.append(FALLBACK_INSTALLMENT)
+        # if it is a credit card service and the brand allows installments..
+        installments = get_installment_options(
+            request.basket, basket_total, cielo_config,
+            allow_installments=CieloProductMatrix.get(cc_brand, {}).get(CieloProduct.InstallmentCredit)
+        )
+        return self._set_cache_headers(JsonResponse({"installments": installments}), etag)
 
-        return JsonResponse({"installments": installments})
+    def _set_cache_headers(self, response, etag):
+        # a resposta depende do carrinho da sessão: o navegador guarda, mas sempre revalida
+        response["ETag"] = etag
+        patch_cache_control(response, private=True, max_age=0, must_revalidate=True)
+        patch_vary_headers(response, ("Cookie", "Accept-Language"))
+        return response
 
 
 class TransactionView(BaseFormView):
@@ -149,16 +182,12 @@ class TransactionView(BaseFormView):
 
     def form_valid(self, form):
         # verifica se existe alguma transação pendente na sessão
-        # se sim, cancela a autorização antiga para fazer uma nova
-        if self.request.cielo.transaction:
-            try:
-                self.request.cielo.transaction.safe_cancel(self.request.cielo.transaction.total_value)
-            except:
-                logger.exception(_("Failed to cancel old Cielo transaction"))
+        # se sim, agenda o cancelamento da autorização antiga para fazer uma nova
+        self.request.cielo.rollback()
 
         # populate the basket with all the checkout stuff
         _configure_basket(self.request)
-        order_total = self.request.basket.taxful_total_price.value
+        order_total = get_basket_total(self.request.basket)
         service = self.request.basket.payment_method.choice_identifier
 
         cc_info = form.cleaned_data
@@ -166,7 +195,7 @@ class TransactionView(BaseFormView):
         interest_amount = Decimal()
         installments = safe_int(cc_info['installments'])
 
-        cielo_config = self.request.shop.cielo_config
+        cielo_config = get_cielo_config(self.request.shop)
 
         produto = CieloProduct.Credit
 
@@ -199,8 +228,9 @@ class TransactionView(BaseFormView):
                         codigo_seguranca=safe_int(cc_info['cc_security_code']),
                         nome_portador=cc_info['cc_holder'])
 
+        total_cents = decimal_to_int_cents(transaction_total)
         pedido = Pedido(numero="{0}".format(cielo_order.pk),
-                        valor=decimal_to_int_cents(transaction_total),
+                        valor=total_cents,
                         moeda=986,  # Fixo
                         data_hora=now().isoformat())
 
@@ -220,7 +250,7 @@ class TransactionView(BaseFormView):
                               capturar=cielo_config.auto_capture,
                               url_retorno=return_url)
 
-        cielo_request = CieloRequest(sandbox=cielo_config.sandbox)
+        cielo_request = get_cielo_client(cielo_config)
 
         # base response data
         response_data = {"success": False}
@@ -229,16 +259,20 @@ class TransactionView(BaseFormView):
         try:
             response_transaction = cielo_request.autorizar(transacao=transacao)
 
-            cielo_transaction = CieloTransaction.objects.create(shop=self.request.shop,
-                                                                order_transaction=cielo_order,
-                                                                tid=response_transaction.tid,
-                                                                status=response_transaction.status,
-                                                                total_value=transaction_total,
-                                                                cc_holder=cc_info['cc_holder'],
-                                                                cc_brand=cc_info['cc_brand'],
-                                                                cc_product=produto,
-                                                                installments=installments,
-                                                                interest_value=interest_amount)
+            cielo_transaction = CieloTransaction(shop=self.request.shop,
+                                                 order_transaction=cielo_order,
+                                                 tid=response_transaction.tid,
+                                                 status=response_transaction.status,
+                                                 currency=self.request.basket.currency,
+                                                 total_cents=total_cents,
+                                                 cc_holder=cc_info['cc_holder'],
+                                                 cc_brand=cc_info['cc_brand'],
+                                                 cc_product=produto,
+                                                 installments=installments,
+                                                 interest_cents=decimal_to_int_cents(interest_amount))
+
+            # a resposta da autorização já traz o estado completo da transação
+            cielo_transaction._update_from_transaction(response_transaction, CieloSyncSource.Authorization)
 
             # se existe uma URL para autenticacao, vamos redirecionar primeiro
             if response_transaction.url_autenticacao:
@@ -266,6 +300,16 @@ class TransactionView(BaseFormView):
                 response_data["success"] = False
                 response_data["error"] = _p("Transaction not authorized: {0}").format(CIELO_UKNOWN_ERROR_MSG)
 
+        except CieloCircuitOpenError:
+            response_data["success"] = False
+            response_data["error"] = _p("The payment gateway is unavailable. Please, try again in a few minutes.")
+            logger.warning("Cielo transaction not made: the circuit breaker is open.")
+
+        except CieloTimeoutError:
+            response_data["success"] = False
+            response_data["error"] = _p("The payment gateway is taking too long to respond. Please, try again.")
+            logger.exception(_("Cielo transaction timeout."))
+
         except CieloRequestError:
             response_data["success"] = False
             response_data["error"] = _p("Internal error")
@@ -306,16 +350,17 @@ class TransactionReturnView(View):
             messages.error(request, _("Payment not identified. Old transactions were also cancelled."))
             return HttpResponseRedirect(reverse("shuup:checkout", kwargs={"phase": "payment"}))
 
-        cielo_transaction.refresh()
+        status = get_transaction_status(cielo_transaction)
 
-        max_tries = 3
-        tries = 0
-        # aguarda uma transação mudar de estado -> de autenticando para qualquer outra coisa
-        # pois ainda não temos o estado da autorização
-        while cielo_transaction.status == CieloTransactionStatus.Authenticating and tries <= max_tries:
-            cielo_transaction.refresh()
-            tries = tries + 1
-            time.sleep(0.1)
+        # a autorização ainda não terminou: em vez de prender o worker aguardando,
+        # responde uma página que consulta o estado da transação aos poucos
+        if is_pending_status(status) and not request.GET.get("final"):
+            return render(request, "cielo/confirming.jinja", {
+                "status_url": reverse("shuup:cielo_transaction_status", kwargs={"cielo_order_pk": cielo_order.pk}),
+                "return_url": request.path,
+                "poll_interval": get_status_poll_interval(),
+                "poll_timeout": get_status_poll_timeout(),
+            })
 
         # not authorized, clean data
         if cielo_transaction.authorization_lr not in CIELO_AUTHORIZED_STATUSES:
@@ -330,3 +375,74 @@ class TransactionReturnView(View):
         # se tudo deu certo, vamos para o fim direto
         messages.success(request, _("Transaction authorized."))
         return HttpResponseRedirect(reverse("shuup:checkout", kwargs={"phase": "confirm"}))
+
+
+class TransactionStatusView(View):
+    """
+    Returns the status of the current transaction, polled by the confirming page
+    """
+
+    def get(self, request, **kwargs):
+        cielo_order = self.request.cielo.order_transaction
+        cielo_transaction = self.request.cielo.transaction
+
+        if not cielo_order or not cielo_transaction or not cielo_order.pk == safe_int(kwargs['cielo_order_pk']):
+            return JsonResponse({"error": _p("Payment not identified.")}, status=404)
+
+        status = get_transaction_status(cielo_transaction)
+        return JsonResponse({"status": status.value, "pending": is_pending_status(status)})
+
+
+class NotificationView(View):
+    """
+    Receives the transaction status posted by Cielo
+
+    The message has the same `<transacao>` format of the `consultar` response,
+    so the transaction is updated without querying Cielo back.
+    """
+
+    def post(self, request, **kwargs):
+        cielo_config = get_cielo_config(safe_int(kwargs['shop_pk']))
+
+        if not cielo_config or not constant_time_compare(kwargs['token'], cielo_config.get_notification_token()):
+            return HttpResponseForbidden()
+
+        message = request.POST.get('mensagem') or request.body
+
+        try:
+            response_transaction = xml_to_object(message)
+        except Exception:
+            logger.warning("Invalid Cielo notification received")
+            return HttpResponseBadRequest()
+
+        if not isinstance(response_transaction, Transacao) or not response_transaction.tid:
+            return HttpResponseBadRequest()
+
+        cielo_transaction = CieloTransaction.objects.filter(shop_id=cielo_config.shop_id,
+                                                            tid=response_transaction.tid).first()
+
+        if not cielo_transaction:
+            return HttpResponseNotFound()
+
+        # a notificação deve ser do mesmo pedido e valor
+        pedido = response_transaction.pedido
+        if not pedido or (pedido.numero != "{0}".format(cielo_transaction.order_transaction_id) or
+                          safe_int(pedido.valor) != cielo_transaction.total_cents):
+            logger.warning("Cielo notification does not match transaction {0}".format(cielo_transaction.tid))
+            return HttpResponseBadRequest()
+
+        # a Cielo pode repetir a mesma notificação
+        deduplication_key = "cielo_notification:{0}".format(hashlib.sha1(force_bytes(message)).hexdigest())
+
+        if not cache.add(deduplication_key, 1, timeout=CIELO_NOTIFICATION_DEDUPLICATION_TIMEOUT):
+            return HttpResponse("OK")
+
+        try:
+            cielo_transaction._update_from_transaction(response_transaction, CieloSyncSource.Notification)
+        except Exception:
+            # permite que a Cielo envie novamente
+            cache.delete(deduplication_key)
+            raise
+
+        set_notified_status(cielo_transaction)
+        return HttpResponse("OK")
@@ -9,6 +9,7 @@
 from __future__ import unicode_literals
 
 from decimal import Decimal
+import uuid
 
 from django.utils.timezone import now
 
@@ -59,6 +60,19 @@ CC_MASTER_1X_INFO = {
 }
 
 
+def create_cielo_transaction(status=CieloTransactionStatus.InProgress, tid=None, total=Decimal(10), **kwargs):
+    # este pacote é carregado junto com as settings, antes dos modelos
+    from shuup.testing.factories import get_default_shop
+    from shuup_cielo.models import CieloOrderTransaction, CieloTransaction
+
+    return CieloTransaction.objects.create(shop=get_default_shop(),
+                                           order_transaction=CieloOrderTransaction.objects.create(),
+                                           tid=tid or uuid.uuid4().hex,
+                                           status=status,
+                                           total_value=total,
+                                           **kwargs)
+
+
 def get_in_progress_transaction(numero=1, valor="", produto="", bandeira="", parcelas=1, tid="", return_url=AUTH_URL):
     return Transacao(
         pedido=dict_to_pedido({'numero':str(numero),
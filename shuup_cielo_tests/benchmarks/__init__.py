@@ -0,0 +1,322 @@
+# -*- coding: utf-8 -*-
+# This file is part of Shuup Cielo.
+#
+# Copyright (c) 2016, Rockho Team. All rights reserved.
+# Author: Christian Hess
+#
+# This source code is licensed under the AGPLv3 license found in the
+# LICENSE file in the root directory of this source tree.
+"""
+Checkout payment benchmarks
+
+The benchmarks are skipped unless ``CIELO_BENCHMARK=1`` is set::
+
+    CIELO_BENCHMARK=1 py.test -s shuup_cielo_tests/benchmarks
+
+Environment variables:
+
+* ``CIELO_BENCHMARK_ITERATIONS``: measured checkouts (default 20)
+* ``CIELO_BENCHMARK_LATENCY``: Cielo stand-in latency, e.g. ``lognormal:0.2,0.5``
+  (default: no latency, so only the local overhead is measured)
+* ``CIELO_BENCHMARK_BASELINE``: baseline file (default ``baseline.json`` in this directory);
+  it is written by the first run and every run after that is compared against it
+* ``CIELO_BENCHMARK_UPDATE=1``: replaces the baseline with the current run
+* ``CIELO_BENCHMARK_TOLERANCE``: allowed relative slowdown (default 0.25)
+"""
+from __future__ import unicode_literals
+
+from collections import defaultdict, OrderedDict
+from contextlib import contextmanager
+import cProfile
+from importlib import import_module
+import io
+import json
+import math
+import os
+import pstats
+import time
+
+from django.conf import settings
+from django.db import connection
+from django.test.utils import CaptureQueriesContext
+from mock import patch
+
+try:
+    import tracemalloc
+except ImportError:  # Python 2
+    tracemalloc = None
+
+timer = getattr(time, "perf_counter", time.time)
+
+BENCHMARK_DIR = os.path.dirname(os.path.abspath(__file__))
+DEFAULT_BASELINE_PATH = os.path.join(BENCHMARK_DIR, "baseline.json")
+DEFAULT_TOLERANCE = 0.25
+
+# diferenças menores que isso (ms) são ruído
+LATENCY_NOISE_MS = 2.0
+
+# pacotes usados para dividir o tempo de CPU de cada etapa
+PROFILE_PACKAGES = ("shuup_cielo", "cielo_webservice", "requests", "shuup", "django")
+
+
+def percentile(values, percent):
+    """
+    Nearest-rank percentile
+    """
+    ordered = sorted(values)
+
+    if not ordered:
+        return 0.0
+
+    index = int(math.ceil(percent / 100.0 * len(ordered))) - 1
+    return ordered[max(index, 0)]
+
+
+def _ms(seconds):
+    return round(seconds * 1000.0, 3)
+
+
+def _get_package_dirs():
+    package_dirs = []
+
+    for name in PROFILE_PACKAGES:
+        try:
+            module = import_module(name)
+        except ImportError:
+            continue
+        package_dirs.append((name, os.path.dirname(os.path.abspath(module.__file__)) + os.sep))
+
+    # os diretórios mais específicos primeiro
+    return sorted(package_dirs, key=lambda item: len(item[1]), reverse=True)
+
+
+class StepStats(object):
+    def __init__(self, name):
+        self.name = name
+        self.durations = []
+        self.gateway = []
+        self.queries = []
+        self.session_writes = []
+        self.hooks = defaultdict(list)
+        self.allocated_kb = None
+        self.peak_kb = None
+        self.breakdown = None
+
+    def summary(self):
+        summary = OrderedDict([
+            ("iterations", len(self.durations)),
+            ("p50_ms", _ms(percentile(self.durations, 50))),
+            ("p95_ms", _ms(percentile(self.durations, 95))),
+            ("p99_ms", _ms(percentile(self.durations, 99))),
+            ("gateway_p50_ms", _ms(percentile(self.gateway, 50))),
+            ("queries", max(self.queries) if self.queries else 0),
+            ("session_writes", max(self.session_writes) if self.session_writes else 0),
+            ("hooks_p50_ms", OrderedDict((name, _ms(percentile(values, 50)))
+                                         for name, values in sorted(self.hooks.items()))),
+            ("allocated_kb", self.allocated_kb),
+            ("peak_kb", self.peak_kb),
+            ("cpu_breakdown_pct", self.breakdown),
+        ])
+        return summary
+
+
+class CheckoutBenchmark(object):
+    """
+    Collects the metrics of each checkout step
+
+    :param hooks: list of `(name, class, method name)` whose
+        time is also measured inside each step
+    :param gateway: `(class, method name)` of the gateway call
+    """
+
+    def __init__(self, hooks=(), gateway=None):
+        self.hooks = hooks
+        self.gateway = gateway
+        self.steps = OrderedDict()
+
+    def _get_step(self, name):
+        if name not in self.steps:
+            self.steps[name] = StepStats(name)
+        return self.steps[name]
+
+    @contextmanager
+    def _instrument(self, counters):
+        patchers = []
+
+        def timed(key, original):
+            def wrapper(*args, **kwargs):
+                start = timer()
+                try:
+                    return original(*args, **kwargs)
+                finally:
+                    counters[key] += timer() - start
+            return wrapper
+
+        for name, klass, method_name in self.hooks:
+            patchers.append(patch.object(klass, method_name, timed(name, getattr(klass, method_name))))
+
+        if self.gateway:
+            klass, method_name = self.gateway
+            patchers.append(patch.object(klass, method_name, timed("gateway", getattr(klass, method_name))))
+
+        session_store = import_module(settings.SESSION_ENGINE).SessionStore
+        original_save = session_store.save
+
+        def save(*args, **kwargs):
+            counters["session_writes"] += 1
+            return original_save(*args, **kwargs)
+
+        patchers.append(patch.object(session_store, "save", save))
+
+        for patcher in patchers:
+            patcher.start()
+        try:
+            yield
+        finally:
+            for patcher in reversed(patchers):
+                patcher.stop()
+
+    @contextmanager
+    def measure(self, name):
+        """
+        Measures latency, queries, session writes, gateway and hook times
+        """
+        stats = self._get_step(name)
+        counters = defaultdict(float)
+
+        with self._instrument(counters), CaptureQueriesContext(connection) as queries:
+            start = timer()
+            yield
+            elapsed = timer() - start
+
+        stats.durations.append(elapsed)
+        stats.gateway.append(counters.pop("gateway", 0.0))
+        stats.session_writes.append(int(counters.pop("session_writes", 0)))
+        stats.queries.append(len(queries))
+
+        for hook_name, _, _ in self.hooks:
+            stats.hooks[hook_name].append(counters.get(hook_name, 0.0))
+
+    @contextmanager
+    def trace_allocations(self, name):
+        """
+        Measures the memory allocated by the step (Python 3 only)
+        """
+        if tracemalloc is None:
+            yield
+            return
+
+        stats = self._get_step(name)
+        tracemalloc.start()
+        try:
+            yield
+            current, peak = tracemalloc.get_traced_memory()
+        finally:
+            tracemalloc.stop()
+
+        stats.allocated_kb = round(current / 1024.0, 1)
+        stats.peak_kb = round(peak / 1024.0, 1)
+
+    @contextmanager
+    def profile(self, name):
+        """
+        Splits the CPU time of the step by package
+        """
+        stats = self._get_step(name)
+        profiler = cProfile.Profile()
+        profiler.enable()
+        try:
+            yield
+        finally:
+            profiler.disable()
+
+        package_dirs = _get_package_dirs()
+        totals = defaultdict(float)
+
+        for (filename, _, _), (_, _, own_time, _, _) in pstats.Stats(profiler).stats.items():
+            category = "other"
+            for package, package_dir in package_dirs:
+                if os.path.abspath(filename).startswith(package_dir):
+                    category = package
+                    break
+            totals[category] += own_time
+
+        total = sum(totals.values()) or 1.0
+        stats.breakdown = OrderedDict((category, round(100.0 * totals[category] / total, 1))
+                                      for category in sorted(totals, key=totals.get, reverse=True))
+
+    def summary(self):
+        return OrderedDict((name, stats.summary()) for name, stats in self.steps.items())
+
+
+def format_report(summary, regressions=()):
+    lines = ["{0:<18}{1:>10}{2:>10}{3:>10}{4:>12}{5:>9}{6:>10}{7:>11}{8:>14}".format(
+        "step", "p50 ms", "p95 ms", "p99 ms", "gateway ms", "queries", "sessions", "alloc KB", "shuup_cielo %")]
+
+    for name, step in summary.items():
+        breakdown = step["cpu_breakdown_pct"] or {}
+        lines.append("{0:<18}{1:>10.2f}{2:>10.2f}{3:>10.2f}{4:>12.2f}{5:>9}{6:>10}{7:>11}{8:>14}".format(
+            name, step["p50_ms"], step["p95_ms"], step["p99_ms"], step["gateway_p50_ms"], step["queries"],
+            step["session_writes"], step["allocated_kb"] if step["allocated_kb"] is not None else "-",
+            breakdown.get("shuup_cielo", "-")))
+
+        for hook_name, hook_time in step["hooks_p50_ms"].items():
+            if hook_time:
+                lines.append("    {0}: {1:.2f} ms".format(hook_name, hook_time))
+
+        if breakdown:
+            lines.append("    cpu: {0}".format(", ".join(
+                "{0} {1}%".format(category, pct) for category, pct in breakdown.items())))
+
+    for regression in regressions:
+        lines.append("REGRESSION: {0}".format(regression))
+
+    return "\n".join(lines)
+
+
+def compare_with_baseline(summary, baseline, tolerance=DEFAULT_TOLERANCE):
+    """
+    :return: the list of regressions found
+    :rtype: list[str]
+    """
+    regressions = []
+
+    for name, step in summary.items():
+        base = baseline.get(name)
+
+        if not base:
+            continue
+
+        for key in ("p50_ms", "p95_ms"):
+            if step[key] > base[key] * (1 + tolerance) and step[key] - base[key] > LATENCY_NOISE_MS:
+                regressions.append("{0} {1}: {2:.2f} > {3:.2f}".format(name, key, step[key], base[key]))
+
+        for key in ("queries", "session_writes"):
+            if step[key] > base[key]:
+                regressions.append("{0} {1}: {2} > {3}".format(name, key, step[key], base[key]))
+
+        if step["peak_kb"] and base.get("peak_kb") and step["peak_kb"] > base["peak_kb"] * (1 + tolerance):
+            regressions.append("{0} peak_kb: {1} > {2}".format(name, step["peak_kb"], base["peak_kb"]))
+
+    return regressions
+
+
+def check_baseline(summary):
+    """
+    Compares `summary` with the stored baseline, writing it when missing
+
+    :return: the list of regressions found
+    :rtype: list[str]
+    """
+    path = os.environ.get("CIELO_BENCHMARK_BASELINE", DEFAULT_BASELINE_PATH)
+    tolerance = float(os.environ.get("CIELO_BENCHMARK_TOLERANCE", DEFAULT_TOLERANCE))
+
+    if os.path.exists(path) and not os.environ.get("CIELO_BENCHMARK_UPDATE"):
+        with io.open(path, encoding="utf-8") as baseline_file:
+            baseline = json.load(baseline_file, object_pairs_hook=OrderedDict)
+        return compare_with_baseline(summary, baseline["steps"], tolerance)
+
+    with io.open(path, "w", encoding="utf-8") as baseline_file:
+        baseline_file.write("{0}".format(json.dumps({"steps": summary}, indent=2)))
+
+    return []
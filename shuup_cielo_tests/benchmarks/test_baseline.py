@@ -0,0 +1,41 @@
+# -*- coding: utf-8 -*-
+# This file is part of Shuup Cielo.
+#
+# Copyright (c) 2016, Rockho Team. All rights reserved.
+# Author: Christian Hess
+#
+# This source code is licensed under the AGPLv3 license found in the
+# LICENSE file in the root directory of this source tree.
+from __future__ import unicode_literals
+
+from shuup_cielo_tests.benchmarks import compare_with_baseline, percentile
+
+
+def get_step(p50_ms=10.0, p95_ms=20.0, queries=5, session_writes=1, peak_kb=100.0):
+    return {"p50_ms": p50_ms, "p95_ms": p95_ms, "queries": queries,
+            "session_writes": session_writes, "peak_kb": peak_kb}
+
+
+def test_percentile():
+    values = list(range(1, 101))
+    assert percentile(values, 50) == 50
+    assert percentile(values, 95) == 95
+    assert percentile(values, 99) == 99
+    assert percentile([3], 99) == 3
+    assert percentile([], 50) == 0.0
+
+
+def test_compare_with_baseline():
+    baseline = {"transaction": get_step()}
+
+    # dentro da tolerância e do ruído
+    assert compare_with_baseline({"transaction": get_step(p50_ms=11.0, p95_ms=21.0)}, baseline) == []
+    assert compare_with_baseline({"transaction": get_step(p50_ms=12.5)}, baseline) == []
+
+    # etapas novas não são comparadas
+    assert compare_with_baseline({"return": get_step(queries=50)}, baseline) == []
+
+    regressions = compare_with_baseline({"transaction": get_step(p95_ms=40.0, queries=6, session_writes=2,
+                                                                 peak_kb=200.0)}, baseline)
+    assert len(regressions) == 4
+    assert "transaction p95_ms: 40.00 > 20.00" in regressions
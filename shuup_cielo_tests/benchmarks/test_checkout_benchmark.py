@@ -0,0 +1,166 @@
+# -*- coding: utf-8 -*-
+# This file is part of Shuup Cielo.
+#
+# Copyright (c) 2016, Rockho Team. All rights reserved.
+# Author: Christian Hess
+#
+# This source code is licensed under the AGPLv3 license found in the
+# LICENSE file in the root directory of this source tree.
+from __future__ import unicode_literals
+
+from contextlib import contextmanager
+import json
+import os
+
+from bs4 import BeautifulSoup
+from django.core.cache import cache
+from django.core.urlresolvers import reverse
+import pytest
+import requests
+
+from shuup.core.defaults.order_statuses import create_default_order_statuses
+from shuup.core.models._orders import Order
+from shuup.core.models._product_shops import ShopProduct
+from shuup.testing.factories import (
+    get_default_product, get_default_shipping_method, get_default_shop, get_default_supplier,
+    get_default_tax_class
+)
+from shuup.testing.mock_population import populate_if_required
+from shuup.testing.soup_utils import extract_form_fields
+from shuup.xtheme._theme import set_current_theme
+from shuup_cielo.checkout import CieloCheckoutPhase
+from shuup_cielo.client import CieloClient, clear_cielo_requests
+from shuup_cielo.constants import CIELO_SERVICE_CREDIT, CieloCardBrand
+from shuup_cielo.models import CieloPaymentProcessor
+from shuup_cielo_tests import CC_VISA_1X_INFO, PRODUCT_PRICE
+from shuup_cielo_tests.benchmarks import check_baseline, CheckoutBenchmark, format_report
+from shuup_cielo_tests.cielo_server import CieloStandIn, parse_latency
+from shuup_cielo_tests.test_checkout import get_cielo_config, get_payment_provider
+from shuup_tests.front.test_checkout_flow import fill_address_inputs
+from shuup_tests.utils import SmartClient
+
+pytestmark = pytest.mark.skipif(not os.environ.get("CIELO_BENCHMARK"),
+                                reason="Benchmarks run only with CIELO_BENCHMARK=1")
+
+ITERATIONS = int(os.environ.get("CIELO_BENCHMARK_ITERATIONS", 20))
+
+HOOKS = (
+    ("phase.is_valid", CieloCheckoutPhase, "is_valid"),
+    ("phase.process", CieloCheckoutPhase, "process"),
+    ("processor.get_payment_process_response", CieloPaymentProcessor, "get_payment_process_response"),
+)
+
+
+@contextmanager
+def not_measured(name):
+    yield
+
+
+def initialize():
+    get_default_shop()
+    get_cielo_config()
+    set_current_theme('shuup.themes.classic_gray')
+    create_default_order_statuses()
+    populate_if_required()
+
+    sp = ShopProduct.objects.get(product=get_default_product(), shop=get_default_shop())
+    sp.default_price = get_default_shop().create_price(PRODUCT_PRICE)
+    sp.save()
+
+    payment_method = get_payment_provider().create_service(
+        CIELO_SERVICE_CREDIT,
+        identifier="cielo_phase_cc",
+        shop=get_default_shop(),
+        name="credit card",
+        enabled=True,
+        tax_class=get_default_tax_class())
+
+    return payment_method, get_default_shipping_method()
+
+
+def run_checkout(step, payment_method, shipping_method):
+    """
+    Runs one checkout; `step` wraps each part of the payment path
+    """
+    client = SmartClient()
+
+    # carrinho, endereços e métodos não são medidos
+    client.post(reverse("shuup:basket"), data={
+        "command": "add",
+        "product_id": get_default_product().pk,
+        "quantity": 1,
+        "supplier": get_default_supplier().pk
+    })
+    addresses_path = reverse("shuup:checkout", kwargs={"phase": "addresses"})
+    client.post(addresses_path, data=fill_address_inputs(client.soup(addresses_path), with_company=False))
+    client.post(reverse("shuup:checkout", kwargs={"phase": "methods"}),
+                data={"payment_method": payment_method.pk, "shipping_method": shipping_method.pk})
+
+    with step("installments"):
+        response = client.get(reverse("shuup:cielo_get_installment_options"), {"cc_brand": CieloCardBrand.Visa})
+    assert response.status_code == 200
+
+    with step("transaction"):
+        response = client.post(reverse("shuup:cielo_make_transaction"), CC_VISA_1X_INFO)
+    assert response.status_code == 200
+    redirect_url = json.loads(response.content.decode("utf-8"))["redirect_url"]
+
+    # o portador autentica na Cielo (fora da loja)
+    return_url = requests.get(redirect_url, allow_redirects=False).headers["Location"]
+
+    with step("return"):
+        response = client.get(return_url)
+    confirm_path = reverse("shuup:checkout", kwargs={"phase": "confirm"})
+    assert response.url.endswith(confirm_path)
+
+    with step("confirm_page"):
+        response = client.get(confirm_path)
+    assert response.status_code == 200
+    confirm_fields = extract_form_fields(BeautifulSoup(response.content))
+
+    with step("confirm_order"):
+        response = client.post(confirm_path, data=confirm_fields)
+    assert response.status_code == 302
+
+    order = Order.objects.latest("pk")
+
+    with step("process_payment"):
+        response = client.get(reverse("shuup:order_process_payment", kwargs={"pk": order.pk, "key": order.key}))
+    assert response.status_code == 302
+
+    client.get(reverse("shuup:order_process_payment_return", kwargs={"pk": order.pk, "key": order.key}))
+
+
+@pytest.mark.django_db
+def test_checkout_payment_benchmark(settings):
+    cache.clear()
+    latency = os.environ.get("CIELO_BENCHMARK_LATENCY")
+    benchmark = CheckoutBenchmark(hooks=HOOKS, gateway=(CieloClient, "_request"))
+
+    with CieloStandIn(latency=parse_latency(latency) if latency else None) as server:
+        settings.CIELO_BASE_URL = server.url
+        clear_cielo_requests()
+        payment_method, shipping_method = initialize()
+
+        # aquece caches de templates, temas, etc.
+        run_checkout(not_measured, payment_method, shipping_method)
+
+        for iteration in range(ITERATIONS):
+            run_checkout(benchmark.measure, payment_method, shipping_method)
+
+        # passadas separadas, tracemalloc e cProfile distorcem o tempo
+        run_checkout(benchmark.trace_allocations, payment_method, shipping_method)
+        run_checkout(benchmark.profile, payment_method, shipping_method)
+
+    clear_cielo_requests()
+
+    summary = benchmark.summary()
+    regressions = check_baseline(summary)
+    print("\n" + format_report(summary, regressions))
+
+    output = os.environ.get("CIELO_BENCHMARK_OUTPUT")
+    if output:
+        with open(output, "w") as output_file:
+            json.dump(summary, output_file, indent=2)
+
+    assert not regressions, "Checkout payment path regressed:\n" + "\n".join(regressions)
@@ -0,0 +1,86 @@
+# -*- coding: utf-8 -*-
+# This file is part of Shuup Cielo.
+#
+# Copyright (c) 2016, Rockho Team. All rights reserved.
+# Author: Christian Hess
+#
+# This source code is licensed under the AGPLv3 license found in the
+# LICENSE file in the root directory of this source tree.
+from __future__ import unicode_literals
+
+import os
+
+from django.contrib.sessions.middleware import SessionMiddleware
+from django.test.client import RequestFactory
+import pytest
+
+from shuup.front.checkout._storage import CheckoutPhaseStorage
+from shuup.utils.importing import cached_load, load
+from shuup_cielo.views import _configure_basket, BASKET_SEARCH_KEYS
+from shuup_cielo_tests.benchmarks import _ms, percentile, timer
+
+pytestmark = pytest.mark.skipif(not os.environ.get("CIELO_BENCHMARK"),
+                                reason="Benchmarks run only with CIELO_BENCHMARK=1")
+
+ITERATIONS = int(os.environ.get("CIELO_BENCHMARK_ITERATIONS", 20)) * 100
+
+
+class Basket(object):
+    pass
+
+
+def configure_basket_uncached(request):
+    """
+    The phase lookup made before the phases were cached
+    """
+    for phase in cached_load("SHUUP_CHECKOUT_VIEW_SPEC").phase_specs:
+        storage = CheckoutPhaseStorage(request, load(phase).identifier)
+
+        for key, dst_key in BASKET_SEARCH_KEYS:
+            value = storage.get(key)
+            if value:
+                setattr(request.basket, dst_key, value)
+
+
+def get_request():
+    request = RequestFactory().get("/")
+    SessionMiddleware().process_request(request)
+    request.basket = Basket()
+
+    methods = CheckoutPhaseStorage(request, "methods")
+    methods.set("payment_method_id", 1)
+    methods.set("shipping_method_id", 2)
+
+    addresses = CheckoutPhaseStorage(request, "addresses")
+    addresses.set("shipping", "shipping address")
+    addresses.set("payment", "payment address")
+    return request
+
+
+def measure(function, request):
+    durations = []
+
+    for iteration in range(ITERATIONS):
+        start = timer()
+        function(request)
+        durations.append(timer() - start)
+
+    return durations
+
+
+def test_configure_basket_benchmark():
+    request = get_request()
+
+    # aquece os dois caminhos
+    configure_basket_uncached(request)
+    _configure_basket(request)
+    assert request.basket.payment_method_id == 1
+    assert request.basket.payment_address == "payment address"
+
+    uncached = measure(configure_basket_uncached, request)
+    cached = measure(_configure_basket, request)
+
+    print("\n_configure_basket p50: {0:.4f} ms uncached, {1:.4f} ms cached".format(
+        _ms(percentile(uncached, 50)), _ms(percentile(cached, 50))))
+
+    assert percentile(cached, 50) < percentile(uncached, 50)
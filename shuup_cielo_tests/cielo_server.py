@@ -0,0 +1,541 @@
+# -*- coding: utf-8 -*-
+# This file is part of Shuup Cielo.
+#
+# Copyright (c) 2016, Rockho Team. All rights reserved.
+# Author: Christian Hess
+#
+# This source code is licensed under the AGPLv3 license found in the
+# LICENSE file in the root directory of this source tree.
+"""
+Local stand-in for the Cielo 1.5 XML webservice
+
+Speaks the same protocol as ``ecommwsec.do`` for the messages used by
+`CieloRequest`: autorizar, consultar, capturar and cancelar. Transactions
+are kept in memory, so a TID can be authorized, queried, partially captured
+and partially cancelled like on the real gateway.
+
+Usage in tests::
+
+    with CieloStandIn(latency=lognormal_latency(0.2, 0.5)) as server:
+        settings.CIELO_BASE_URL = server.url
+        ...
+
+Usage for load tests, pointing ``CIELO_BASE_URL`` to the printed URL::
+
+    python -m shuup_cielo_tests.cielo_server --port 8765 --latency lognormal:0.2,0.5 \\
+        --error autorizar:97:0.01 --lr 05:0.05
+"""
+from __future__ import unicode_literals
+
+import argparse
+from collections import OrderedDict
+from datetime import datetime
+import math
+import random
+import re
+import threading
+import time
+import uuid
+
+from django.utils.encoding import force_text
+from django.utils.six.moves import BaseHTTPServer, socketserver
+from django.utils.six.moves.urllib.parse import parse_qs, urlparse
+import xmltodict
+
+from shuup_cielo.constants import (
+    CIELO_AUTHORIZED_STATUSES, CieloAuthorizationType, CieloErrorMap, CieloProduct,
+    CieloTransactionStatus
+)
+
+CIELO_SERVER_PATH = "/servicos/ecommwsec.do"
+CIELO_AUTHENTICATION_PATH = "/autenticacao/"
+
+# elemento raiz da mensagem -> operação
+OPERATIONS = OrderedDict([
+    ("requisicao-transacao", "autorizar"),
+    ("requisicao-consulta", "consultar"),
+    ("requisicao-captura", "capturar"),
+    ("requisicao-cancelamento", "cancelar"),
+])
+
+
+def constant_latency(seconds):
+    return lambda: seconds
+
+
+def uniform_latency(low, high):
+    return lambda: random.uniform(low, high)
+
+
+def lognormal_latency(median, sigma):
+    """
+    Long tail latency: half of the calls are faster than `median`
+    """
+    return lambda: random.lognormvariate(math.log(median), sigma)
+
+
+def parse_latency(value):
+    """
+    Parses `constant:0.1`, `uniform:0.05,0.3` or `lognormal:0.2,0.5`
+    """
+    name, _, args = value.partition(":")
+    factories = {"constant": constant_latency, "uniform": uniform_latency, "lognormal": lognormal_latency}
+
+    if name not in factories:
+        raise ValueError("Unknown latency distribution: {0}".format(name))
+
+    return factories[name](*[float(arg) for arg in args.split(",") if arg])
+
+
+class CieloError(Exception):
+    def __init__(self, code, message=None):
+        self.code = code
+        self.message = message or force_text(CieloErrorMap.get(code, "Erro"))
+        super(CieloError, self).__init__(self.code, self.message)
+
+
+def _now():
+    return datetime.utcnow().strftime("%Y-%m-%dT%H:%M:%S.%f")[:-3] + "Z"
+
+
+def _pick(rates):
+    """
+    Chooses a value from a list of `(value, probability)`, or None
+    """
+    draw = random.random()
+
+    for value, probability in rates:
+        if draw < probability:
+            return value
+        draw -= probability
+
+    return None
+
+
+class CieloStandIn(object):
+    """
+    The stand-in server
+
+    :param latency: callable returning the seconds to wait before answering,
+        or a dict of operation -> callable (key `None` is the default)
+    :param error_rates: dict of operation -> list of `(CieloErrorMap code, probability)`
+    :param lr_rates: list of `(authorization LR, probability)`, "00" otherwise
+    :param authentication: whether the card holder must authenticate before
+        authorization, for the authorization modes that allow it
+    :param authorization_delay: seconds the transaction stays in
+        Authenticating after the holder returns from the authentication page
+    :param affiliations: dict of affiliation number -> key; any credential
+        is accepted when not given
+    """
+
+    def __init__(self, host="127.0.0.1", port=0, latency=None, error_rates=None, lr_rates=None,
+                 authentication=True, authorization_delay=0, affiliations=None):
+        self.latency = latency
+        self.error_rates = error_rates or {}
+        self.lr_rates = lr_rates or []
+        self.authentication = authentication
+        self.authorization_delay = authorization_delay
+        self.affiliations = affiliations
+
+        self.transactions = {}
+        self.calls = dict((operation, 0) for operation in OPERATIONS.values())
+        self._next_errors = {}
+        self._next_lrs = []
+        self._lock = threading.Lock()
+
+        self.httpd = _ThreadingHTTPServer((host, port), _CieloRequestHandler)
+        self.httpd.stand_in = self
+        self.httpd.verbose = False
+        self._thread = None
+
+    @property
+    def base_url(self):
+        host, port = self.httpd.server_address[:2]
+        return "http://{0}:{1}".format(host, port)
+
+    @property
+    def url(self):
+        return self.base_url + CIELO_SERVER_PATH
+
+    def start(self):
+        self._thread = threading.Thread(target=self.httpd.serve_forever)
+        self._thread.daemon = True
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self.httpd.shutdown()
+        self.httpd.server_close()
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *exc_info):
+        self.stop()
+
+    def inject_error(self, operation, code):
+        """
+        Makes the next `operation` call fail with a `CieloErrorMap` code
+        """
+        with self._lock:
+            self._next_errors.setdefault(operation, []).append(code)
+
+    def inject_lr(self, lr):
+        """
+        Makes the next authorization return `lr`
+        """
+        with self._lock:
+            self._next_lrs.append(lr)
+
+    # protocolo
+
+    def get_latency(self, operation):
+        latency = self.latency
+
+        if isinstance(latency, dict):
+            latency = latency.get(operation, latency.get(None))
+
+        return latency() if latency else 0
+
+    def handle_message(self, xml):
+        """
+        Processes a webservice message and returns the response XML
+        """
+        try:
+            data = xmltodict.parse(xml)
+            root = next(iter(data))
+            operation = OPERATIONS.get(root)
+
+            if not operation:
+                raise CieloError(1)
+
+            time.sleep(self.get_latency(operation))
+
+            with self._lock:
+                self.calls[operation] += 1
+                self._check_error(operation)
+                self._check_credentials(data[root].get("dados-ec") or {})
+                transaction = getattr(self, "_{0}".format(operation))(data[root])
+                return self._render_transaction(transaction)
+
+        except CieloError as exc:
+            return self._render({"erro": OrderedDict([("codigo", "{0:03d}".format(exc.code)),
+                                                      ("mensagem", exc.message)])})
+
+        except Exception:
+            return self._render({"erro": OrderedDict([("codigo", "001"), ("mensagem", "Mensagem inválida")])})
+
+    def authenticate(self, tid, success=True):
+        """
+        Simulates the card holder going through the authentication page
+
+        :return: the URL Cielo redirects the holder to
+        """
+        with self._lock:
+            transaction = self.transactions.get(tid)
+
+            if not transaction or transaction["status"] != CieloTransactionStatus.Created.value:
+                return None
+
+            transaction["autenticacao"] = OrderedDict([
+                ("codigo", CieloTransactionStatus.Authenticated.value if success else
+                 CieloTransactionStatus.NotAuthenticated.value),
+                ("mensagem", "Autenticada com sucesso" if success else "Autenticação negada"),
+                ("data-hora", _now()),
+                ("valor", transaction["valor"]),
+                ("eci", 5 if success else 7),
+            ])
+
+            authorize = (transaction["autorizar"] == CieloAuthorizationType.IfAuthenticatedOrNot or
+                         (success and transaction["autorizar"] == CieloAuthorizationType.OnyIfAuthenticated))
+
+            if authorize:
+                transaction["status"] = CieloTransactionStatus.Authenticating.value
+                transaction["settle_at"] = time.time() + self.authorization_delay
+            elif success:
+                transaction["status"] = CieloTransactionStatus.Authenticated.value
+            else:
+                transaction["status"] = CieloTransactionStatus.NotAuthenticated.value
+
+            return transaction["url-retorno"]
+
+    def _check_error(self, operation):
+        code = None
+
+        if self._next_errors.get(operation):
+            code = self._next_errors[operation].pop(0)
+        elif self.error_rates.get(operation):
+            code = _pick(self.error_rates[operation])
+
+        if code is not None:
+            raise CieloError(code)
+
+    def _check_credentials(self, dados_ec):
+        if self.affiliations is None:
+            return
+
+        if self.affiliations.get("{0}".format(dados_ec.get("numero"))) != dados_ec.get("chave"):
+            raise CieloError(2)
+
+    def _get_transaction(self, data):
+        transaction = self.transactions.get(data.get("tid"))
+
+        if not transaction:
+            raise CieloError(3)
+
+        # a autorização após a autenticação terminou
+        if transaction.get("settle_at") is not None and time.time() >= transaction["settle_at"]:
+            transaction["settle_at"] = None
+            self._authorize(transaction)
+
+        return transaction
+
+    def _authorize(self, transaction):
+        if self._next_lrs:
+            lr = self._next_lrs.pop(0)
+        else:
+            lr = _pick(self.lr_rates) or "00"
+
+        authorized = lr in CIELO_AUTHORIZED_STATUSES
+        transaction["autorizacao"] = OrderedDict([
+            ("codigo", CieloTransactionStatus.Authorized.value if authorized else
+             CieloTransactionStatus.NotAuthorized.value),
+            ("mensagem", "Autorização concedida" if authorized else "Autorização negada"),
+            ("data-hora", _now()),
+            ("valor", transaction["valor"]),
+            ("lr", lr),
+            ("arp", random.randint(100000, 999999)),
+            ("nsu", random.randint(100000, 999999)),
+        ])
+        transaction["status"] = (CieloTransactionStatus.Authorized.value if authorized else
+                                 CieloTransactionStatus.NotAuthorized.value)
+
+        if authorized and transaction["capturar"]:
+            self._capture(transaction, transaction["valor"])
+
+    def _capture(self, transaction, value):
+        transaction["captura"] = OrderedDict([
+            ("codigo", CieloTransactionStatus.Captured.value),
+            ("mensagem", "Transação capturada com sucesso"),
+            ("data-hora", _now()),
+            ("valor", value),
+        ])
+        transaction["capturado"] = value
+        transaction["status"] = CieloTransactionStatus.Captured.value
+
+    def _autorizar(self, data):
+        pedido = data["dados-pedido"]
+        pagamento = data["forma-pagamento"]
+        numero = "{0}".format((data.get("dados-ec") or {}).get("numero", ""))
+        cartao = "{0}".format((data.get("dados-portador") or {}).get("numero", ""))
+
+        tid = "{0:0>10}{1}".format(numero[-10:], uuid.uuid4().hex[:10].upper())
+        autorizar = int(data.get("autorizar") or CieloAuthorizationType.Direct)
+
+        transaction = {
+            "tid": tid,
+            "pan": "{0}******{1}".format(cartao[:6], cartao[-4:]),
+            "dados-pedido": OrderedDict([
+                ("numero", pedido["numero"]),
+                ("valor", int(pedido["valor"])),
+                ("moeda", pedido.get("moeda") or 986),
+                ("data-hora", pedido.get("data-hora") or _now()),
+            ]),
+            "forma-pagamento": OrderedDict([
+                ("bandeira", pagamento["bandeira"]),
+                ("produto", pagamento["produto"]),
+                ("parcelas", int(pagamento.get("parcelas") or 1)),
+            ]),
+            "valor": int(pedido["valor"]),
+            "autorizar": autorizar,
+            "capturar": (data.get("capturar") or "").lower() == "true",
+            "url-retorno": data.get("url-retorno"),
+            "status": CieloTransactionStatus.Created.value,
+            "capturado": 0,
+            "cancelado": 0,
+        }
+        self.transactions[tid] = transaction
+
+        # débito sempre passa pela autenticação
+        needs_authentication = (pagamento["produto"] == CieloProduct.Debit or autorizar in (
+            CieloAuthorizationType.OnlyAuthenticate,
+            CieloAuthorizationType.OnyIfAuthenticated,
+            CieloAuthorizationType.IfAuthenticatedOrNot
+        ))
+
+        if self.authentication and needs_authentication and transaction["url-retorno"]:
+            transaction["url-autenticacao"] = "{0}{1}{2}".format(self.base_url, CIELO_AUTHENTICATION_PATH, tid)
+        else:
+            self._authorize(transaction)
+
+        return transaction
+
+    def _consultar(self, data):
+        return self._get_transaction(data)
+
+    def _capturar(self, data):
+        transaction = self._get_transaction(data)
+
+        if transaction["status"] != CieloTransactionStatus.Authorized.value:
+            raise CieloError(30)
+
+        value = int(data.get("valor") or transaction["valor"])
+
+        if value <= 0 or value > transaction["valor"]:
+            raise CieloError(32)
+
+        self._capture(transaction, value)
+        return transaction
+
+    def _cancelar(self, data):
+        transaction = self._get_transaction(data)
+
+        if transaction["status"] == CieloTransactionStatus.Captured.value:
+            total = transaction["capturado"]
+        elif transaction["status"] == CieloTransactionStatus.Authorized.value:
+            total = transaction["valor"]
+        else:
+            raise CieloError(42)
+
+        value = int(data.get("valor") or (total - transaction["cancelado"]))
+
+        if value <= 0 or transaction["cancelado"] + value > total:
+            raise CieloError(43)
+
+        transaction["cancelado"] += value
+        # a Cielo retorna apenas o total cancelado
+        transaction["cancelamentos"] = OrderedDict([("cancelamento", OrderedDict([
+            ("codigo", CieloTransactionStatus.Cancelled.value),
+            ("mensagem", "Cancelamento realizado com sucesso"),
+            ("data-hora", _now()),
+            ("valor", transaction["cancelado"]),
+        ]))])
+
+        if transaction["cancelado"] == total:
+            transaction["status"] = CieloTransactionStatus.Cancelled.value
+
+        return transaction
+
+    def _render_transaction(self, transaction):
+        body = OrderedDict([
+            ("@versao", "1.3.0"),
+            ("@id", uuid.uuid4().hex),
+            ("@xmlns", "http://ecommerce.cbmp.com.br"),
+        ])
+
+        for key in ("tid", "pan", "dados-pedido", "forma-pagamento", "status", "autenticacao",
+                    "autorizacao", "captura", "cancelamentos", "url-autenticacao"):
+            if transaction.get(key) is not None:
+                body[key] = transaction[key]
+
+        return self._render({"transacao": body})
+
+    def _render(self, data):
+        return xmltodict.unparse(data, encoding="ISO-8859-1")
+
+
+class _ThreadingHTTPServer(socketserver.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+    daemon_threads = True
+    request_queue_size = 128
+
+
+class _CieloRequestHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+
+    def do_POST(self):
+        if urlparse(self.path).path != CIELO_SERVER_PATH:
+            return self._send(404, "")
+
+        length = int(self.headers.get("Content-Length") or 0)
+        body = force_text(self.rfile.read(length), encoding="ISO-8859-1")
+        xml = (parse_qs(body).get("mensagem") or [""])[0]
+        self._send(200, self.server.stand_in.handle_message(xml),
+                   content_type="text/xml; charset=ISO-8859-1")
+
+    def do_GET(self):
+        url = urlparse(self.path)
+        match = re.match(r"^{0}(\w+)$".format(CIELO_AUTHENTICATION_PATH), url.path)
+
+        if not match:
+            return self._send(404, "")
+
+        # ?falha=1 simula a autenticação negada pelo banco
+        success = not parse_qs(url.query).get("falha")
+        return_url = self.server.stand_in.authenticate(match.group(1), success=success)
+
+        if not return_url:
+            return self._send(404, "")
+
+        self.send_response(302)
+        self.send_header("Location", return_url)
+        self.send_header("Content-Length", "0")
+        self.end_headers()
+
+    def _send(self, status, body, content_type="text/plain"):
+        content = body.encode("ISO-8859-1", "xmlcharrefreplace")
+        self.send_response(status)
+        self.send_header("Content-Type", content_type)
+        self.send_header("Content-Length", "{0}".format(len(content)))
+        self.end_headers()
+        self.wfile.write(content)
+
+    def log_message(self, format, *args):
+        if self.server.verbose:
+            BaseHTTPServer.BaseHTTPRequestHandler.log_message(self, format, *args)
+
+
+def _parse_error(value):
+    # operacao:codigo:probabilidade
+    operation, code, probability = value.split(":")
+    return operation, (int(code), float(probability))
+
+
+def _parse_lr(value):
+    # lr:probabilidade
+    lr, probability = value.split(":")
+    return lr, float(probability)
+
+
+def main(argv=None):
+    from django.conf import settings
+
+    if not settings.configured:
+        settings.configure(USE_I18N=False)
+
+    parser = argparse.ArgumentParser(description="Local stand-in for the Cielo 1.5 webservice")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8765)
+    parser.add_argument("--latency", type=parse_latency, default=None,
+                        help="constant:SECONDS, uniform:LOW,HIGH or lognormal:MEDIAN,SIGMA")
+    parser.add_argument("--error", type=_parse_error, action="append", default=[],
+                        help="OPERATION:CODE:PROBABILITY, e.g. autorizar:97:0.01 (may be repeated)")
+    parser.add_argument("--lr", type=_parse_lr, action="append", default=[],
+                        help="LR:PROBABILITY, e.g. 05:0.05 (may be repeated)")
+    parser.add_argument("--no-authentication", action="store_true",
+                        help="Authorize directly, without the authentication redirect")
+    parser.add_argument("--authorization-delay", type=float, default=0,
+                        help="Seconds a transaction stays in Authenticating after the holder returns")
+    parser.add_argument("--verbose", action="store_true")
+    args = parser.parse_args(argv)
+
+    error_rates = {}
+    for operation, rate in args.error:
+        error_rates.setdefault(operation, []).append(rate)
+
+    server = CieloStandIn(host=args.host, port=args.port, latency=args.latency, error_rates=error_rates,
+                          lr_rates=args.lr, authentication=not args.no_authentication,
+                          authorization_delay=args.authorization_delay)
+    server.httpd.verbose = args.verbose
+
+    print("Cielo stand-in listening, set CIELO_BASE_URL = \"{0}\"".format(server.url))
+
+    try:
+        server.httpd.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.httpd.server_close()
+
+
+if __name__ == "__main__":
+    main()
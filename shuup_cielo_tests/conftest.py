@@ -0,0 +1,21 @@
+# -*- coding: utf-8 -*-
+# This file is part of Shuup Cielo.
+#
+# Copyright (c) 2016, Rockho Team. All rights reserved.
+# Author: Christian Hess
+#
+# This source code is licensed under the AGPLv3 license found in the
+# LICENSE file in the root directory of this source tree.
+from __future__ import unicode_literals
+
+from django.core.cache import cache
+import pytest
+
+from shuup_cielo.config_cache import clear_cielo_config_cache
+
+
+@pytest.fixture(autouse=True)
+def clear_cached_configs():
+    # o rollback do banco entre os testes não invalida as configurações em cache
+    cache.clear()
+    clear_cielo_config_cache()
@@ -9,9 +9,12 @@
 from __future__ import unicode_literals
 
 from decimal import Decimal
+import json
 import uuid
 
 from django.core.urlresolvers import reverse
+from django.db import connection
+from django.test.utils import CaptureQueriesContext
 from mock import patch
 import pytest
 
@@ -37,8 +40,8 @@ from shuup_cielo.constants import (
 from shuup_cielo.models import CieloTransaction
 from shuup_cielo.utils import decimal_to_int_cents
 from shuup_cielo_tests import (
-    CC_VISA_1X_INFO, get_approved_transaction, get_cancelled_transaction, get_captured_transaction,
-    get_in_progress_transaction, PRODUCT_PRICE
+    CC_VISA_1X_INFO, create_cielo_transaction, get_approved_transaction, get_cancelled_transaction,
+    get_captured_transaction, get_in_progress_transaction, PRODUCT_PRICE
 )
 from shuup_cielo_tests.test_checkout import get_cielo_config, get_payment_provider
 from shuup_tests.front.test_checkout_flow import fill_address_inputs
@@ -369,3 +372,43 @@ def test_forms():
     CieloPaymentProcessorForm()
     DiscountPercentageBehaviorComponentForm()
     CieloConfigForm()
+
+
+@pytest.mark.django_db
+def test_transaction_list_view(rf, admin_user):
+    transactions = [
+        create_cielo_transaction(status=CieloTransactionStatus.Authorized, cc_brand=CieloCardBrand.Visa)
+        for index in range(5)
+    ]
+    view = load("shuup_cielo.admin.views.transaction.TransactionListView").as_view()
+
+    def get_page(page, filters=None):
+        query = {"perPage": 2, "page": page, "filters": filters or {}}
+        request = apply_request_middleware(rf.get("/", {"jq": json.dumps(query)}), user=admin_user)
+
+        with CaptureQueriesContext(connection) as queries:
+            response = view(request)
+
+        # a listagem não consulta os pedidos
+        assert not any('"shuup_order"' in captured["sql"] for captured in queries)
+        assert response.status_code == 200
+        return json.loads(response.content.decode("utf-8"))
+
+    data = get_page(1)
+    assert [item["tid"] for item in data["items"]] == [transactions[4].tid, transactions[3].tid]
+    assert data["pagination"]["nPages"] == 2
+
+    data = get_page(2)
+    assert [item["tid"] for item in data["items"]] == [transactions[2].tid, transactions[1].tid]
+
+    data = get_page(3)
+    assert [item["tid"] for item in data["items"]] == [transactions[0].tid]
+    assert data["pagination"]["nPages"] == 3
+
+    # página ainda não visitada
+    data = get_page(3, {"status": CieloTransactionStatus.Authorized.value})
+    assert [item["tid"] for item in data["items"]] == [transactions[0].tid]
+
+    data = get_page(1, {"tid": transactions[2].tid})
+    assert [item["tid"] for item in data["items"]] == [transactions[2].tid]
+    assert data["pagination"]["nPages"] == 1
@@ -0,0 +1,86 @@
+# -*- coding: utf-8 -*-
+# This file is part of Shuup Cielo.
+#
+# Copyright (c) 2016, Rockho Team. All rights reserved.
+# Author: Christian Hess
+#
+# This source code is licensed under the AGPLv3 license found in the
+# LICENSE file in the root directory of this source tree.
+from __future__ import unicode_literals
+
+import sys
+
+from django.core.cache import cache
+from mock import patch
+import pytest
+
+from cielo_webservice.exceptions import CieloRequestError
+from cielo_webservice.models import Comercial
+from shuup_cielo.circuit_breaker import CircuitBreaker
+from shuup_cielo.constants import CieloTransactionStatus
+
+if sys.version_info < (3, 5):
+    pytest.skip("the asyncio client requires Python 3.5+", allow_module_level=True)
+
+aiohttp = pytest.importorskip("aiohttp", minversion="3.3")
+import asyncio  # noqa (Python 3 only)
+from shuup_cielo.aio import AsyncCieloClient  # noqa (depends on aiohttp)
+
+TRANSACTION_XML = """<?xml version="1.0" encoding="ISO-8859-1"?>
+<transacao versao="1.3.0" id="1" xmlns="http://ecommerce.cbmp.com.br">
+    <tid>10069930690009F2A1001</tid>
+    <dados-pedido>
+        <numero>1</numero>
+        <valor>1000</valor>
+        <moeda>986</moeda>
+        <data-hora>2016-01-01T01:00:00.000-02:00</data-hora>
+    </dados-pedido>
+    <forma-pagamento>
+        <bandeira>visa</bandeira>
+        <produto>1</produto>
+        <parcelas>1</parcelas>
+    </forma-pagamento>
+    <status>4</status>
+</transacao>"""
+
+ERROR_XML = """<?xml version="1.0" encoding="ISO-8859-1"?>
+<erro xmlns="http://ecommerce.cbmp.com.br">
+    <codigo>97</codigo>
+    <mensagem>Sistema indisponivel</mensagem>
+</erro>"""
+
+
+def _answer(body):
+    def send(xml):
+        assert "<tid>10069930690009F2A1001</tid>" in xml
+        future = asyncio.Future()
+        future.set_result(body)
+        return future
+    return send
+
+
+def test_async_client():
+    cache.clear()
+    loop = asyncio.new_event_loop()
+    asyncio.set_event_loop(loop)
+
+    breaker = CircuitBreaker("async-test", min_calls=1, error_rate=1)
+    client = AsyncCieloClient(sandbox=True, affiliation="1006993069", circuit_breaker=breaker)
+    comercial = Comercial(numero=1006993069, chave="25fbb997438630f30b112d033ce2e621b34f3")
+
+    try:
+        with patch.object(AsyncCieloClient, "_send", side_effect=_answer(TRANSACTION_XML)):
+            transacao = loop.run_until_complete(client.consultar(tid="10069930690009F2A1001", comercial=comercial))
+            assert transacao.status == CieloTransactionStatus.Authorized.value
+            assert transacao.pedido.valor == 1000
+
+        with patch.object(AsyncCieloClient, "_send", side_effect=_answer(ERROR_XML)):
+            with pytest.raises(CieloRequestError):
+                loop.run_until_complete(client.cancelar(tid="10069930690009F2A1001", comercial=comercial))
+
+        # Cielo unavailable: the shared breaker is open now
+        assert breaker.get_info()["failures"] == 1
+        assert breaker.get_state() == "open"
+    finally:
+        loop.run_until_complete(client.close())
+        loop.close()
@@ -0,0 +1,145 @@
+# -*- coding: utf-8 -*-
+# This file is part of Shuup Cielo.
+#
+# Copyright (c) 2016, Rockho Team. All rights reserved.
+# Author: Christian Hess
+#
+# This source code is licensed under the AGPLv3 license found in the
+# LICENSE file in the root directory of this source tree.
+from __future__ import unicode_literals
+
+from django.core.cache import cache
+from django.utils.timezone import now
+import pytest
+import requests
+
+from cielo_webservice.exceptions import CieloRequestError
+from cielo_webservice.models import Cartao, Comercial, Pagamento, Pedido, Transacao
+from shuup_cielo.client import clear_cielo_requests, CieloClient, get_cielo_request
+from shuup_cielo.constants import (
+    CieloAuthorizationType, CieloCardBrand, CieloProduct, CieloTransactionStatus
+)
+from shuup_cielo.exceptions import CieloTimeoutError
+from shuup_cielo_tests.cielo_server import CieloStandIn, constant_latency, parse_latency
+
+COMERCIAL = Comercial(numero=1006993069, chave="25fbb997438630f30b112d033ce2e621b34f3")
+RETURN_URL = "http://localhost/cielo/return/1/"
+
+
+@pytest.yield_fixture
+def cielo_server(settings):
+    cache.clear()
+
+    with CieloStandIn() as server:
+        settings.CIELO_BASE_URL = server.url
+        clear_cielo_requests()
+        yield server
+
+    clear_cielo_requests()
+
+
+def get_transacao(valor=1000, autorizar=CieloAuthorizationType.Direct, capturar=False):
+    return Transacao(comercial=COMERCIAL,
+                     cartao=Cartao(numero=4012001038443335, validade=201812, indicador=1,
+                                   codigo_seguranca=123, nome_portador="Joao de souza"),
+                     pedido=Pedido(numero="1", valor=valor, moeda=986, data_hora=now().isoformat()),
+                     pagamento=Pagamento(bandeira=CieloCardBrand.Visa, produto=CieloProduct.Credit, parcelas=1),
+                     autorizar=autorizar,
+                     capturar=capturar,
+                     url_retorno=RETURN_URL)
+
+
+def test_parse_latency():
+    assert parse_latency("constant:0.1")() == 0.1
+    assert 0.1 <= parse_latency("uniform:0.1,0.2")() <= 0.2
+    assert parse_latency("lognormal:0.2,0.5")() > 0
+
+    with pytest.raises(ValueError):
+        parse_latency("gaussian:1")
+
+
+def test_stand_in_capture_and_cancel(cielo_server):
+    cielo_request = get_cielo_request(sandbox=True, affiliation="1006993069")
+    assert cielo_request.base_url == cielo_server.url
+
+    transacao = cielo_request.autorizar(transacao=get_transacao())
+    assert transacao.status == CieloTransactionStatus.Authorized.value
+    assert transacao.autorizacao.lr == "00"
+    assert transacao.url_autenticacao is None
+
+    # captura parcial
+    transacao = cielo_request.capturar(tid=transacao.tid, comercial=COMERCIAL, valor=600)
+    assert transacao.status == CieloTransactionStatus.Captured.value
+    assert transacao.captura.valor == 600
+
+    with pytest.raises(CieloRequestError) as exc:
+        cielo_request.capturar(tid=transacao.tid, comercial=COMERCIAL, valor=400)
+    assert "030" in "{0}".format(exc.value)
+
+    # cancelamentos parciais até o total capturado
+    transacao = cielo_request.cancelar(tid=transacao.tid, comercial=COMERCIAL, valor=100)
+    assert transacao.status == CieloTransactionStatus.Captured.value
+    assert transacao.cancelamento.valor == 100
+
+    with pytest.raises(CieloRequestError):
+        cielo_request.cancelar(tid=transacao.tid, comercial=COMERCIAL, valor=600)
+
+    transacao = cielo_request.cancelar(tid=transacao.tid, comercial=COMERCIAL)
+    assert transacao.status == CieloTransactionStatus.Cancelled.value
+    assert transacao.cancelamento.valor == 600
+
+    transacao = cielo_request.consultar(tid=transacao.tid, comercial=COMERCIAL)
+    assert transacao.status == CieloTransactionStatus.Cancelled.value
+    assert cielo_server.calls["consultar"] == 1
+
+    with pytest.raises(CieloRequestError):
+        cielo_request.consultar(tid="inexistente", comercial=COMERCIAL)
+
+
+def test_stand_in_injection(cielo_server):
+    cielo_request = get_cielo_request(sandbox=True, affiliation="1006993069")
+
+    cielo_server.inject_lr("05")
+    transacao = cielo_request.autorizar(transacao=get_transacao(capturar=True))
+    assert transacao.status == CieloTransactionStatus.NotAuthorized.value
+    assert transacao.autorizacao.lr == "05"
+    assert transacao.captura is None
+
+    transacao = cielo_request.autorizar(transacao=get_transacao(capturar=True))
+    assert transacao.status == CieloTransactionStatus.Captured.value
+
+    cielo_server.inject_error("consultar", 97)
+    with pytest.raises(CieloRequestError) as exc:
+        cielo_request.consultar(tid=transacao.tid, comercial=COMERCIAL)
+    assert "097" in "{0}".format(exc.value)
+
+    # a latência passa do timeout de leitura
+    cielo_server.latency = {"consultar": constant_latency(0.5)}
+    client = CieloClient(cielo_request, connect_timeout=1, read_timeout=0.1, request_timeout=5)
+    with pytest.raises(CieloTimeoutError):
+        client.consultar(tid=transacao.tid, comercial=COMERCIAL)
+
+
+def test_stand_in_authentication(cielo_server):
+    cielo_server.authorization_delay = 0.2
+    cielo_request = get_cielo_request(sandbox=True, affiliation="1006993069")
+
+    transacao = cielo_request.autorizar(
+        transacao=get_transacao(autorizar=CieloAuthorizationType.IfAuthenticatedOrNot)
+    )
+    assert transacao.status == CieloTransactionStatus.Created.value
+    assert transacao.url_autenticacao.startswith(cielo_server.base_url)
+
+    response = requests.get(transacao.url_autenticacao, allow_redirects=False)
+    assert response.status_code == 302
+    assert response.headers["Location"] == RETURN_URL
+
+    # a autorização ainda está em andamento logo após o retorno
+    transacao = cielo_request.consultar(tid=transacao.tid, comercial=COMERCIAL)
+    assert transacao.status == CieloTransactionStatus.Authenticating.value
+    assert transacao.autenticacao.eci == 5
+
+    cielo_server.authorization_delay = 0
+    cielo_server.transactions[transacao.tid]["settle_at"] = 0
+    transacao = cielo_request.consultar(tid=transacao.tid, comercial=COMERCIAL)
+    assert transacao.status == CieloTransactionStatus.Authorized.value
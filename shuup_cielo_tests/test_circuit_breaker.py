@@ -0,0 +1,101 @@
+# -*- coding: utf-8 -*-
+# This file is part of Shuup Cielo.
+#
+# Copyright (c) 2016, Rockho Team. All rights reserved.
+# Author: Christian Hess
+#
+# This source code is licensed under the AGPLv3 license found in the
+# LICENSE file in the root directory of this source tree.
+from __future__ import unicode_literals
+
+from django.core.cache import cache
+from mock import Mock, patch
+import pytest
+import requests
+
+from cielo_webservice.exceptions import CieloRequestError
+from shuup_cielo.circuit_breaker import CircuitBreaker, is_gateway_failure
+from shuup_cielo.constants import CircuitBreakerState
+from shuup_cielo.exceptions import CieloCircuitOpenError, CieloDeadlineExceeded, CieloTimeoutError
+
+
+def test_gateway_failures():
+    assert is_gateway_failure(CieloRequestError("97 - Sistema indisponível")) is True
+    assert is_gateway_failure(CieloRequestError("98 - Timeout")) is True
+    assert is_gateway_failure(CieloTimeoutError("slow")) is True
+    assert is_gateway_failure(requests.ConnectionError("refused")) is True
+
+    # business errors and the local deadline do not count
+    assert is_gateway_failure(CieloRequestError("30 - Status inválido para captura")) is False
+    assert is_gateway_failure(CieloDeadlineExceeded("over")) is False
+    assert is_gateway_failure(ValueError()) is False
+
+
+def test_circuit_breaker():
+    cache.clear()
+    breaker = CircuitBreaker("test", error_rate=0.5, min_calls=4, window=60, reset_timeout=30)
+    assert breaker.get_state() == CircuitBreakerState.Closed
+
+    ok = Mock(return_value="ok")
+    unavailable = Mock(side_effect=CieloRequestError("97 - Sistema indisponível"))
+
+    assert breaker.call(ok) == "ok"
+    assert breaker.call(ok) == "ok"
+
+    with pytest.raises(CieloRequestError):
+        breaker.call(unavailable)
+    assert breaker.get_state() == CircuitBreakerState.Closed
+
+    # 2 errors of 4 calls: 50%
+    with pytest.raises(CieloRequestError):
+        breaker.call(unavailable)
+    assert breaker.get_state() == CircuitBreakerState.Open
+
+    # fast fail, the gateway is not called
+    ok.reset_mock()
+    with pytest.raises(CieloCircuitOpenError):
+        breaker.call(ok)
+    assert not ok.called
+
+    # the state is shared: another instance sees the circuit open
+    assert CircuitBreaker("test", reset_timeout=30).get_state() == CircuitBreakerState.Open
+
+    opened_at = breaker.get_opened_at()
+
+    with patch("shuup_cielo.circuit_breaker.time.time", return_value=opened_at + 31):
+        assert breaker.get_state() == CircuitBreakerState.HalfOpen
+
+        # failed probe: opens again
+        with pytest.raises(CieloRequestError):
+            breaker.call(unavailable)
+
+    assert breaker.get_state() == CircuitBreakerState.Open
+    opened_at = breaker.get_opened_at()
+
+    with patch("shuup_cielo.circuit_breaker.time.time", return_value=opened_at + 31):
+        # only one probe at a time
+        breaker.before_call()
+        with pytest.raises(CieloCircuitOpenError):
+            breaker.before_call()
+        breaker.record_success(probe=True)
+
+    assert breaker.get_state() == CircuitBreakerState.Closed
+    assert breaker.call(ok) == "ok"
+
+
+def test_circuit_breaker_deadline_probe():
+    cache.clear()
+    breaker = CircuitBreaker("deadline", error_rate=0.5, min_calls=1, window=60, reset_timeout=30)
+    breaker.open()
+    opened_at = breaker.get_opened_at()
+
+    with patch("shuup_cielo.circuit_breaker.time.time", return_value=opened_at + 31):
+        # Cielo was not called: the probe is given back and the state is kept
+        with pytest.raises(CieloDeadlineExceeded):
+            breaker.call(Mock(side_effect=CieloDeadlineExceeded("over")))
+        assert breaker.get_state() == CircuitBreakerState.HalfOpen
+
+        assert breaker.before_call() is True
+        breaker.record_success(probe=True)
+
+    assert breaker.get_state() == CircuitBreakerState.Closed
@@ -0,0 +1,79 @@
+# -*- coding: utf-8 -*-
+# This file is part of Shuup Cielo.
+#
+# Copyright (c) 2016, Rockho Team. All rights reserved.
+# Author: Christian Hess
+#
+# This source code is licensed under the AGPLv3 license found in the
+# LICENSE file in the root directory of this source tree.
+from __future__ import unicode_literals
+
+from decimal import Decimal
+
+from mock import patch
+import pytest
+import requests
+
+from cielo_webservice.request import BASE_URL, CieloRequest, SANDBOX_BASE_URL
+from shuup_cielo.client import (
+    clear_cielo_requests, clear_request_deadline, CieloClient, get_cielo_request, start_request_deadline
+)
+from shuup_cielo.exceptions import CieloDeadlineExceeded, CieloTimeoutError
+
+
+def test_pooled_cielo_request():
+    clear_cielo_requests()
+
+    request_1 = get_cielo_request(sandbox=True, affiliation="1006993069")
+    request_2 = get_cielo_request(sandbox=True, affiliation="1006993069")
+    assert request_1 is request_2
+    assert request_1.base_url == SANDBOX_BASE_URL
+
+    # another affiliation or environment means another client
+    request_3 = get_cielo_request(sandbox=True, affiliation="1001734898")
+    request_4 = get_cielo_request(sandbox=False, affiliation="1006993069")
+    assert request_3 is not request_1
+    assert request_4 is not request_1
+    assert request_4.base_url == BASE_URL
+
+    # the https adapter keeps a pool of persistent connections
+    adapter = request_1.session.get_adapter(SANDBOX_BASE_URL)
+    assert adapter._pool_maxsize >= 1
+
+    clear_cielo_requests()
+    assert get_cielo_request(sandbox=True, affiliation="1006993069") is not request_1
+
+
+def test_client_timeouts():
+    cielo_request = get_cielo_request(sandbox=True, affiliation="1006993069")
+    client = CieloClient(cielo_request, connect_timeout=Decimal(3), read_timeout=Decimal(5),
+                         request_timeout=Decimal(15))
+
+    # no request being tracked, just the configured timeouts
+    clear_request_deadline()
+    assert client._get_timeout() == (3.0, 5.0)
+
+    with patch.object(CieloRequest, 'consultar', return_value="ok") as mocked_method:
+        start_request_deadline()
+        assert client.consultar(tid="123") == "ok"
+        assert mocked_method.called
+
+        # the timeouts are shortened by the remaining request budget
+        client.request_timeout = 2.0
+        connect_timeout, read_timeout = client._get_timeout()
+        assert connect_timeout <= 2.0
+        assert read_timeout <= 2.0
+
+        # the budget is over: fail fast without calling Cielo
+        mocked_method.reset_mock()
+        client.request_timeout = 0
+        with pytest.raises(CieloDeadlineExceeded):
+            client.consultar(tid="123")
+        assert not mocked_method.called
+
+    with patch.object(CieloRequest, 'consultar', side_effect=requests.Timeout("slow")):
+        client.request_timeout = 15.0
+        with pytest.raises(CieloTimeoutError):
+            client.consultar(tid="123")
+
+    clear_request_deadline()
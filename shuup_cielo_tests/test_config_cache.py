@@ -0,0 +1,89 @@
+# -*- coding: utf-8 -*-
+# This file is part of Shuup Cielo.
+#
+# Copyright (c) 2016, Rockho Team. All rights reserved.
+# Author: Christian Hess
+#
+# This source code is licensed under the AGPLv3 license found in the
+# LICENSE file in the root directory of this source tree.
+from __future__ import unicode_literals
+
+from django.core.cache import cache
+from django.db import connection
+from django.test.utils import CaptureQueriesContext
+from mock import patch
+import pytest
+
+from shuup.testing.factories import get_default_shop
+from shuup_cielo import config_cache
+from shuup_cielo.config_cache import (
+    clear_cielo_config_cache, get_cielo_config, get_cielo_config_version, invalidate_cielo_config
+)
+from shuup_cielo.models import CieloConfig
+
+
+@pytest.mark.django_db
+def test_config_cache(settings):
+    settings.CIELO_CONFIG_LOCAL_TTL = 60
+    shop = get_default_shop()
+    assert get_cielo_config(shop) is None
+
+    # salvar invalida o cache
+    cielo_config = CieloConfig.objects.create(shop=shop, max_installments=3)
+    assert get_cielo_config(shop).max_installments == 3
+
+    with CaptureQueriesContext(connection) as queries:
+        assert get_cielo_config(shop).pk == cielo_config.pk
+        assert get_cielo_config(shop.pk).pk == cielo_config.pk
+
+        # outro processo: a configuração vem do cache compartilhado
+        clear_cielo_config_cache()
+        assert get_cielo_config(shop).max_installments == 3
+        assert len(queries) == 0
+
+    cielo_config.max_installments = 6
+    cielo_config.save()
+    assert get_cielo_config(shop).max_installments == 6
+
+    cielo_config.delete()
+    assert get_cielo_config(shop) is None
+
+
+@pytest.mark.django_db
+def test_config_cache_remote_invalidation(settings):
+    settings.CIELO_CONFIG_LOCAL_TTL = 60
+    shop = get_default_shop()
+    CieloConfig.objects.create(shop=shop, max_installments=3)
+    assert get_cielo_config(shop).max_installments == 3
+
+    # outro processo alterou a configuração
+    CieloConfig.objects.filter(shop=shop).update(max_installments=9)
+    cache.set("cielo_config_version:{0}".format(shop.pk), "changed")
+
+    # a camada local ainda é válida
+    assert get_cielo_config(shop).max_installments == 3
+
+    settings.CIELO_CONFIG_LOCAL_TTL = 0
+    assert get_cielo_config(shop).max_installments == 9
+
+
+class InvalidatedConfigs(dict):
+    """
+    Local layer invalidated by another thread right after each write
+    """
+
+    def __setitem__(self, key, value):
+        pass
+
+
+@pytest.mark.django_db
+def test_config_version_concurrent_invalidation():
+    shop = get_default_shop()
+    CieloConfig.objects.create(shop=shop)
+    version = get_cielo_config_version(shop)
+
+    with patch.object(config_cache, "_local_configs", InvalidatedConfigs()):
+        assert get_cielo_config_version(shop) == version
+
+        invalidate_cielo_config(shop.pk)
+        assert get_cielo_config_version(shop) != version
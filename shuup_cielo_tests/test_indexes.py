@@ -0,0 +1,61 @@
+# -*- coding: utf-8 -*-
+# This file is part of Shuup Cielo.
+#
+# Copyright (c) 2016, Rockho Team. All rights reserved.
+# Author: Christian Hess
+#
+# This source code is licensed under the AGPLv3 license found in the
+# LICENSE file in the root directory of this source tree.
+from __future__ import unicode_literals
+
+from datetime import timedelta
+
+from django.db import connection
+import pytest
+
+from shuup.testing.factories import get_default_shop
+from shuup_cielo.constants import CieloTransactionStatus
+from shuup_cielo.models import CieloTransaction
+from shuup_cielo.sync import get_transactions_to_sync
+
+pytestmark = pytest.mark.skipif(connection.vendor != "sqlite", reason="The query plans are checked on SQLite")
+
+
+def get_transaction_plan(queryset):
+    """
+    Returns the query plan lines that read the transactions table
+    """
+    sql, params = queryset.query.sql_with_params()
+
+    with connection.cursor() as cursor:
+        cursor.execute("EXPLAIN QUERY PLAN " + sql, params)
+        return [row[-1] for row in cursor.fetchall() if CieloTransaction._meta.db_table in row[-1]]
+
+
+def assert_uses_index(queryset, *columns):
+    plan = get_transaction_plan(queryset)
+    assert plan
+
+    for line in plan:
+        assert " USING " in line and "INDEX" in line, line
+        for column in columns:
+            assert "{0}=".format(column) in line, line
+
+
+@pytest.mark.django_db
+def test_lookup_indexes():
+    shop = get_default_shop()
+
+    assert_uses_index(CieloTransaction.objects.filter(tid="123"), "tid")
+    assert_uses_index(CieloTransaction.objects.filter(authorization_nsu="123"), "authorization_nsu")
+    assert_uses_index(
+        CieloTransaction.objects.filter(shop=shop, status=CieloTransactionStatus.Authorized).order_by("-creation_date"),
+        "shop_id", "status"
+    )
+
+
+@pytest.mark.django_db
+def test_sync_indexes():
+    shop = get_default_shop()
+    assert_uses_index(get_transactions_to_sync(min_age=timedelta(minutes=30)), "status")
+    assert_uses_index(get_transactions_to_sync(shop=shop, min_age=timedelta(minutes=30)), "shop_id")
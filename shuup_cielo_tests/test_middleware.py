@@ -0,0 +1,95 @@
+# -*- coding: utf-8 -*-
+# This file is part of Shuup Cielo.
+#
+# Copyright (c) 2016, Rockho Team. All rights reserved.
+# Author: Christian Hess
+#
+# This source code is licensed under the AGPLv3 license found in the
+# LICENSE file in the root directory of this source tree.
+from __future__ import unicode_literals
+
+from django.contrib.sessions.middleware import SessionMiddleware
+from django.db import connection
+from django.http.response import HttpResponse
+from django.test.client import RequestFactory
+from django.test.utils import CaptureQueriesContext
+import pytest
+
+from shuup_cielo import metrics
+from shuup_cielo.constants import CieloTransactionStatus
+from shuup_cielo.middleware import CieloTransactionMiddleware
+from shuup_cielo.models import CieloOrderTransaction
+from shuup_cielo.objects import CIELO_ORDER_TRANSACTION_ID_KEY, CIELO_TRANSACTION_ID_KEY
+from shuup_cielo_tests import create_cielo_transaction
+from shuup_cielo_tests.test_checkout import get_cielo_config
+
+
+def get_request(**session_data):
+    request = RequestFactory().get("/")
+    SessionMiddleware().process_request(request)
+    request.session.update(session_data)
+    request.session.modified = False
+    return request
+
+
+@pytest.mark.django_db
+def test_middleware_lazy_context():
+    cielo_config = get_cielo_config()
+    cielo_transaction = create_cielo_transaction(CieloTransactionStatus.Authorized)
+    cielo_order = cielo_transaction.order_transaction
+    request = get_request(**{
+        CIELO_TRANSACTION_ID_KEY: cielo_transaction.pk,
+        CIELO_ORDER_TRANSACTION_ID_KEY: cielo_order.pk
+    })
+    middleware = CieloTransactionMiddleware()
+
+    with CaptureQueriesContext(connection) as queries:
+        middleware.process_request(request)
+        assert len(queries) == 0
+
+        # tudo vem da mesma consulta
+        assert request.cielo.order_transaction == cielo_order
+        assert request.cielo.transaction == cielo_transaction
+        assert request.cielo.transaction.shop.pk == cielo_config.shop_id
+        assert len(queries) == 1
+
+        skipped = metrics.get_counter(metrics.SESSION_WRITES_SKIPPED)
+        middleware.process_response(request, HttpResponse())
+        assert len(queries) == 1
+
+    # nada mudou, a sessão não precisa ser gravada
+    assert not request.session.modified
+    assert metrics.get_counter(metrics.SESSION_WRITES_SKIPPED) == skipped + 1
+    assert request.session[CIELO_TRANSACTION_ID_KEY] == cielo_transaction.pk
+    assert request.session[CIELO_ORDER_TRANSACTION_ID_KEY] == cielo_order.pk
+
+
+@pytest.mark.django_db
+def test_middleware_commit_changes():
+    cielo_order = CieloOrderTransaction.objects.create()
+    request = get_request(**{CIELO_ORDER_TRANSACTION_ID_KEY: cielo_order.pk})
+    middleware = CieloTransactionMiddleware()
+    middleware.process_request(request)
+
+    new_cielo_order = CieloOrderTransaction.objects.create()
+    request.cielo.set_order_transaction(new_cielo_order)
+    middleware.process_response(request, HttpResponse())
+
+    assert request.session.modified
+    assert request.session[CIELO_ORDER_TRANSACTION_ID_KEY] == new_cielo_order.pk
+    assert CIELO_TRANSACTION_ID_KEY not in request.session
+
+    request.cielo.clear()
+    assert request.session[CIELO_ORDER_TRANSACTION_ID_KEY] is None
+
+
+@pytest.mark.django_db
+def test_middleware_without_transaction():
+    request = get_request()
+    middleware = CieloTransactionMiddleware()
+
+    with CaptureQueriesContext(connection) as queries:
+        middleware.process_request(request)
+        assert request.cielo.transaction is None
+        assert request.cielo.order_transaction is None
+        assert len(queries) == 0
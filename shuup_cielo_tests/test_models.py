@@ -6,15 +6,33 @@
 #
 # This source code is licensed under the AGPLv3 license found in the
 # LICENSE file in the root directory of this source tree.
+from datetime import timedelta
 from decimal import Decimal
+import uuid
 
+from django.db import connection
+from django.test.utils import CaptureQueriesContext
+from django.utils.timezone import now
+from mock import patch
 import pytest
 
+from cielo_webservice.request import CieloRequest
 from shuup.core.models._order_lines import OrderLineType
 from shuup.testing.factories import (
-    create_product, get_default_payment_method, get_default_shipping_method, get_default_supplier
+    create_product, get_default_payment_method, get_default_shipping_method, get_default_shop,
+    get_default_supplier
 )
-from shuup_cielo.models import DiscountPercentageBehaviorComponent
+from shuup_cielo import metrics
+from shuup_cielo.constants import CieloProduct, CieloSyncSource, CieloTransactionStatus, InterestType
+from shuup_cielo.models import (
+    CieloConfig, CieloTransaction, DiscountPercentageBehaviorComponent,
+    get_best_installment_offers, InstallmentContext
+)
+from shuup_cielo.utils import decimal_to_int_cents
+from shuup_cielo_tests import (
+    create_cielo_transaction, get_approved_transaction, get_captured_transaction, get_in_progress_transaction
+)
+from shuup_cielo_tests.test_checkout import get_cielo_config
 from shuup_tests.core.test_order_creator import seed_source
 
 
@@ -60,3 +78,169 @@ def test_discount_service_behavior(admin_user, get_service, service_attr):
 
     assert len(costs) == 1
     assert costs[0].price.value == (PRODUCT_QTNTY * PRODUCT_PRICE) * (-DISCOUNT_PERC) / Decimal(100.0)
+
+
+def test_best_installment_offers():
+    cielo_config = CieloConfig(max_installments=12,
+                               installments_without_interest=3,
+                               interest_type=InterestType.Price,
+                               interest_rate=Decimal("2.3"),
+                               min_installment_amount=Decimal(30))
+    prices = [Decimal(10), Decimal(45), Decimal(100), Decimal("1000.50")]
+    offers = get_best_installment_offers(prices, cielo_config)
+
+    # menor que a parcela mínima
+    assert offers[0] is None
+
+    for price, offer in zip(prices[1:], offers[1:]):
+        choices = InstallmentContext(price, cielo_config).get_intallments_choices()
+        assert tuple(offer) == choices[-1]
+
+    assert offers[1].number == 1
+    assert offers[1].interest == Decimal(0)
+    assert offers[2].number == 3
+    assert offers[3].number == 12
+    assert offers[3].interest > Decimal(0)
+
+
+@pytest.mark.parametrize("installments", [3, 6, 7, 9, 11, 12])
+def test_installments_min_amount_boundary(installments):
+    cielo_config = CieloConfig(max_installments=12,
+                               installments_without_interest=12,
+                               interest_type=InterestType.Simple,
+                               interest_rate=Decimal(0),
+                               min_installment_amount=Decimal(10))
+    # a parcela é exatamente o valor mínimo
+    price = Decimal(10) * installments
+
+    choices = InstallmentContext(price, cielo_config).get_intallments_choices()
+    assert choices[-1][0] == installments
+    assert choices[-1][1] == Decimal("10.00")
+
+    offer = get_best_installment_offers([price], cielo_config)[0]
+    assert offer.number == installments
+    assert offer.installment_amount == Decimal("10.00")
+
+
+def test_installments_min_amount_below_boundary():
+    cielo_config = CieloConfig(max_installments=3,
+                               installments_without_interest=3,
+                               interest_type=InterestType.Simple,
+                               interest_rate=Decimal(0),
+                               min_installment_amount=Decimal("29.98"))
+
+    # 29.975 por parcela é exibido como 29.98, mas fica abaixo do mínimo
+    choices = InstallmentContext(Decimal("89.925"), cielo_config).get_intallments_choices()
+    assert choices[-1][0] == 2
+    assert get_best_installment_offers([Decimal("89.925")], cielo_config)[0].number == 2
+
+    # 29.985 por parcela passa do mínimo
+    choices = InstallmentContext(Decimal("89.955"), cielo_config).get_intallments_choices()
+    assert choices[-1][0] == 3
+    assert choices[-1][1] == Decimal("29.98")
+
+
+@pytest.mark.django_db
+def test_refresh_max_age():
+    get_cielo_config()
+    tid = uuid.uuid4().hex
+    cielo_transaction = create_cielo_transaction(tid=tid)
+    transacao = get_in_progress_transaction(valor=decimal_to_int_cents(Decimal(10)),
+                                            produto=CieloProduct.Credit, tid=tid)
+
+    with patch.object(CieloRequest, 'consultar', return_value=transacao) as mock_consultar:
+        # nunca sincronizada
+        assert cielo_transaction.refresh(max_age=60)
+        assert mock_consultar.call_count == 1
+        assert cielo_transaction.last_sync_source == CieloSyncSource.Query
+
+        # o cliente ainda está autenticando
+        assert cielo_transaction.refresh(max_age=60)
+        assert mock_consultar.call_count == 2
+
+        mock_consultar.return_value = get_approved_transaction(transacao)
+        assert cielo_transaction.refresh()
+        assert cielo_transaction.status == CieloTransactionStatus.Authorized
+        assert mock_consultar.call_count == 3
+
+        # sincronizada há pouco
+        skipped = metrics.get_counter(metrics.REFRESHES_SKIPPED)
+        assert cielo_transaction.refresh(max_age=60)
+        assert mock_consultar.call_count == 3
+        assert metrics.get_counter(metrics.REFRESHES_SKIPPED) == skipped + 1
+
+        cielo_transaction.last_sync = now() - timedelta(seconds=61)
+        assert cielo_transaction.refresh(max_age=60)
+        assert mock_consultar.call_count == 4
+
+        # estado final
+        cielo_transaction.status = CieloTransactionStatus.Captured
+        cielo_transaction.last_sync = now() - timedelta(days=1)
+        assert cielo_transaction.is_final()
+        assert cielo_transaction.refresh(max_age=60)
+        assert mock_consultar.call_count == 4
+
+        # o cancelamento parcial ainda pode mudar
+        cielo_transaction.status = CieloTransactionStatus.Cancelled
+        cielo_transaction.total_reversed_value = Decimal(4)
+        assert not cielo_transaction.is_final()
+        cielo_transaction.total_reversed_value = Decimal(10)
+        assert cielo_transaction.is_final()
+
+        # sem max_age a consulta é sempre feita
+        assert cielo_transaction.refresh()
+        assert mock_consultar.call_count == 5
+
+
+@pytest.mark.django_db
+def test_update_from_transaction():
+    tid = uuid.uuid4().hex
+    cielo_transaction = create_cielo_transaction(tid=tid)
+    approved = get_approved_transaction(get_in_progress_transaction(valor=decimal_to_int_cents(Decimal(10)),
+                                                                    produto=CieloProduct.Credit, tid=tid))
+
+    assert cielo_transaction._update_from_transaction(approved)
+    last_update = CieloTransaction.objects.get(pk=cielo_transaction.pk).last_update
+
+    # nada mudou: nenhuma escrita
+    with CaptureQueriesContext(connection) as queries:
+        assert not cielo_transaction._update_from_transaction(approved)
+        assert len(queries) == 0
+
+    assert CieloTransaction.objects.get(pk=cielo_transaction.pk).last_update == last_update
+
+    # outro processo capturou a transação
+    stale_transaction = CieloTransaction.objects.get(pk=cielo_transaction.pk)
+    captured = get_captured_transaction(get_approved_transaction(
+        get_in_progress_transaction(valor=decimal_to_int_cents(Decimal(10)), produto=CieloProduct.Credit, tid=tid)
+    ))
+    assert cielo_transaction._update_from_transaction(captured, CieloSyncSource.Capture)
+
+    # a resposta antiga não volta a transação para autorizada
+    stale_transaction.last_sync = None
+    stale_transaction.authorization_nsu = "stale"
+    assert not stale_transaction._update_from_transaction(approved)
+    assert stale_transaction.status == CieloTransactionStatus.Captured
+    assert stale_transaction.last_sync_source == CieloSyncSource.Capture
+
+    cielo_transaction = CieloTransaction.objects.get(pk=cielo_transaction.pk)
+    assert cielo_transaction.status == CieloTransactionStatus.Captured
+    assert cielo_transaction.total_captured_value == Decimal(10)
+    assert cielo_transaction.total_captured_cents == 1000
+
+
+@pytest.mark.django_db
+def test_transaction_currency():
+    shop = get_default_shop()
+    cielo_transaction = create_cielo_transaction(total_captured_value=Decimal(4))
+    assert cielo_transaction.currency == shop.currency
+
+    cielo_transaction = CieloTransaction.objects.get(pk=cielo_transaction.pk)
+
+    # os valores não consultam o pedido
+    with CaptureQueriesContext(connection) as queries:
+        assert cielo_transaction.total.value == Decimal(10)
+        assert cielo_transaction.total.currency == shop.currency
+        assert cielo_transaction.total_captured.value == Decimal(4)
+        assert cielo_transaction.total_reversed.value == Decimal(0)
+        assert len(queries) == 0
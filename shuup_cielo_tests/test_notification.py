@@ -0,0 +1,132 @@
+# -*- coding: utf-8 -*-
+# This file is part of Shuup Cielo.
+#
+# Copyright (c) 2016, Rockho Team. All rights reserved.
+# Author: Christian Hess
+#
+# This source code is licensed under the AGPLv3 license found in the
+# LICENSE file in the root directory of this source tree.
+from __future__ import unicode_literals
+
+import re
+
+from django.core.urlresolvers import reverse
+from django.test.client import Client
+from mock import patch
+import pytest
+
+from cielo_webservice.request import CieloRequest
+from shuup_cielo.constants import CieloCardBrand, CieloProduct, CieloSyncSource, CieloTransactionStatus
+from shuup_cielo.models import CieloTransaction
+from shuup_cielo.status import refresh_transaction
+from shuup_cielo_tests import create_cielo_transaction, get_approved_transaction, get_in_progress_transaction
+from shuup_cielo_tests.test_checkout import get_cielo_config
+
+NOTIFICATION_XML = """<?xml version="1.0" encoding="ISO-8859-1"?>
+<transacao versao="1.3.0" id="1" xmlns="http://ecommerce.cbmp.com.br">
+    <tid>{tid}</tid>
+    <dados-pedido>
+        <numero>{numero}</numero>
+        <valor>{valor}</valor>
+        <moeda>986</moeda>
+        <data-hora>2016-01-01T01:00:00</data-hora>
+    </dados-pedido>
+    <status>{status}</status>
+    <autorizacao>
+        <codigo>4</codigo>
+        <mensagem>Transacao autorizada</mensagem>
+        <data-hora>2016-01-01T01:00:00</data-hora>
+        <valor>{valor}</valor>
+        <lr>00</lr>
+        <arp>123456</arp>
+        <nsu>123</nsu>
+    </autorizacao>
+</transacao>"""
+
+
+def get_notification_message(cielo_transaction, valor=1000, status=CieloTransactionStatus.Authorized):
+    return NOTIFICATION_XML.format(tid=cielo_transaction.tid,
+                                   numero=cielo_transaction.order_transaction_id,
+                                   valor=valor,
+                                   status=status.value)
+
+
+def get_notification_url(cielo_config, token=None):
+    return reverse("shuup:cielo_notification", kwargs={
+        "shop_pk": cielo_config.shop_id,
+        "token": token or cielo_config.get_notification_token()
+    })
+
+
+@pytest.mark.django_db
+def test_notification_invalid_token():
+    cielo_config = get_cielo_config()
+    cielo_transaction = create_cielo_transaction()
+
+    response = Client().post(get_notification_url(cielo_config, "invalid"),
+                             {"mensagem": get_notification_message(cielo_transaction)})
+    assert response.status_code == 403
+
+    cielo_transaction = CieloTransaction.objects.get(pk=cielo_transaction.pk)
+    assert cielo_transaction.status == CieloTransactionStatus.InProgress
+
+
+@pytest.mark.django_db
+def test_notification_invalid_message():
+    cielo_config = get_cielo_config()
+    cielo_transaction = create_cielo_transaction()
+    client = Client()
+
+    response = client.post(get_notification_url(cielo_config), {"mensagem": "not xml"})
+    assert response.status_code == 400
+
+    # o valor não é o da transação
+    response = client.post(get_notification_url(cielo_config),
+                           {"mensagem": get_notification_message(cielo_transaction, valor=1)})
+    assert response.status_code == 400
+
+    # sem os dados do pedido não há como conferir a notificação
+    message = re.sub(r"<dados-pedido>.*</dados-pedido>", "", get_notification_message(cielo_transaction),
+                     flags=re.DOTALL)
+    response = client.post(get_notification_url(cielo_config), {"mensagem": message})
+    assert response.status_code == 400
+
+    cielo_transaction = CieloTransaction.objects.get(pk=cielo_transaction.pk)
+    assert cielo_transaction.status == CieloTransactionStatus.InProgress
+
+
+@pytest.mark.django_db
+def test_notification_updates_transaction():
+    cielo_config = get_cielo_config()
+    cielo_transaction = create_cielo_transaction()
+    message = get_notification_message(cielo_transaction)
+    client = Client()
+
+    transacao = get_approved_transaction(
+        get_in_progress_transaction(numero=cielo_transaction.order_transaction_id, valor=1000,
+                                    produto=CieloProduct.Credit, bandeira=CieloCardBrand.Visa,
+                                    tid=cielo_transaction.tid)
+    )
+
+    with patch.object(CieloRequest, 'consultar', return_value=transacao) as mock_consultar:
+        response = client.post(get_notification_url(cielo_config), {"mensagem": message})
+        assert response.status_code == 200
+        assert not mock_consultar.called
+
+        cielo_transaction = CieloTransaction.objects.get(pk=cielo_transaction.pk)
+        assert cielo_transaction.status == CieloTransactionStatus.Authorized
+        assert cielo_transaction.authorization_lr == "00"
+        assert cielo_transaction.last_sync_source == CieloSyncSource.Notification
+
+        # a autorização notificada é confirmada por uma única consulta
+        assert refresh_transaction(cielo_transaction)
+        assert mock_consultar.call_count == 1
+
+        assert refresh_transaction(cielo_transaction)
+        assert mock_consultar.call_count == 1
+
+    # notificação repetida não atualiza a transação novamente
+    with patch.object(CieloTransaction, '_update_from_transaction') as mock_update:
+        response = client.post(get_notification_url(cielo_config), {"mensagem": message})
+        assert response.status_code == 200
+        assert not mock_update.called
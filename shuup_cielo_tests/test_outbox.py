@@ -0,0 +1,264 @@
+# -*- coding: utf-8 -*-
+# This file is part of Shuup Cielo.
+#
+# Copyright (c) 2016, Rockho Team. All rights reserved.
+# Author: Christian Hess
+#
+# This source code is licensed under the AGPLv3 license found in the
+# LICENSE file in the root directory of this source tree.
+from __future__ import unicode_literals
+
+import copy
+from datetime import timedelta
+from decimal import Decimal
+
+from django.core.management import call_command
+from django.utils.six import StringIO
+from django.utils.timezone import now
+from mock import patch
+import pytest
+
+from cielo_webservice.exceptions import CieloRequestError
+from cielo_webservice.models import dict_to_cancelamento
+from cielo_webservice.request import CieloRequest
+from shuup_cielo.constants import (
+    CieloCardBrand, CieloOperationStatus, CieloOperationType, CieloProduct, CieloTransactionStatus
+)
+from shuup_cielo.models import CieloTransaction
+from shuup_cielo.outbox import get_retry_delay, process_outbox
+from shuup_cielo_tests import (
+    create_cielo_transaction, get_approved_transaction, get_cancelled_transaction, get_captured_transaction,
+    get_in_progress_transaction
+)
+from shuup_cielo_tests.test_checkout import get_cielo_config
+
+
+def get_approved_answer(cielo_transaction):
+    transacao = get_in_progress_transaction(numero=cielo_transaction.order_transaction_id, valor=1000,
+                                            produto=CieloProduct.Credit, bandeira=CieloCardBrand.Visa,
+                                            tid=cielo_transaction.tid)
+    return get_approved_transaction(transacao)
+
+
+def test_retry_delay(settings):
+    settings.CIELO_OUTBOX_RETRY_DELAY = 10
+    settings.CIELO_OUTBOX_MAX_RETRY_DELAY = 60
+    assert get_retry_delay(1) == timedelta(seconds=10)
+    assert get_retry_delay(2) == timedelta(seconds=20)
+    assert get_retry_delay(3) == timedelta(seconds=40)
+    assert get_retry_delay(10) == timedelta(seconds=60)
+
+
+@pytest.mark.django_db
+def test_schedule_cancel():
+    get_cielo_config()
+    cielo_transaction = create_cielo_transaction(CieloTransactionStatus.Authorized)
+
+    with patch.object(CieloRequest, 'cancelar') as mock_cancelar:
+        operation = cielo_transaction.schedule_cancel(cielo_transaction.total_value)
+        assert not mock_cancelar.called
+
+    # agendar novamente não duplica a operação
+    assert cielo_transaction.schedule_cancel(cielo_transaction.total_value) == operation
+    assert cielo_transaction.operations.count() == 1
+
+    cielo_transaction = CieloTransaction.objects.get(pk=cielo_transaction.pk)
+    assert cielo_transaction.status == CieloTransactionStatus.Cancelling
+    assert operation.operation == CieloOperationType.Cancel
+    assert operation.status == CieloOperationStatus.Pending
+
+
+@pytest.mark.django_db
+def test_schedule_cancel_not_authorized():
+    get_cielo_config()
+    cielo_transaction = create_cielo_transaction(CieloTransactionStatus.Authorized)
+    cielo_transaction.status = CieloTransactionStatus.NotAuthorized
+    cielo_transaction.save()
+
+    # nada foi autorizado: não há o que cancelar
+    assert cielo_transaction.schedule_cancel(cielo_transaction.total_value) is None
+    assert cielo_transaction.operations.count() == 0
+
+    cielo_transaction = CieloTransaction.objects.get(pk=cielo_transaction.pk)
+    assert cielo_transaction.status == CieloTransactionStatus.NotAuthorized
+
+
+@pytest.mark.django_db
+def test_process_outbox_abandoned_transaction():
+    get_cielo_config()
+    cielo_transaction = create_cielo_transaction(CieloTransactionStatus.Authenticating)
+    transacao = get_approved_answer(cielo_transaction)
+    authenticating = get_in_progress_transaction(numero=cielo_transaction.order_transaction_id, valor=1000,
+                                                 tid=cielo_transaction.tid)
+    authenticating.status = CieloTransactionStatus.Authenticating.value
+
+    # o cliente desistiu antes da resposta da Cielo
+    operation = cielo_transaction.schedule_cancel(cielo_transaction.total_value)
+    assert operation.status == CieloOperationStatus.Pending
+    assert CieloTransaction.objects.get(pk=cielo_transaction.pk).status == CieloTransactionStatus.Authenticating
+
+    with patch.object(CieloRequest, 'consultar', return_value=authenticating):
+        with patch.object(CieloRequest, 'cancelar') as mock_cancelar:
+            assert process_outbox().retried == 1
+            assert not mock_cancelar.called
+
+    operation.refresh_from_db()
+    operation.next_attempt = now()
+    operation.save()
+
+    # a Cielo autorizou depois: a autorização é estornada
+    with patch.object(CieloRequest, 'consultar', return_value=transacao):
+        with patch.object(CieloRequest, 'cancelar',
+                          return_value=get_cancelled_transaction(copy.copy(transacao))) as mock_cancelar:
+            assert process_outbox().done == 1
+            assert mock_cancelar.call_args[1]["valor"] == 1000
+
+    cielo_transaction = CieloTransaction.objects.get(pk=cielo_transaction.pk)
+    assert cielo_transaction.status == CieloTransactionStatus.Cancelled
+
+
+@pytest.mark.django_db
+def test_process_outbox_abandoned_transaction_refused():
+    get_cielo_config()
+    cielo_transaction = create_cielo_transaction(CieloTransactionStatus.InProgress)
+    refused = get_approved_answer(cielo_transaction)
+    refused.status = CieloTransactionStatus.NotAuthorized.value
+
+    operation = cielo_transaction.schedule_cancel(cielo_transaction.total_value)
+
+    # recusada: não há o que cancelar
+    with patch.object(CieloRequest, 'consultar', return_value=refused):
+        with patch.object(CieloRequest, 'cancelar') as mock_cancelar:
+            assert process_outbox().done == 1
+            assert not mock_cancelar.called
+
+    operation.refresh_from_db()
+    assert operation.status == CieloOperationStatus.Done
+    assert CieloTransaction.objects.get(pk=cielo_transaction.pk).status == CieloTransactionStatus.NotAuthorized
+
+
+@pytest.mark.django_db
+def test_process_outbox():
+    get_cielo_config()
+    cielo_transaction = create_cielo_transaction(CieloTransactionStatus.Authorized)
+    transacao = get_approved_answer(cielo_transaction)
+    operation = cielo_transaction.schedule_capture(cielo_transaction.total_value)
+
+    with patch.object(CieloRequest, 'capturar', return_value=get_captured_transaction(transacao)) as mock_capturar:
+        result = process_outbox()
+        assert result.done == 1
+        assert mock_capturar.call_args[1]["valor"] == 1000
+
+        # nada mais a fazer
+        assert process_outbox().processed == 0
+        assert mock_capturar.call_count == 1
+
+    operation.refresh_from_db()
+    assert operation.status == CieloOperationStatus.Done
+    assert operation.attempts == 1
+
+    cielo_transaction = CieloTransaction.objects.get(pk=cielo_transaction.pk)
+    assert cielo_transaction.status == CieloTransactionStatus.Captured
+    assert cielo_transaction.total_captured_value == Decimal(10)
+
+
+@pytest.mark.django_db
+def test_process_outbox_retry(settings):
+    settings.CIELO_OUTBOX_MAX_ATTEMPTS = 3
+    get_cielo_config()
+    cielo_transaction = create_cielo_transaction(CieloTransactionStatus.Authorized)
+    transacao = get_approved_answer(cielo_transaction)
+    operation = cielo_transaction.schedule_cancel(cielo_transaction.total_value)
+
+    with patch.object(CieloRequest, 'cancelar', side_effect=CieloRequestError("042 - Falha ao cancelar")):
+        result = process_outbox()
+        assert result.retried == 1
+
+        operation.refresh_from_db()
+        assert operation.status == CieloOperationStatus.Pending
+        assert operation.attempts == 1
+        assert operation.next_attempt > now()
+        assert "042" in operation.last_error
+
+        # ainda não chegou a hora da nova tentativa
+        assert process_outbox().processed == 0
+
+    # a tentativa anterior chegou à Cielo: não cancela de novo
+    operation.next_attempt = now()
+    operation.save()
+
+    with patch.object(CieloRequest, 'consultar', return_value=get_cancelled_transaction(transacao)):
+        with patch.object(CieloRequest, 'cancelar') as mock_cancelar:
+            assert process_outbox().done == 1
+            assert not mock_cancelar.called
+
+    cielo_transaction = CieloTransaction.objects.get(pk=cielo_transaction.pk)
+    assert cielo_transaction.status == CieloTransactionStatus.Cancelled
+
+
+def get_partially_cancelled_answer(cielo_transaction, valor):
+    transacao = get_approved_answer(cielo_transaction)
+    transacao.cancelamento = dict_to_cancelamento({
+        'cancelamento': {
+            'codigo': '9',
+            'mensagem': 'cancelado parcialmente',
+            'data-hora': '2016-01-01T01:00Z',
+            'valor': valor
+        }
+    })
+    return transacao
+
+
+@pytest.mark.django_db
+def test_process_outbox_retry_partial_cancel():
+    get_cielo_config()
+    cielo_transaction = create_cielo_transaction(CieloTransactionStatus.Authorized)
+    cielo_transaction.total_reversed_value = Decimal(4)
+    cielo_transaction.save()
+
+    # segundo cancelamento parcial: espera 4 + 3 estornados
+    operation = cielo_transaction.schedule_cancel(Decimal(3))
+    assert operation.expected_total_cents == 700
+
+    with patch.object(CieloRequest, 'cancelar', side_effect=CieloRequestError("042 - Falha ao cancelar")):
+        assert process_outbox().retried == 1
+
+    operation.refresh_from_db()
+    operation.next_attempt = now()
+    operation.save()
+
+    # a Cielo só tem o primeiro cancelamento: este ainda precisa ser enviado
+    with patch.object(CieloRequest, 'consultar', return_value=get_partially_cancelled_answer(cielo_transaction, 400)):
+        with patch.object(CieloRequest, 'cancelar',
+                          return_value=get_partially_cancelled_answer(cielo_transaction, 700)) as mock_cancelar:
+            assert process_outbox().done == 1
+            assert mock_cancelar.call_args[1]["valor"] == 300
+
+    cielo_transaction = CieloTransaction.objects.get(pk=cielo_transaction.pk)
+    assert cielo_transaction.total_reversed_value == Decimal(7)
+
+
+@pytest.mark.django_db
+def test_process_outbox_command(settings):
+    settings.CIELO_OUTBOX_MAX_ATTEMPTS = 2
+    get_cielo_config()
+    cielo_transaction = create_cielo_transaction(CieloTransactionStatus.Authorized)
+    transacao = get_approved_answer(cielo_transaction)
+    operation = cielo_transaction.schedule_cancel(cielo_transaction.total_value)
+
+    with patch.object(CieloRequest, 'consultar', return_value=transacao):
+        with patch.object(CieloRequest, 'cancelar', side_effect=CieloRequestError("042 - Falha ao cancelar")):
+            out = StringIO()
+            call_command("cielo_process_outbox", stdout=out)
+            assert "1 to retry" in out.getvalue()
+
+            operation.next_attempt = now()
+            operation.save()
+
+            out = StringIO()
+            call_command("cielo_process_outbox", stdout=out)
+            assert "1 failed" in out.getvalue()
+
+    operation.refresh_from_db()
+    assert operation.status == CieloOperationStatus.Failed
+    assert operation.attempts == 2
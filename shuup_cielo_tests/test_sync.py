@@ -0,0 +1,164 @@
+# -*- coding: utf-8 -*-
+# This file is part of Shuup Cielo.
+#
+# Copyright (c) 2016, Rockho Team. All rights reserved.
+# Author: Christian Hess
+#
+# This source code is licensed under the AGPLv3 license found in the
+# LICENSE file in the root directory of this source tree.
+from __future__ import unicode_literals
+
+from datetime import timedelta
+from decimal import Decimal
+import os
+import threading
+
+from django.core.cache import cache
+from django.core.management import call_command
+from django.utils.six import StringIO
+from mock import patch
+import pytest
+
+from cielo_webservice.request import CieloRequest
+from shuup_cielo.constants import CieloCardBrand, CieloProduct, CieloTransactionStatus
+from shuup_cielo.models import CieloTransaction
+from shuup_cielo.sync import bulk_update_transactions, get_transactions_to_sync, parse_age, sync_transactions
+from shuup_cielo_tests import (
+    create_cielo_transaction, get_approved_transaction, get_captured_transaction, get_in_progress_transaction
+)
+from shuup_cielo_tests.test_checkout import get_cielo_config
+
+
+def cielo_answer(tid=None, comercial=None):
+    transacao = get_in_progress_transaction(numero=1, valor=1000, produto=CieloProduct.Credit,
+                                            bandeira=CieloCardBrand.Visa, tid=tid)
+    transacao = get_approved_transaction(transacao)
+
+    # as transações pares foram capturadas
+    if int(tid) % 2 == 0:
+        transacao = get_captured_transaction(transacao)
+
+    return transacao
+
+
+def test_parse_age():
+    assert parse_age("30") == timedelta(minutes=30)
+    assert parse_age("12h") == timedelta(hours=12)
+    assert parse_age("7d") == timedelta(days=7)
+
+
+@pytest.mark.django_db
+def test_bulk_update_transactions():
+    get_cielo_config()
+    transaction_1 = create_cielo_transaction(tid="1")
+    transaction_2 = create_cielo_transaction(tid="2")
+
+    transaction_1.status = CieloTransactionStatus.Authorized
+    transaction_1.authorization_lr = "00"
+    transaction_2.status = CieloTransactionStatus.Captured
+    transaction_2.total_captured_value = Decimal(10)
+
+    assert bulk_update_transactions([transaction_1, transaction_2]) == 2
+
+    transaction_1 = CieloTransaction.objects.get(pk=transaction_1.pk)
+    transaction_2 = CieloTransaction.objects.get(pk=transaction_2.pk)
+    assert transaction_1.status == CieloTransactionStatus.Authorized
+    assert transaction_1.authorization_lr == "00"
+    assert transaction_1.authorization_date is None
+    assert transaction_2.status == CieloTransactionStatus.Captured
+    assert transaction_2.total_captured_value == Decimal(10)
+
+
+@pytest.mark.django_db
+def test_bulk_update_transactions_concurrent_capture():
+    get_cielo_config()
+    transaction_1 = create_cielo_transaction(tid="1")
+    transaction_2 = create_cielo_transaction(tid="2")
+
+    transaction_1.status = CieloTransactionStatus.Authorized
+    transaction_1.authorization_lr = "00"
+    transaction_2.status = CieloTransactionStatus.Authorized
+    transaction_2.authorization_lr = "00"
+
+    # capturada enquanto a Cielo era consultada
+    CieloTransaction.objects.filter(pk=transaction_2.pk).update(status=CieloTransactionStatus.Captured,
+                                                                total_captured_cents=1000)
+
+    assert bulk_update_transactions([transaction_1, transaction_2]) == 1
+
+    transaction_1 = CieloTransaction.objects.get(pk=transaction_1.pk)
+    transaction_2 = CieloTransaction.objects.get(pk=transaction_2.pk)
+    assert transaction_1.status == CieloTransactionStatus.Authorized
+    assert transaction_2.status == CieloTransactionStatus.Captured
+    assert transaction_2.total_captured_value == Decimal(10)
+    assert transaction_2.authorization_lr != "00"
+
+
+@pytest.mark.django_db
+def test_sync_transactions_command(tmpdir):
+    cache.clear()
+    get_cielo_config()
+
+    transactions = [create_cielo_transaction(tid="{0}".format(tid)) for tid in range(1, 8)]
+    final_transaction = create_cielo_transaction(CieloTransactionStatus.Cancelled, tid="8")
+
+    assert get_transactions_to_sync(min_age=None).count() == len(transactions)
+    assert get_transactions_to_sync(min_age=timedelta(days=1)).count() == 0
+
+    checkpoint = tmpdir.join("checkpoint").strpath
+    out = StringIO()
+
+    with patch.object(CieloRequest, 'consultar', side_effect=cielo_answer) as mocked_method:
+        call_command("cielo_sync_transactions", min_age="0", workers=3, batch_size=3,
+                     checkpoint=checkpoint, stdout=out)
+
+    # transações finalizadas não são consultadas
+    assert mocked_method.call_count == len(transactions)
+    assert "7 processed, 7 updated, 0 failed" in out.getvalue()
+    assert not os.path.exists(checkpoint)
+
+    for transaction in transactions:
+        transaction = CieloTransaction.objects.get(pk=transaction.pk)
+
+        if int(transaction.tid) % 2 == 0:
+            assert transaction.status == CieloTransactionStatus.Captured
+            assert transaction.total_captured_value == Decimal(10)
+        else:
+            assert transaction.status == CieloTransactionStatus.Authorized
+            assert transaction.authorization_lr == "00"
+
+    assert CieloTransaction.objects.get(pk=final_transaction.pk).status == CieloTransactionStatus.Cancelled
+
+    # retoma a partir do checkpoint
+    with open(checkpoint, "w") as checkpoint_file:
+        checkpoint_file.write("{0}".format(transactions[4].pk))
+
+    with patch.object(CieloRequest, 'consultar', side_effect=cielo_answer) as mocked_method:
+        call_command("cielo_sync_transactions", min_age="0", statuses=["Authorized"],
+                     checkpoint=checkpoint, stdout=StringIO())
+
+    # apenas a última transação autorizada foi consultada
+    assert mocked_method.call_count == 1
+
+
+@pytest.mark.django_db
+def test_sync_transactions_config_main_thread():
+    cache.clear()
+    get_cielo_config()
+    for tid in range(1, 5):
+        create_cielo_transaction(tid="{0}".format(tid))
+
+    get_cielo_config_original = CieloTransaction._get_cielo_config
+    threads = set()
+
+    def get_cielo_config_tracked(transaction):
+        threads.add(threading.current_thread())
+        return get_cielo_config_original(transaction)
+
+    # a configuração é resolvida antes de as threads consultarem a Cielo
+    with patch.object(CieloTransaction, '_get_cielo_config', get_cielo_config_tracked):
+        with patch.object(CieloRequest, 'consultar', side_effect=cielo_answer):
+            result = sync_transactions(get_transactions_to_sync(), workers=3, batch_size=2)
+
+    assert result.fetched == 4
+    assert threads == set([threading.current_thread()])
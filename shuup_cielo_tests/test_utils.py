@@ -9,7 +9,11 @@
 
 from decimal import Decimal
 
-from shuup_cielo.utils import decimal_to_int_cents, InstallmentCalculator, is_cc_valid, safe_int
+from shuup_cielo.constants import InterestType
+from shuup_cielo.utils import (
+    cents_to_decimal, decimal_to_int_cents, get_basket_total, get_installment_table,
+    InstallmentCalculator, is_cc_valid, safe_int
+)
 
 
 def test_validate_cc_number():
@@ -63,6 +67,14 @@ def test_decimal_to_int_cents():
     assert decimal_to_int_cents('32.41312312') == 3241
     assert decimal_to_int_cents('0.0001') == 0
     assert decimal_to_int_cents('0.01') == 1
+    assert decimal_to_int_cents('10.005') == 1001
+    assert decimal_to_int_cents(Decimal('1112.6849')) == 111268
+
+
+def test_cents_to_decimal():
+    assert cents_to_decimal(1324) == Decimal('13.24')
+    assert cents_to_decimal(0) == Decimal(0)
+    assert decimal_to_int_cents(cents_to_decimal(111268)) == 111268
 
 def test_price_interest():
     # Valor financiado=74085.12  parcelas=27  juros=7.54%
@@ -85,3 +97,63 @@ def test_simple_interest():
     total, installment = InstallmentCalculator.simple_interest(Decimal(1000), 10, Decimal(1.99))
     assert abs(installment - Decimal(119.9)) < 0.01
     assert abs(total - Decimal(1199)) < 0.01
+
+
+def test_installment_table():
+    table = get_installment_table(10, 2, InterestType.Price, Decimal("1.99"))
+    assert len(table) == 10
+
+    # calculada uma única vez
+    assert get_installment_table(10, 2, InterestType.Price, Decimal("1.99")) is table
+
+    # sem juros
+    assert table[0] == (1, Decimal(1))
+    assert table[1] == (2, Decimal(1))
+
+    total, installment = InstallmentCalculator.price_interest(Decimal(1000), 10, Decimal("1.99"))
+    assert abs(Decimal(1000) * table[9][1] - total) < 0.01
+    assert abs(Decimal(1000) * table[9][1] - Decimal("1112.68")) < 0.01
+
+    table = get_installment_table(10, 1, InterestType.Simple, Decimal("1.99"))
+    assert Decimal(1000) * table[9][1] == Decimal("1199")
+
+
+class Price(object):
+    def __init__(self, value):
+        self.value = value
+
+
+class TotalBasket(object):
+    payment_method_id = 1
+    shipping_method_id = 2
+
+    def __init__(self):
+        self.calls = 0
+        self._processed_lines_cache = []
+
+    @property
+    def taxful_total_price(self):
+        self.calls += 1
+        return Price(Decimal(10) * self.calls)
+
+
+def test_basket_total():
+    basket = TotalBasket()
+    assert get_basket_total(basket) == Decimal(10)
+    assert get_basket_total(basket) == Decimal(10)
+    assert basket.calls == 1
+
+    # o método de pagamento mudou
+    basket.payment_method_id = 3
+    assert get_basket_total(basket) == Decimal(20)
+    assert basket.calls == 2
+
+    # as linhas mudaram
+    basket._processed_lines_cache = []
+    assert get_basket_total(basket) == Decimal(30)
+    assert get_basket_total(basket) == Decimal(30)
+
+    # sem o cache de linhas não há como saber se o carrinho mudou
+    basket._processed_lines_cache = None
+    assert get_basket_total(basket) == Decimal(40)
+    assert get_basket_total(basket) == Decimal(50)
@@ -13,7 +13,9 @@ from decimal import Decimal
 import json
 import uuid
 
+from django.contrib.sessions.middleware import SessionMiddleware
 from django.core.urlresolvers import reverse
+from django.test.client import RequestFactory
 from mock import patch
 import pytest
 
@@ -21,6 +23,7 @@ from cielo_webservice.request import CieloRequest
 from shuup.core.defaults.order_statuses import create_default_order_statuses
 from shuup.core.models._product_shops import ShopProduct
 from shuup.core.models._service_behavior import FixedCostBehaviorComponent
+from shuup.front.checkout._storage import CheckoutPhaseStorage
 from shuup.testing.factories import (
     get_default_product, get_default_shipping_method, get_default_shop, get_default_supplier,
     get_default_tax_class
@@ -29,12 +32,15 @@ from shuup.testing.mock_population import populate_if_required
 from shuup.utils.i18n import format_money
 from shuup.xtheme._theme import set_current_theme
 from shuup_cielo.constants import (
-    CIELO_SERVICE_CREDIT, CieloCardBrand, CieloProduct, CieloTransactionStatus,
-    InterestType
+    CIELO_SERVICE_CREDIT, CIELO_SERVICE_DEBIT, CieloCardBrand, CieloOperationStatus, CieloOperationType, CieloProduct,
+    CieloTransactionStatus, InterestType
 )
 from shuup_cielo.models import (
     CieloConfig, CieloPaymentProcessor, CieloTransaction, InstallmentContext
 )
+from shuup_cielo.outbox import process_outbox
+from shuup_cielo.views import _configure_basket as configure_basket_from_phases
+from shuup_cielo.views import _get_checkout_phase_identifiers
 from shuup_cielo_tests import (
     AUTH_URL, CC_VISA_1X_INFO, get_approved_transaction, get_cancelled_transaction,
     get_captured_transaction, get_in_progress_transaction
@@ -116,6 +122,27 @@ def _get_configured_basket_client():
     return c
 
 
+class Basket(object):
+    pass
+
+
+@pytest.mark.django_db
+def test_configure_basket_last_phase_wins():
+    request = RequestFactory().get("/")
+    SessionMiddleware().process_request(request)
+    request.basket = Basket()
+
+    phase_identifiers = _get_checkout_phase_identifiers()
+    CheckoutPhaseStorage(request, phase_identifiers[0]).set("payment_method_id", 1)
+    CheckoutPhaseStorage(request, phase_identifiers[-1]).set("payment_method_id", 2)
+    CheckoutPhaseStorage(request, phase_identifiers[0]).set("shipping_method_id", 3)
+
+    # a chave em duas fases: vale a última, como na busca fase a fase
+    configure_basket_from_phases(request)
+    assert request.basket.payment_method_id == 2
+    assert request.basket.shipping_method_id == 3
+
+
 @pytest.mark.django_db
 def test_get_installments_options_rest():
     patch_cielo_request()
@@ -198,6 +225,103 @@ def test_get_installments_3x_no_intereset():
     assert total_3x_no_interest in json_content['installments'][2]['name']
 
 
+@pytest.mark.django_db
+def test_get_installments_all_brands():
+    patch_cielo_request()
+    shop = get_default_shop()
+    create_default_order_statuses()
+    populate_if_required()
+    set_current_theme('shuup.themes.classic_gray')
+    c = SmartClient()
+    _configure_basket(c)
+    CieloConfig.objects.create(shop=shop, max_installments=3, installments_without_interest=3)
+
+    response = c.get(INSTALLMENTS_PATH, {"all": 1})
+    assert response.status_code == 200
+    json_content = json.loads(response.content.decode("utf-8"))
+
+    visa_options = json_content["options"][json_content["brands"][CieloCardBrand.Visa]]
+    discover_options = json_content["options"][json_content["brands"][CieloCardBrand.Discover]]
+    assert len(visa_options) == 3
+    assert len(discover_options) == 1
+
+    # a mesma resposta de uma bandeira por vez
+    response = c.get(INSTALLMENTS_PATH, {"cc_brand": CieloCardBrand.Visa})
+    assert json.loads(response.content.decode("utf-8"))["installments"] == visa_options
+
+
+@pytest.mark.django_db
+def test_get_installments_etag():
+    patch_cielo_request()
+    shop = get_default_shop()
+    create_default_order_statuses()
+    populate_if_required()
+    set_current_theme('shuup.themes.classic_gray')
+    c = SmartClient()
+    _configure_basket(c)
+    cielo_config = CieloConfig.objects.create(shop=shop, max_installments=3, installments_without_interest=3)
+
+    response = c.get(INSTALLMENTS_PATH, {"cc_brand": CieloCardBrand.Visa})
+    assert response.status_code == 200
+    etag = response["ETag"]
+    assert "private" in response["Cache-Control"]
+
+    # nada mudou
+    response = c.get(INSTALLMENTS_PATH, {"cc_brand": CieloCardBrand.Visa}, HTTP_IF_NONE_MATCH=etag)
+    assert response.status_code == 304
+    assert response["ETag"] == etag
+
+    # outra bandeira
+    response = c.get(INSTALLMENTS_PATH, {"cc_brand": CieloCardBrand.Mastercard}, HTTP_IF_NONE_MATCH=etag)
+    assert response.status_code == 200
+    assert response["ETag"] != etag
+
+    # a configuração mudou
+    cielo_config.max_installments = 2
+    cielo_config.save()
+    response = c.get(INSTALLMENTS_PATH, {"cc_brand": CieloCardBrand.Visa}, HTTP_IF_NONE_MATCH=etag)
+    assert response.status_code == 200
+    assert len(json.loads(response.content.decode("utf-8"))['installments']) == 2
+
+
+@pytest.mark.django_db
+def test_get_installments_all_brands_etag_service():
+    patch_cielo_request()
+    shop = get_default_shop()
+    create_default_order_statuses()
+    populate_if_required()
+    set_current_theme('shuup.themes.classic_gray')
+    c = SmartClient()
+    _configure_basket(c)
+    CieloConfig.objects.create(shop=shop, max_installments=3, installments_without_interest=3)
+
+    response = c.get(INSTALLMENTS_PATH, {"all": 1})
+    assert response.status_code == 200
+    etag = response["ETag"]
+    credit_matrix = json.loads(response.content.decode("utf-8"))
+
+    # o cliente troca para débito, com o mesmo total
+    debit_method = get_payment_provider().create_service(
+        CIELO_SERVICE_DEBIT,
+        identifier="cielo_phase_debit",
+        shop=shop,
+        name="debit card",
+        enabled=True,
+        tax_class=get_default_tax_class())
+    c.post(reverse("shuup:checkout", kwargs={"phase": "methods"}), data={
+        "payment_method": debit_method.pk,
+        "shipping_method": get_default_shipping_method().pk
+    })
+
+    response = c.get(INSTALLMENTS_PATH, {"all": 1}, HTTP_IF_NONE_MATCH=etag)
+    assert response.status_code == 200
+    assert response["ETag"] != etag
+
+    debit_matrix = json.loads(response.content.decode("utf-8"))
+    assert debit_matrix != credit_matrix
+    assert len(debit_matrix["options"]) == 1
+
+
 @pytest.mark.django_db
 def test_get_installments_9x_with_simples_intereset():
     """
@@ -347,6 +471,13 @@ def test_transaction_success():
                 assert json_content["success"] is True
                 assert json_content["redirect_url"].endswith(return_url_2)
 
+                # o cancelamento foi agendado
+                t1.refresh_from_db()
+                assert t1.status == CieloTransactionStatus.Cancelling
+                assert not mock_method.called
+
+                process_outbox()
+
                 t1.refresh_from_db()
                 assert t1.status == CieloTransactionStatus.Cancelled
                 # deve ter invocado o método para cancelar
@@ -424,6 +555,8 @@ def test_transaction_success_captured():
                 assert json_content["success"] is True
                 assert json_content["redirect_url"].endswith(AUTH_URL)
 
+                process_outbox()
+
                 # cancelar must be called
                 assert mocked_method.called
 
@@ -503,16 +636,40 @@ def test_return_view_not_authorized():
     transacao1_authenticating = copy.copy(transacao1)
     transacao1_authenticating.status = CieloTransactionStatus.Authenticating
 
-    # the transaction is authenticating for a long time, cancel it and return to payment
-    with patch.object(CieloRequest, 'consultar', return_value=transacao1_authenticating):
+    status_url = reverse("shuup:cielo_transaction_status", kwargs={"cielo_order_pk": 1})
+
+    with patch.object(CieloRequest, 'consultar', return_value=transacao1_authenticating) as mocked_method:
+        # the transaction is still authenticating, render the confirming page right away
         response = c.post(return_url)
+        assert response.status_code == 200
+        assert status_url in response.content.decode("utf-8")
+        assert mocked_method.call_count == 1
+
+        # the page polls the cached status, Cielo is not queried again in the same interval
+        for poll in range(3):
+            response = c.get(status_url)
+            assert response.status_code == 200
+            json_content = json.loads(response.content.decode("utf-8"))
+            assert json_content["pending"] is True
+            assert json_content["status"] == CieloTransactionStatus.Authenticating.value
+        assert mocked_method.call_count == 1
+
+        # wrong cielo order
+        response = c.get(reverse("shuup:cielo_transaction_status", kwargs={"cielo_order_pk": 45405}))
+        assert response.status_code == 404
+
+        # the transaction is authenticating for a long time, cancel it and return to payment
+        response = c.get(return_url, {"final": 1})
         assert response.status_code == 302
         assert response.url.endswith(reverse("shuup:checkout", kwargs={"phase": "payment"}))
         assert "Transaction not authorized:" in response.cookies['messages'].value
 
+    # a Cielo ainda pode autorizar: o cancelamento fica agendado sem mudar o estado
     t1.refresh_from_db()
     assert t1.status == CieloTransactionStatus.Authenticating
     assert t1.authorization_lr == ""
+    assert t1.operations.filter(operation=CieloOperationType.Cancel,
+                                status=CieloOperationStatus.Pending).count() == 1
 
 
 @pytest.mark.django_db
@@ -549,13 +706,17 @@ def test_return_view_not_identified():
 
     # transaction exists, but wrong cielo_order_pk
     return_url = reverse("shuup:cielo_transaction_return", kwargs={"cielo_order_pk": 45405})
+    transacao1_aprovada = get_approved_transaction(copy.copy(transacao1))
     transacao1_cancelada = get_cancelled_transaction(transacao1)
 
-    with patch.object(CieloRequest, 'cancelar', return_value=transacao1_cancelada):
-        response = c.post(return_url)
-        assert response.status_code == 302
-        assert response.url.endswith(reverse("shuup:checkout", kwargs={"phase": "payment"}))
-        assert "Payment not identified. Old transactions were also cancelled" in response.cookies['messages'].value
+    with patch.object(CieloRequest, 'consultar', return_value=transacao1_aprovada):
+        with patch.object(CieloRequest, 'cancelar', return_value=transacao1_cancelada):
+            response = c.post(return_url)
+            assert response.status_code == 302
+            assert response.url.endswith(reverse("shuup:checkout", kwargs={"phase": "payment"}))
+            assert "Payment not identified. Old transactions were also cancelled" in response.cookies['messages'].value
+
+            process_outbox()
 
     t1.refresh_from_db()
     assert t1.status == CieloTransactionStatus.Cancelled